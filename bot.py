@@ -11,11 +11,11 @@
 # - bePaid webhook заглушка: POST /webhook/bepaid
 # - Без дублей, корректный post_init на builder (python-telegram-bot)
 
-import os, io, re, html, json, time, sqlite3, tempfile, logging, threading, asyncio
+import os, io, re, html, json, time, atexit, logging, threading, asyncio
 from time import perf_counter
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from collections import defaultdict, Counter
+from collections import Counter
 from typing import Optional
+from contextvars import ContextVar
 
 # ---------- ЛОГИ ----------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
@@ -38,20 +38,43 @@ VDB_WEBHOOK_SECRET = os.getenv("VDB_WEBHOOK_SECRET", "")
 
 # Директории / БД / Метрики
 DATA_DIR = os.getenv("DATA_DIR", "/data")
-DB_PATH = os.path.join(DATA_DIR, "app.db")
-METRICS_PATH = os.path.join(DATA_DIR, "metrics.json")
+METRICS_PATH = os.path.join(DATA_DIR, "metrics.json")          # старый формат: только импорт при первом старте
+METRICS_LOG_PATH = os.path.join(DATA_DIR, "metrics.log")
 METRICS_AUTOSAVE_SEC = int(os.getenv("METRICS_AUTOSAVE_SEC", "60"))
 
 # ---------- Безопасные импорты RAG / Формулы ----------
 try:
-    from rag_vdb import search_rules as _search_rules, clamp_words as _clamp_words  # type: ignore
+    from rag_vdb import search_rules as _search_rules, clamp_words as _clamp_words, embed_query as _embed_query  # type: ignore
+    from rag_vdb import embed_cache_stats as _embed_cache_stats, search_rules_multi as _search_rules_multi  # type: ignore
+    from rag_vdb import upsert_rules as _upsert_rules, embed_cache_open as _embed_cache_open  # type: ignore
 except Exception as e:
     log.warning(f"RAG not available, using fallbacks: {e}")
-    async def _search_rules(client, query, subject_key, grade, top_k=5): return []
+    async def _search_rules(client, query, subject_key, grade, top_k=5, qv=None): return []
     def _clamp_words(s: str, n: int) -> str: return " ".join((s or "").split()[:max(1, n)])
+    async def _embed_query(client, query): return None
+    def _embed_cache_stats() -> dict: return {}
+    async def _search_rules_multi(client, query, subjects, grade, top_k=5, qv=None): return []
+    async def _upsert_rules(client, rules, timings=None): raise RuntimeError("VDB not available")
+    def _embed_cache_open(): pass
 search_rules = _search_rules
+search_rules_multi = _search_rules_multi
+upsert_rules = _upsert_rules
+embed_query = _embed_query
+embed_cache_stats = _embed_cache_stats
+embed_cache_open = _embed_cache_open
 clamp_words = _clamp_words
 
+VDB_TIMEOUT = float(os.getenv("VDB_TIMEOUT", "3.0"))  # сек на весь поиск (основной + запасной предмет)
+
+async def search_rules_first(query: str, subjects: list, grade: int, top_k: int = 5, qv=None, where: str = "VDB") -> list:
+    """Основной и запасной предмет — одним пакетом под одним таймаутом; берём первый непустой результат."""
+    try:
+        res = await asyncio.wait_for(search_rules_multi(client, query, subjects, grade, top_k=top_k, qv=qv), timeout=VDB_TIMEOUT)
+    except Exception as e:
+        log.warning(f"{where} search timeout/fail: {e!r}")
+        return []
+    return next((r for r in res if r), [])
+
 try:
     from services.formulas import postprocess_formulas as _ppf, extract_tex_snippets as _ets, render_tex_png as _rtp  # type: ignore
     try:
@@ -77,9 +100,11 @@ from telegram import (
 from telegram.constants import ChatAction
 from telegram.error import BadRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler,
-    filters as f
+    Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, TypeHandler,
+    SimpleUpdateProcessor, filters as f
 )
+from telegram.request import HTTPXRequest
+from aiohttp import web
 
 # ---------- OpenAI ----------
 from openai import AsyncOpenAI
@@ -87,15 +112,26 @@ OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))  # сек
 client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=2)
 
 # ---------- OCR ----------
-from PIL import Image, ImageOps, ImageFilter, ImageEnhance
-import pytesseract
-from pytesseract import TesseractError
-# === Анти-OOM настройки изображений ===
-Image.MAX_IMAGE_PIXELS = 24_000_000  # ~24 мегапикселя
+# Сам OCR (Tesseract) живёт в services/ocr.py и крутится в пуле процессов, а не на event loop
+from services.ocr_pool import ocr_pool, OcrBusy, OcrTimeout
+from services.inflight import inflight, content_key as inflight_content_key
+from services.router import router as model_router
+from services.llm_sched import llm_sched, LlmBusy, PRIO_ADMIN, PRIO_PRO, PRIO_FREE, PRIO_FOLLOWUP, PRIO_NAMES
+from services.ocr_cache import ocr_cache
+from services.answer_cache import answer_cache
+from services import storage
+from services.storage import db as app_db, tx as db_tx
+from services.sessions import sessions, FieldView
+from services.metrics_log import MetricsLog
+from services.ingest import ingest, IngestError
+from services import tracing
+from services.tracing import span, aspan
+from services.metrics import (REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, HANDLER as METRICS_HANDLER, LLM_SECONDS,
+                              LLM_TTFT_SECONDS, LLM_INFLIGHT, LLM_TOKENS, LLM_COST_USD, TG_SECONDS, UPDATE_SECONDS,
+                              UPDATES_INFLIGHT)
+from services.usage import llm_usage, llm_cost, llm_event, record_llm, cost_summary
+from services.write_behind import WriteBehind
 MAX_IMAGE_BYTES = 8 * 1024 * 1024    # 8 МБ
-TESS_LANGS_DEFAULT = "rus+eng"
-TESS_LANGS = os.getenv("TESS_LANGS", TESS_LANGS_DEFAULT)
-TESS_CONFIG = os.getenv("TESS_CONFIG", "--oem 3 --psm 6 -c preserve_interword_spaces=1")
 
 # ---------- Guard secrets ----------
 if not TELEGRAM_TOKEN:
@@ -117,35 +153,22 @@ def subject_to_vdb_key(s: str) -> str:
     s = (s or "").strip().lower()
     return SUBJECT_VDB_KEY.get(s, s)
 
-USER_SUBJECT = defaultdict(lambda: "auto")
-USER_GRADE = defaultdict(lambda: "8")
-PARENT_MODE = defaultdict(lambda: True)
-USER_STATE = defaultdict(lambda: None)
-USER_LANG = defaultdict(lambda: "ru")
-PRO_NEXT = defaultdict(lambda: False)
+# Сессии пользователей: LRU в памяти + SQLite (services/sessions.py); интерфейс прежний — USER_*[uid]
+USER_SUBJECT = FieldView(sessions, "subject")
+USER_GRADE = FieldView(sessions, "grade")
+PARENT_MODE = FieldView(sessions, "parent")
+USER_STATE = FieldView(sessions, "state")
+USER_LANG = FieldView(sessions, "lang")
+PRO_NEXT = FieldView(sessions, "pro_next")
 
 # ---------- SQLite: follow-up контекст ----------
-def _db_followup():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute(
-        """CREATE TABLE IF NOT EXISTS followup_state(
-        user_id INTEGER PRIMARY KEY,
-        last_task TEXT,
-        last_answer TEXT,
-        ts INTEGER,
-        used_free INTEGER
-    )"""
-    )
-    return conn
-
 FOLLOWUP_FREE_WINDOW_SEC = 15 * 60
 
 def set_followup_context(uid: int, task_text: str, answer_text: str):
     snippet_task = (task_text or "").strip()[:1200]
     snippet_ans = (answer_text or "").strip()[:1200]
     now = int(time.time())
-    with _db_followup() as db:
+    with db_tx() as db:
         db.execute(
             """INSERT INTO followup_state(user_id,last_task,last_answer,ts,used_free)
                VALUES(?,?,?,?,0)
@@ -155,7 +178,7 @@ def set_followup_context(uid: int, task_text: str, answer_text: str):
         )
 
 def get_followup_context(uid: int) -> Optional[dict]:
-    with _db_followup() as db:
+    with db_tx() as db:
         row = db.execute(
             "SELECT last_task,last_answer,ts,used_free FROM followup_state WHERE user_id=?",
             (uid,),
@@ -165,83 +188,101 @@ def get_followup_context(uid: int) -> Optional[dict]:
     return {"task": row[0] or "", "answer": row[1] or "", "ts": row[2] or 0, "used_free": bool(row[3])}
 
 def mark_followup_used(uid: int):
-    with _db_followup() as db:
+    with db_tx() as db:
         db.execute("UPDATE followup_state SET used_free=1 WHERE user_id=?", (uid,))
 
 def in_free_window(ctx: dict | None) -> bool:
     return bool(ctx) and (int(time.time()) - int(ctx.get("ts", 0)) <= FOLLOWUP_FREE_WINDOW_SEC)
 
 # ---------- SQLite: план пользователя (pro_until, free-лимиты, кредиты) ----------
-def _db_plan():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute(
-        """CREATE TABLE IF NOT EXISTS user_plan(
-            user_id INTEGER PRIMARY KEY,
-            pro_until INTEGER NOT NULL DEFAULT 0,
-            day INTEGER NOT NULL DEFAULT 0,
-            free_count INTEGER NOT NULL DEFAULT 0,
-            credits INTEGER NOT NULL DEFAULT 0,
-            sub_until INTEGER NOT NULL DEFAULT 0
-        )"""
-    )
-    return conn
-
 DAY = lambda: int(time.time() // 86400)
 FREE_LIMIT_PER_DAY = 10  # ← требование
+TRIAL_SEC = 7 * 24 * 3600
+_PLAN_COLS = "pro_until,day,free_count,credits,sub_until"
 
-def _ensure_user_plan(uid: int) -> dict:
-    now = int(time.time())
-    with _db_plan() as db:
-        row = db.execute("SELECT user_id,pro_until,day,free_count,credits,sub_until FROM user_plan WHERE user_id=?", (uid,)).fetchone()
-        if row:
-            return {"user_id": row[0], "pro_until": row[1], "day": row[2], "free_count": row[3], "credits": row[4], "sub_until": row[5]}
-        # Первый визит → даём 7 дней Pro
-        pro_until = now + 7 * 24 * 3600
-        db.execute("INSERT INTO user_plan(user_id,pro_until,day,free_count,credits,sub_until) VALUES(?,?,?,?,?,?)",
-                   (uid, pro_until, DAY(), 0, 0, 0))
-        return {"user_id": uid, "pro_until": pro_until, "day": DAY(), "free_count": 0, "credits": 0, "sub_until": 0}
-
-def _roll_day(uid: int):
-    with _db_plan() as db:
-        row = db.execute("SELECT day FROM user_plan WHERE user_id=?", (uid,)).fetchone()
-        today = DAY()
-        if not row:
-            db.execute("INSERT OR IGNORE INTO user_plan(user_id,day) VALUES(?,?)", (uid, today))
-            return
-        if row[0] != today:
-            db.execute("UPDATE user_plan SET day=?, free_count=0 WHERE user_id=?", (today, uid))
+# Мемо на время одного апдейта (ставит _begin_update в группе -1): повторные plan_get бесплатны,
+# consume_request списывает не больше одного раза, refund_request знает, что вернуть.
+_UPDATE_MEMO: ContextVar[Optional[dict]] = ContextVar("update_memo", default=None)
 
-def plan_get(uid: int) -> dict:
-    _ensure_user_plan(uid)
-    _roll_day(uid)
-    with _db_plan() as db:
-        row = db.execute("SELECT pro_until,day,free_count,credits,sub_until FROM user_plan WHERE user_id=?", (uid,)).fetchone()
+def _plan_dict(row) -> dict:
     now = int(time.time())
     pro_active = (row[0] > now) or (row[4] > now)
     free_left = max(0, FREE_LIMIT_PER_DAY - int(row[2] or 0))
     return {"pro_active": pro_active, "free_left_today": free_left, "pro_until": row[0], "credits": int(row[3] or 0), "sub_until": row[4]}
 
-def inc_free(uid: int):
-    with _db_plan() as db:
-        db.execute("UPDATE user_plan SET free_count = free_count + 1 WHERE user_id=?", (uid,))
+def _plan_row(db, uid: int) -> tuple:
+    """Строка плана на сегодня. Обычно — один SELECT; новый пользователь или новый день — один UPSERT … RETURNING."""
+    today = DAY()
+    row = db.execute(f"SELECT {_PLAN_COLS} FROM user_plan WHERE user_id=?", (uid,)).fetchone()
+    if row and row[1] == today:
+        return row
+    # Первый визит → даём 7 дней Pro; новый день → обнуляем free-счётчик
+    return db.execute(
+        f"""INSERT INTO user_plan(user_id,pro_until,day,free_count,credits,sub_until) VALUES(?,?,?,0,0,0)
+            ON CONFLICT(user_id) DO UPDATE SET day=excluded.day,
+                free_count=CASE WHEN user_plan.day=excluded.day THEN user_plan.free_count ELSE 0 END
+            RETURNING {_PLAN_COLS}""",
+        (uid, int(time.time()) + TRIAL_SEC, today),
+    ).fetchall()[0]
 
-def dec_credit(uid: int) -> bool:
-    with _db_plan() as db:
-        row = db.execute("SELECT credits FROM user_plan WHERE user_id=?", (uid,)).fetchone()
-        if not row or int(row[0] or 0) <= 0:
-            return False
-        db.execute("UPDATE user_plan SET credits = credits - 1 WHERE user_id=?", (uid,))
-        return True
+def plan_get(uid: int) -> dict:
+    memo = _UPDATE_MEMO.get()
+    if memo is not None and ("plan", uid) in memo:
+        return memo[("plan", uid)]
+    with db_tx() as db:
+        plan = _plan_dict(_plan_row(db, uid))
+    if memo is not None:
+        memo[("plan", uid)] = plan
+    return plan
+
+def _charge(uid: int, need_pro: bool) -> tuple:
+    """Списание одной транзакцией: строка плана + условный UPDATE … RETURNING (условие и есть защита от гонок)."""
+    with db_tx() as db:
+        plan = _plan_dict(_plan_row(db, uid))
+        if need_pro:
+            if plan["pro_active"]:
+                return True, "pro", "", None, plan
+            rows = db.execute("UPDATE user_plan SET credits = credits - 1 WHERE user_id=? AND credits > 0 RETURNING credits",
+                              (uid,)).fetchall()
+            if rows:
+                plan["credits"] = int(rows[0][0])
+                return True, "pro", "", "credit", plan
+            return False, "free", "нужен Pro (подписка/кредиты)", None, plan
+        today = DAY()
+        rows = db.execute(
+            """UPDATE user_plan SET free_count = CASE WHEN day=?1 THEN free_count + 1 ELSE 1 END, day=?1
+               WHERE user_id=?2 AND (day<>?1 OR free_count < ?3) RETURNING ?3 - free_count""",
+            (today, uid, FREE_LIMIT_PER_DAY),
+        ).fetchall()
+        if rows:
+            plan["free_left_today"] = int(rows[0][0])
+            return True, "free", "", "free", plan
+        return False, "free", "исчерпан дневной лимит Free", None, plan
+
+def refund_request(uid: int) -> bool:
+    """Вернуть списание текущего апдейта (LLM/OCR не дали результата). Повторный вызов — no-op."""
+    memo = _UPDATE_MEMO.get()
+    charge = memo.get(("charge", uid)) if memo is not None else None
+    if not charge or charge[3] is None or memo.get(("refunded", uid)):
+        return False
+    with db_tx() as db:
+        if charge[3] == "credit":
+            db.execute("UPDATE user_plan SET credits = credits + 1 WHERE user_id=?", (uid,))
+        else:
+            db.execute("UPDATE user_plan SET free_count = MAX(0, free_count - 1) WHERE user_id=? AND day=?", (uid, DAY()))
+    memo[("refunded", uid)] = True
+    memo.pop(("plan", uid), None)
+    log.info(f"Quota refund uid={uid} kind={charge[3]}")
+    return True
 
 def add_credits(uid: int, cnt: int):
-    with _db_plan() as db:
+    with db_tx() as db:
         db.execute("INSERT INTO user_plan(user_id,credits) VALUES(?,?) ON CONFLICT(user_id) DO UPDATE SET credits=credits+?",
                    (uid, cnt, cnt))
 
 def activate_sub(uid: int, months: int = 1):
     until = int(time.time()) + int(months * 30 * 24 * 3600)
-    with _db_plan() as db:
+    with db_tx() as db:
         db.execute("INSERT INTO user_plan(user_id,sub_until) VALUES(?,?) ON CONFLICT(user_id) DO UPDATE SET sub_until=?",
                    (uid, until, until))
 
@@ -260,6 +301,10 @@ def kb(uid: int) -> ReplyKeyboardMarkup:
         resize_keyboard=True,
     )
 
+# подписи кнопок (нижний регистр, префиксы) — управляющие тексты, не задания: дубли не склеиваем
+MENU_LABELS = ("🧠 объяснить", "📝 сочинение", "⭐ pro", "📚 предмет:", "🎓 класс:", "👨‍👩‍👧 родит.:",
+               "ℹ️ free vs pro", "💳 купить", "🧾 моя статистика", "📸 решить по фото", "✍️ напишу текстом")
+
 # ---------- Безопасный HTML ----------
 ALLOWED_TAGS = {"b", "i", "code", "pre"}
 _TAG_OPEN = {t: f"&lt;{t}&gt;" for t in ALLOWED_TAGS}
@@ -283,10 +328,15 @@ async def safe_reply_html(message: Message, text: str, **kwargs):
         raise
 
 # ---------- Спиннер ----------
-async def start_spinner(update: Update, context: ContextTypes.DEFAULT_TYPE, label="Обрабатываю…", interval=1.6):
-    msg = await update.message.reply_text(f"⏳ {label}")
+async def start_spinner(update: Update, context: ContextTypes.DEFAULT_TYPE, label="Обрабатываю…", interval=1.6,
+                        reply_markup=None):
+    # reply_markup — сразу со спиннером: если ответ придёт потоком в это же сообщение, обычную клавиатуру
+    # правкой уже не навесить (editMessageText принимает только inline)
+    msg = await update.message.reply_text(f"⏳ {label}", reply_markup=reply_markup)
     stop = asyncio.Event()
     current_label = label
+    kept = False
+    on_finish = []
     def set_label(s: str):
         nonlocal current_label
         current_label = s
@@ -299,15 +349,95 @@ async def start_spinner(update: Update, context: ContextTypes.DEFAULT_TYPE, labe
             except Exception: pass
             await asyncio.sleep(interval)
     task = asyncio.create_task(worker())
+    async def take_over(on_done=None):
+        """Остановить анимацию и отдать сообщение под потоковый ответ. keep() — не удалять его в finish."""
+        if on_done: on_finish.append(on_done)
+        stop.set()
+        try: await task
+        except Exception: pass
+        def keep():
+            nonlocal kept
+            kept = True
+        return msg, keep
     async def finish(final_text: str = None, delete: bool = True):
         stop.set()
+        for cb in on_finish: cb()
         try: await task
         except Exception: pass
+        if kept: return
         try:
             if final_text: await msg.edit_text(final_text)
             if delete: await msg.delete()
         except Exception: pass
-    return finish, set_label
+    return finish, set_label, take_over
+
+# ---------- Потоковый ответ в сообщении спиннера ----------
+LLM_STREAM = os.getenv("LLM_STREAM", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))  # Telegram: ~1 правка/сек на чат
+
+def _live_html(text: str) -> str:
+    """HTML для промежуточной правки: обрезаем недописанный тег и закрываем открытые."""
+    text = re.sub(r"<[^<>]{0,10}$", "", text or "")
+    low = text.lower()
+    for t in ALLOWED_TAGS:
+        if low.count(f"<{t}>") > low.count(f"</{t}>"):
+            text += f"</{t}>"
+    return sanitize_html(text)
+
+class LiveAnswer:
+    """Частичный ответ модели прямо в сообщении спиннера (правки — фоном, с троттлингом)."""
+    def __init__(self, take_over, interval: float = STREAM_EDIT_INTERVAL):
+        self._take_over = take_over
+        self._interval = interval
+        self._msg: Message | None = None
+        self._keep = None
+        self._text = ""
+        self._shown = ""
+        self._done = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def push(self, text_so_far: str):
+        self._text = text_so_far
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+
+    async def _edit(self, html_text: str, reply_markup: InlineKeyboardMarkup | None = None) -> bool:
+        try:
+            await self._msg.edit_text(html_text, parse_mode="HTML", disable_web_page_preview=True, reply_markup=reply_markup)
+            return True
+        except BadRequest as e:
+            return "not modified" in str(e)
+        except Exception:
+            return False
+
+    async def _pump(self):
+        self._msg, self._keep = await self._take_over(self._done.set)
+        while not self._done.is_set():
+            if self._text != self._shown:
+                shown = self._text
+                await self._edit(_live_html(shown[:3900]) + " ▌")
+                self._shown = shown
+            try: await asyncio.wait_for(self._done.wait(), timeout=self._interval)
+            except asyncio.TimeoutError: pass
+
+    async def finalize(self, final_text: str, reply_markup=None) -> bool:
+        """Итог — правкой того же сообщения. False — потока не было/не вышло, отвечаем обычным сообщением.
+        Inline-клавиатура уходит в правку; обычная (kb) уже висит на сообщении со start_spinner(reply_markup=...)."""
+        if self._task is None:
+            return False
+        self._done.set()
+        try: await self._task
+        except Exception: pass
+        if self._msg is None:
+            return False
+        inline = reply_markup if isinstance(reply_markup, InlineKeyboardMarkup) else None
+        if await self._edit(sanitize_html(final_text), inline):
+            self._keep()
+            return True
+        try: await self._msg.delete()
+        except Exception: pass
+        self._keep()
+        return False
 
 # ---------- Детект языка ----------
 def detect_lang(text: str) -> str:
@@ -334,6 +464,7 @@ SUBJECT_HINTS = [
     ("русский", ("деепричаст", "причаст", "синтакс", "морфем", "ударен", "орфограм")),
     ("английский", ("present", "past", "future", "vocabulary", "grammar", "essay", "speaking")),
 ]
+@tracing.traced("classify_subject")
 async def classify_subject(text: str) -> str:
     t = (text or "").lower()
     for subj, keys in SUBJECT_HINTS:
@@ -360,107 +491,195 @@ def sys_prompt(uid: int) -> str:
            if parent else "")
     return f"{base} {form_hint} {sub} {grd} {par}"
 
-# ---------- OCR pipeline ----------
-def _preprocess_image(img: Image.Image) -> Image.Image:
-    img = ImageOps.exif_transpose(img)
-    max_side = 1800
-    if max(img.width, img.height) > max_side:
-        scale = max_side / max(img.width, img.height)
-        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
-    img = img.convert("L")
-    img = ImageOps.autocontrast(img)
-    img = ImageEnhance.Sharpness(img).enhance(1.1)
-    return img
-
-def ocr_image(img: Image.Image) -> str:
-    base = ImageOps.exif_transpose(img)
-    langs_chain = [TESS_LANGS, "rus", "eng", "bel"] if TESS_LANGS else ["rus", "eng", "bel"]
-    for angle in (0, 90, 180, 270):
-        rot = base.rotate(-angle, expand=True)
-        p = _preprocess_image(rot)
-        for langs in langs_chain:
-            try:
-                txt = pytesseract.image_to_string(p, lang=langs, config=TESS_CONFIG)
-                if txt and txt.strip():
-                    return txt.strip()
-            except TesseractError:
-                continue
-    return ""
-
 # ---------- Роутер моделей ----------
-HEAVY_MARKERS = ("докажи","обоснуй","подробно","по шагам","поиндукции","уравнен","система",
-                 "дроб","производн","интеграл","доказат","программа","алгоритм","код","теорем")
-
-def select_model(prompt: str, mode: str) -> tuple[str, int, str]:
-    p = (prompt or "").lower()
-    if mode == "free":
-        return "gpt-4o-mini", 800, "4o-mini"
-    if mode == "pro":
-        long_input = len(p) > 600
-        heavy = long_input or any(k in p for k in HEAVY_MARKERS)
-        if heavy and len(p) > 1200:
-            return "gpt-4o", 1100, "4o"
-        if heavy:
-            return "o4-mini", 1100, "o4-mini"
-        return "gpt-4o-mini", 900, "4o-mini"
-    return "gpt-4o-mini", 800, "4o-mini"
+# Правило выбора и здоровье моделей (задержки, ошибки, предохранитель) — services/router.py
+def llm_prio(uid: int, mode: str, followup: bool = False) -> int:
+    """Класс в очереди LLM: админ > Pro/кредит > Free > уточнение."""
+    if is_admin(uid):
+        return PRIO_ADMIN
+    if followup:
+        return PRIO_FOLLOWUP
+    return PRIO_PRO if mode == "pro" else PRIO_FREE
 
-# ---------- Вызовы LLM ----------
-async def call_model(uid: int, user_text: str, mode: str) -> str:
-    lang = detect_lang(user_text); USER_LANG[uid] = lang
-    model, max_out, tag = select_model(user_text, mode)
-    sys = sys_prompt(uid)
+def queue_label(spinner_set, label: str):
+    """on_queue для планировщика LLM: позиция в очереди — в подписи спиннера, по выходу — прежняя подпись."""
+    return lambda pos: spinner_set(f"В очереди: {pos}-й… {label}" if pos else label)
 
-    # ВБД (RAG)
+def _billing_mode(uid: int, mode: str) -> str:
+    """Чем оплачен вызов (events.mode): admin | sub | credit | free."""
+    if is_admin(uid):
+        return "admin"
+    memo = _UPDATE_MEMO.get()
+    charge = memo.get(("charge", uid)) if memo is not None else None
+    if charge and charge[3]:
+        return charge[3]   # "credit" | "free"
+    return "sub" if mode == "pro" else "free"
+
+def _write_llm_events(rows):
+    with db_tx() as db:
+        record_llm(db, rows)
+
+# строки events с токенами пишет фоновый поток пачками — commit в app.db не на event loop после каждого вызова
+LLM_EVENTS = WriteBehind("llm-events-writer", _write_llm_events)
+
+def account_llm(uid: int, mode: str, model: str, tag: str, kind: str, resp_usage) -> tuple:
+    """Токены из resp.usage → стоимость по таблице цен; счётчики пользователя, Prometheus и строка в events."""
+    prompt, cached, completion = llm_usage(resp_usage)
+    if not (prompt or completion):
+        return 0, 0, 0, 0.0
+    cost = llm_cost(model, prompt, cached, completion)
+    bmode = _billing_mode(uid, mode)
+    LLM_TOKENS.inc(prompt, model=model, type="prompt")
+    LLM_TOKENS.inc(cached, model=model, type="cached")
+    LLM_TOKENS.inc(completion, model=model, type="completion")
+    LLM_COST_USD.inc(cost, model=model, mode=bmode)
+    stats_bump(uid, tok_prompt=prompt, tok_cached=cached, tok_completion=completion, cost_usd=cost)
+    with STATS_LOCK:
+        for agg, key in ((COST_MODELS, model), (COST_MODES, bmode)):
+            a = agg.setdefault(key, dict.fromkeys(_COST_FIELDS, 0))
+            a["calls"] += 1; a["prompt"] += prompt; a["cached"] += cached; a["completion"] += completion
+            a["cost_usd"] += cost
+    LLM_EVENTS.add(llm_event(uid, bmode, tag, model, kind, prompt, cached, completion, cost))
+    return prompt, cached, completion, cost
+
+LLM_BUSY_TEXT = "⏳ Сейчас очень много запросов — попробуй через минуту. Лимит не списан."
+
+# ---------- Вызовы LLM ----------
+async def retrieve_context(uid: int, user_text: str, qv_task: "asyncio.Future | None" = None) -> tuple:
+    """Эмбеддинг запроса + поиск правил ВБД → (qv, подсказки). От квоты не зависит — можно запускать заранее."""
     vdb_hints = []
+    qv = None
     try:
         subj_key = subject_to_vdb_key(USER_SUBJECT[uid])
         grade_int = int(USER_GRADE[uid]) if str(USER_GRADE[uid]).isdigit() else 8
         query_for_vdb = clamp_words(user_text, 40)
-        async def _srch(skey): return await search_rules(client, query_for_vdb, skey, grade_int)
+        # эмбеддинг запроса — один на всё: почти-дубликаты в кэше, основной и запасной поиск правил
         try:
-            rules = await asyncio.wait_for(_srch(subj_key), timeout=3.0)
+            with span("embed" if qv_task is None else "embed_wait"):
+                qv = await asyncio.wait_for(qv_task or embed_query(client, query_for_vdb), timeout=VDB_TIMEOUT)
         except Exception as e:
-            log.warning(f"VDB primary timeout/fail: {e}"); rules = []
-        if not rules and subj_key != USER_SUBJECT[uid]:
-            try:
-                rules = await asyncio.wait_for(_srch(USER_SUBJECT[uid]), timeout=3.0)
-            except Exception as e:
-                log.warning(f"VDB fallback timeout/fail: {e}"); rules = []
+            log.warning(f"VDB embed timeout/fail: {e!r}")
+        with span("vdb_search") as sp:
+            rules = await search_rules_first(query_for_vdb, [subj_key, USER_SUBJECT[uid]], grade_int, qv=qv)
+            sp["hits"] = len(rules or [])
         for r in (rules or [])[:5]:
             brief = (r.get("rule_brief") if isinstance(r, dict) else str(r)) or ""
             brief = clamp_words(brief, 120)
             if brief: vdb_hints.append(f"• {brief}")
     except Exception as e:
         log.warning(f"VDB block error: {e}")
+    return qv, vdb_hints
+
+async def call_model(uid: int, user_text: str, mode: str, on_delta=None, rag: "asyncio.Task | None" = None,
+                     on_queue=None) -> str:
+    """on_delta(text_so_far) — включает потоковый режим (частичный ответ в сообщении спиннера).
+    rag — заранее запущенный retrieve_context (см. explain_cmd); без него поиск идёт здесь.
+    on_queue(pos) — позиция в очереди LLM (см. queue_label).
+    LlmBusy — очередь отказала, лимит уже возвращён: ответить LLM_BUSY_TEXT, контекст уточнения не сохранять."""
+    lang = detect_lang(user_text); USER_LANG[uid] = lang
+    sys = sys_prompt(uid)
+
+    # Кэш ответов: то же задание (с точностью до нормализации) в том же предмете/классе/режиме
+    ck = (user_text, USER_SUBJECT[uid], str(USER_GRADE[uid]), mode, bool(PARENT_MODE[uid]))
+    with span("answer_cache", kind="exact"):
+        cached = answer_cache.get_exact(*ck)
+    if cached:
+        if rag: rag.cancel()
+        log.info(f"LLM answer cache: exact hit mode={mode}")
+        return cached
 
+    # ВБД (RAG)
+    if rag:
+        qv, vdb_hints = await aspan("rag_wait", rag)
+    else:
+        qv, vdb_hints = await retrieve_context(uid, user_text)
+    with span("answer_cache", kind="similar"):
+        cached = answer_cache.get_similar(*ck, qv)
+    if cached:
+        log.info(f"LLM answer cache: similar hit mode={mode}")
+        return cached
+
+    # модель выбираем только когда до неё реально дойдём: select() в half-open выдаёт пробу
+    rt = model_router.select(user_text, mode)
+    model, max_out, tag, route = rt[:4]
     vdb_context = ("\n\n[ВБД-памятка: используй только как справку, без ссылок на книги]\n" + "\n".join(vdb_hints)) if vdb_hints else ""
     content = (
         "Реши задание. Сначала <b>Ответы</b>, затем <b>Пояснение</b> простым русским. "
         f"Текст/условие:\n{user_text}" + vdb_context
     )
 
-    t0 = perf_counter()
+    prio = llm_prio(uid, mode)
     try:
-        resp = await client.chat.completions.create(
-            model=model,
-            messages=[{"role": "system", "content": sys}, {"role": "user", "content": content}],
-            temperature=0.25 if mode == "free" else 0.3,
-            max_tokens=max_out,
-        )
-        out_text = (resp.choices[0].message.content or "").strip()
-    except Exception:
-        log.exception("LLM error")
-        out_text = "❌ Не получилось получить ответ от модели. Попробуй ещё раз."
+        with span("llm_queue", prio=PRIO_NAMES[prio]):
+            waited = await llm_sched.acquire(model, prio, uid, on_queue=on_queue)
+    except BaseException as e:
+        model_router.release(rt)   # до модели не дошли — проба half-open не должна зависнуть
+        if not isinstance(e, LlmBusy):
+            raise
+        log.warning(f"LLM queue: {e}")
+        refund_request(uid)
+        raise
+    t0 = perf_counter()
+    ttft = None
+    ok = False
+    resp_usage = None
+    LLM_INFLIGHT.inc(model=model)
+    with span("llm", model=model, tag=tag, route=route) as llm_attrs:
+        try:
+            req = dict(
+                model=model,
+                messages=[{"role": "system", "content": sys}, {"role": "user", "content": content}],
+                temperature=0.25 if mode == "free" else 0.3,
+                max_tokens=max_out,
+            )
+            if on_delta is None:
+                resp = await client.chat.completions.create(**req)
+                out_text = (resp.choices[0].message.content or "").strip()
+                resp_usage = resp.usage
+            else:
+                buf = ""
+                # include_usage: последний чанк (без choices) несёт usage всего ответа
+                stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **req)
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        resp_usage = chunk.usage
+                    piece = (chunk.choices[0].delta.content or "") if chunk.choices else ""
+                    if not piece:
+                        continue
+                    if ttft is None:
+                        ttft = perf_counter() - t0
+                        _note_ttft(ttft)
+                        LLM_TTFT_SECONDS.observe(ttft, model=model, tag=tag)
+                        llm_attrs["ttft_ms"] = round(ttft * 1000)
+                    buf += piece
+                    on_delta(buf)
+                out_text = buf.strip()
+            ok = bool(out_text)
+        except Exception:
+            log.exception("LLM error")
+            llm_attrs["status"] = "error"
+            out_text = "❌ Не получилось получить ответ от модели. Попробуй ещё раз."
+            refund_request(uid)
+        finally:
+            LLM_INFLIGHT.dec(model=model)
+            llm_sched.release(model)
     dt = perf_counter() - t0
-    log.info(f"LLM model={model} tag={tag} mode={mode} dt={dt:.2f}s")
+    LLM_SECONDS.observe(dt, model=model, tag=tag, kind="solve", status="ok" if ok else "error")
+    model_router.record(model, dt, ok, reason=route)
+    if ok:
+        answer_cache.put(*ck, out_text, dt, qv=qv)
+    tok_in, tok_cached, tok_out, cost = account_llm(uid, mode, model, tag, "solve", resp_usage)
+    log.info(f"LLM model={model} tag={tag} route={route} mode={mode} prio={PRIO_NAMES[prio]} wait={waited:.2f}s dt={dt:.2f}s"
+             + (f" ttft={ttft:.2f}s" if ttft is not None else "")
+             + f" tokens={tok_in}/{tok_cached}/{tok_out} cost=${cost:.5f}")
     try:
-        st = _get_user_stats(uid); st.gpt_calls += 1; st.gpt_time_sum += float(dt)
+        stats_bump(uid, gpt_calls=1, gpt_time_sum=float(dt))
     except Exception:
         pass
     return out_text
 
 async def call_model_followup(uid: int, prev_task: str, prev_answer: str, follow_q: str, mode_tag: str) -> str:
+    """LlmBusy — как у call_model: списание уже возвращено, вызывающий отвечает LLM_BUSY_TEXT."""
     sys = sys_prompt(uid)
     prompt = (
         "Коротко и по делу дополни/уточни предыдущее решение.\n\n"
@@ -469,56 +688,98 @@ async def call_model_followup(uid: int, prev_task: str, prev_answer: str, follow
         f"Вопрос-уточнение:\n{follow_q[:1200]}\n\n"
         "Дай ТОЛЬКО дополнение, без переписывания."
     )
-    model, max_out, tag = select_model(prev_task + " " + follow_q, mode_tag)
-    t0 = perf_counter()
+    rt = model_router.select(prev_task + " " + follow_q, mode_tag)
+    model, max_out, tag, route = rt[:4]
+    prio = llm_prio(uid, mode_tag, followup=True)
     try:
-        resp = await client.chat.completions.create(
-            model=model,
-            messages=[{"role": "system", "content": sys}, {"role": "user", "content": prompt}],
-            temperature=0.25 if mode_tag == "free" else 0.3,
-            max_tokens=min(600, max_out),
-        )
-        out = (resp.choices[0].message.content or "").strip()
-    except Exception:
-        log.exception("LLM followup error")
-        out = "❌ Не удалось получить уточнение. Попробуй ещё раз."
+        with span("llm_queue", prio=PRIO_NAMES[prio]):
+            waited = await llm_sched.acquire(model, prio, uid)
+    except BaseException as e:
+        model_router.release(rt)
+        if not isinstance(e, LlmBusy):
+            raise
+        log.warning(f"LLM queue: {e}")
+        refund_request(uid)
+        raise
+    t0 = perf_counter()
+    status = "ok"
+    resp_usage = None
+    LLM_INFLIGHT.inc(model=model)
+    with span("llm", model=model, tag=tag, kind="followup", route=route):
+        try:
+            resp = await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "system", "content": sys}, {"role": "user", "content": prompt}],
+                temperature=0.25 if mode_tag == "free" else 0.3,
+                max_tokens=min(600, max_out),
+            )
+            out = (resp.choices[0].message.content or "").strip()
+            resp_usage = resp.usage
+        except Exception:
+            log.exception("LLM followup error")
+            out = "❌ Не удалось получить уточнение. Попробуй ещё раз."
+            status = "error"
+            refund_request(uid)
+        finally:
+            LLM_INFLIGHT.dec(model=model)
+            llm_sched.release(model)
     dt = perf_counter() - t0
-    log.info(f"LLM followup model={model} tag={tag} mode={mode_tag} dt={dt:.2f}s")
+    LLM_SECONDS.observe(dt, model=model, tag=tag, kind="followup", status=status)
+    model_router.record(model, dt, status == "ok", reason=route)
+    tok_in, tok_cached, tok_out, cost = account_llm(uid, mode_tag, model, tag, "followup", resp_usage)
+    log.info(f"LLM followup model={model} tag={tag} route={route} mode={mode_tag} wait={waited:.2f}s dt={dt:.2f}s "
+             f"tokens={tok_in}/{tok_cached}/{tok_out} cost=${cost:.5f}")
     try:
-        st = _get_user_stats(uid); st.gpt_calls += 1; st.gpt_time_sum += float(dt)
+        stats_bump(uid, gpt_calls=1, gpt_time_sum=float(dt))
     except Exception:
         pass
     return out
 
 # ---------- Формулы ----------
-async def reply_with_formulas(message: Message, raw_text: str, reply_markup=None):
+async def reply_with_formulas(message: Message, raw_text: str, reply_markup=None, live: "LiveAnswer | None" = None):
     text = postprocess_formulas(raw_text or "")
-    await safe_reply_html(message, text, reply_markup=reply_markup)
+    with span("reply", chars=len(text)):
+        if not (live and await live.finalize(text, reply_markup)):
+            await safe_reply_html(message, text, reply_markup=reply_markup)
     if RENDER_TEX:
-        try:
-            for tex in extract_tex_snippets(text)[:4]:
-                png = render_tex_png(tex)
-                await message.reply_photo(png, caption="Формула")
-        except Exception as e:
-            log.warning(f"TEX render fail: {e}")
+        with span("tex") as sp:
+            try:
+                for tex in extract_tex_snippets(text)[:4]:
+                    png = render_tex_png(tex)
+                    await message.reply_photo(png, caption="Формула")
+                    sp["n"] = sp.get("n", 0) + 1
+            except Exception as e:
+                log.warning(f"TEX render fail: {e}")
 
 # ---------- Внутренние метрики ----------
 STATS_LOCK = threading.RLock()
 
 class UserStats:
     __slots__ = ("uid","name","username","first_seen","last_seen","kinds","subjects","langs","gpt_calls","gpt_time_sum",
-                 "tok_prompt","tok_completion","ocr_ok","ocr_fail","bytes_images_in")
+                 "tok_prompt","tok_cached","tok_completion","cost_usd","ocr_ok","ocr_fail","bytes_images_in")
     def __init__(self, uid: int):
         now = time.time()
         self.uid = uid; self.name=""; self.username=""
         self.first_seen = now; self.last_seen = now
         self.kinds = Counter(); self.subjects = Counter(); self.langs = Counter()
         self.gpt_calls = 0; self.gpt_time_sum = 0.0
-        self.tok_prompt = 0; self.tok_completion = 0
+        self.tok_prompt = 0; self.tok_cached = 0; self.tok_completion = 0; self.cost_usd = 0.0
         self.ocr_ok = 0; self.ocr_fail = 0; self.bytes_images_in = 0
 
 USERS: dict[int, UserStats] = {}
 
+# Потоковые ответы: время до первого токена
+LLM_TTFT = {"n": 0, "sum": 0.0, "max": 0.0}
+
+def _note_ttft(sec: float):
+    with STATS_LOCK:
+        LLM_TTFT["n"] += 1; LLM_TTFT["sum"] += sec; LLM_TTFT["max"] = max(LLM_TTFT["max"], sec)
+
+# Изменившиеся с прошлого автосохранения — только их пишем в журнал
+_STATS_DIRTY: set[int] = set()
+METRICS_LOG = MetricsLog(METRICS_LOG_PATH)
+_STATS_SAVE_LOCK = threading.Lock()
+
 def _get_user_stats(uid: int, update: Update | None = None) -> UserStats:
     with STATS_LOCK:
         st = USERS.get(uid) or UserStats(uid)
@@ -527,104 +788,205 @@ def _get_user_stats(uid: int, update: Update | None = None) -> UserStats:
         if update and update.effective_user:
             st.name = update.effective_user.full_name or st.name
             st.username = update.effective_user.username or st.username
+        _STATS_DIRTY.add(uid)
         return st
 
+# Глобальные итоги — ведутся вместе с пользовательскими счётчиками, чтение O(1)
+_TOTAL_FIELDS = ("gpt_calls", "gpt_time_sum", "tok_prompt", "tok_cached", "tok_completion", "cost_usd",
+                 "ocr_ok", "ocr_fail", "bytes_images_in")
+TOTALS = dict.fromkeys(_TOTAL_FIELDS, 0)
+TOTAL_KINDS = Counter(); TOTAL_SUBJECTS = Counter(); TOTAL_LANGS = Counter()
+# Токены/стоимость LLM с запуска процесса: по модели и по режиму оплаты (за период — /stats/cost.json из events)
+_COST_FIELDS = ("calls", "prompt", "cached", "completion", "cost_usd")
+COST_MODELS: dict[str, dict] = {}; COST_MODES: dict[str, dict] = {}
+
+def stats_bump(uid: int, kind: str | None = None, **fields):
+    """Счётчики меняем только здесь: пользователь + глобальные итоги, под STATS_LOCK, с пометкой «изменён» для журнала."""
+    with STATS_LOCK:
+        st = _get_user_stats(uid)
+        if kind:
+            st.kinds[kind] += 1; TOTAL_KINDS[kind] += 1
+        for k, v in fields.items():
+            setattr(st, k, getattr(st, k) + v)
+            TOTALS[k] += v
+
+def _rebuild_totals():
+    """Пересчёт итогов по всем пользователям — только после загрузки журнала."""
+    with STATS_LOCK:
+        for k in _TOTAL_FIELDS: TOTALS[k] = 0
+        TOTAL_KINDS.clear(); TOTAL_SUBJECTS.clear(); TOTAL_LANGS.clear()
+        for st in USERS.values():
+            for k in _TOTAL_FIELDS: TOTALS[k] += getattr(st, k)
+            TOTAL_KINDS.update(st.kinds); TOTAL_SUBJECTS.update(st.subjects); TOTAL_LANGS.update(st.langs)
+
+def _user_record(st: UserStats) -> dict:
+    return {
+        "name": st.name, "username": st.username,
+        "first_seen": st.first_seen, "last_seen": st.last_seen,
+        "kinds": dict(st.kinds), "subjects": dict(st.subjects), "langs": dict(st.langs),
+        "gpt_calls": st.gpt_calls, "gpt_time_sum": st.gpt_time_sum,
+        "tok_prompt": st.tok_prompt, "tok_cached": st.tok_cached, "tok_completion": st.tok_completion,
+        "cost_usd": round(st.cost_usd, 6),
+        "ocr_ok": st.ocr_ok, "ocr_fail": st.ocr_fail, "bytes_images_in": st.bytes_images_in,
+    }
+
+def _apply_record(st: UserStats, u: dict):
+    st.name = u.get("name") or st.name; st.username = u.get("username") or st.username
+    st.first_seen = u.get("first_seen", st.first_seen); st.last_seen = u.get("last_seen", st.last_seen)
+    st.kinds = Counter(u.get("kinds", {})); st.subjects = Counter(u.get("subjects", {})); st.langs = Counter(u.get("langs", {}))
+    st.gpt_calls = u.get("gpt_calls", 0); st.gpt_time_sum = u.get("gpt_time_sum", 0.0)
+    st.tok_prompt = u.get("tok_prompt", 0); st.tok_cached = u.get("tok_cached", 0)
+    st.tok_completion = u.get("tok_completion", 0); st.cost_usd = u.get("cost_usd", 0.0)
+    st.ocr_ok = u.get("ocr_ok", 0); st.ocr_fail = u.get("ocr_fail", 0)
+    st.bytes_images_in = u.get("bytes_images_in", 0)
+
 def stats_snapshot() -> dict:
+    """Итоги без обхода пользователей; по-пользовательские данные — stats_users_page() (/stats/users.json)."""
     with STATS_LOCK:
-        snap_users = {}
-        totals = {
-            "users_count": 0,"tasks_total": 0,"solve_text": 0,"solve_photo": 0,"essay": 0,"text_msg": 0,"photo_msg": 0,
-            "ocr_ok": 0,"ocr_fail": 0,"gpt_calls": 0,"gpt_time_sum": 0.0,"tok_prompt": 0,"tok_completion": 0,
-            "bytes_images_in": 0,"subjects": {},"langs": {},
-        }
-        subjects_acc = Counter(); langs_acc = Counter()
-        for uid, st in USERS.items():
-            u = {
-                "name": st.name, "username": st.username,
-                "first_seen": st.first_seen, "last_seen": st.last_seen,
-                "kinds": dict(st.kinds), "subjects": dict(st.subjects), "langs": dict(st.langs),
-                "gpt_calls": st.gpt_calls, "gpt_time_sum": st.gpt_time_sum,
-                "tok_prompt": st.tok_prompt, "tok_completion": st.tok_completion,
-                "ocr_ok": st.ocr_ok, "ocr_fail": st.ocr_fail, "bytes_images_in": st.bytes_images_in,
-            }
-            snap_users[str(uid)] = u
-            totals["users_count"] += 1
-            totals["solve_text"] += u["kinds"].get("solve_text", 0)
-            totals["solve_photo"] += u["kinds"].get("solve_photo", 0)
-            totals["essay"] += u["kinds"].get("essay", 0)
-            totals["ocr_ok"] += u["ocr_ok"]; totals["ocr_fail"] += u["ocr_fail"]
-            totals["gpt_calls"] += u["gpt_calls"]; totals["gpt_time_sum"] += u["gpt_time_sum"]
-            totals["tok_prompt"] += u["tok_prompt"]; totals["tok_completion"] += u["tok_completion"]
-            totals["bytes_images_in"] += u["bytes_images_in"]
-            subjects_acc.update(u["subjects"]); langs_acc.update(u["langs"])
+        totals = {"users_count": len(USERS), **TOTALS,
+                  "solve_text": TOTAL_KINDS["solve_text"], "solve_photo": TOTAL_KINDS["solve_photo"], "essay": TOTAL_KINDS["essay"],
+                  "text_msg": TOTAL_KINDS["text_msg"], "photo_msg": TOTAL_KINDS["photo_msg"],
+                  "subjects": dict(TOTAL_SUBJECTS), "langs": dict(TOTAL_LANGS)}
         totals["tasks_total"] = totals["solve_text"] + totals["solve_photo"] + totals["essay"]
-        totals["subjects"] = dict(subjects_acc); totals["langs"] = dict(langs_acc)
-        return {"generated_at": int(time.time()), "users": snap_users, "totals": totals}
+        ttft = dict(LLM_TTFT)
+        llm_cost = {"models": {k: {**v, "cost_usd": round(v["cost_usd"], 4)} for k, v in COST_MODELS.items()},
+                    "modes": {k: {**v, "cost_usd": round(v["cost_usd"], 4)} for k, v in COST_MODES.items()}}
+    return {"generated_at": int(time.time()), "totals": totals, "llm_cost": llm_cost, "ocr_pool": ocr_pool.stats(), "llm_sched": llm_sched.stats(), "router": model_router.stats(), "inflight": inflight.stats(), "ocr_cache": ocr_cache.stats(),
+            "llm_ttft": ttft, "answer_cache": answer_cache.stats(),
+            "embed_cache": embed_cache_stats(), "sessions": sessions.stats()}
+
+def _users_page_ids(page: int, per_page: int) -> tuple[list[int], int, int, int]:
+    with STATS_LOCK:
+        ids = sorted(USERS.keys())
+    total = len(ids)
+    pages = max(1, (total + per_page - 1) // per_page)
+    page = max(1, min(page, pages))
+    start = (page - 1) * per_page
+    return ids[start:start + per_page], page, pages, total
 
-def stats_save():
-    os.makedirs(os.path.dirname(METRICS_PATH), exist_ok=True)
-    data = json.dumps(stats_snapshot(), ensure_ascii=False, indent=2).encode("utf-8")
-    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(METRICS_PATH), prefix=".metrics.", suffix=".tmp")
-    try:
-        with os.fdopen(fd, "wb") as f: f.write(data)
-        os.replace(tmp, METRICS_PATH)
-    finally:
-        if os.path.exists(tmp):
-            try: os.remove(tmp)
-            except Exception: pass
+def stats_users_page(page: int = 1, per_page: int = 100) -> dict:
+    per_page = max(1, min(1000, per_page))
+    ids, page, pages, total = _users_page_ids(page, per_page)
+    with STATS_LOCK:
+        users = {str(uid): _user_record(USERS[uid]) for uid in ids if uid in USERS}
+    return {"generated_at": int(time.time()), "page": page, "pages": pages, "per_page": per_page, "total": total, "users": users}
+
+def _all_records() -> list[dict]:
+    with STATS_LOCK:
+        return [{"uid": uid, **_user_record(st)} for uid, st in USERS.items()]
+
+def stats_save() -> int:
+    """Дописать в журнал изменившихся пользователей; при разрастании — сжать. Стоимость ~ активности."""
+    with _STATS_SAVE_LOCK:
+        with STATS_LOCK:
+            recs = [{"uid": uid, **_user_record(USERS[uid])} for uid in _STATS_DIRTY if uid in USERS]
+            _STATS_DIRTY.clear()
+            users = len(USERS)
+        n = METRICS_LOG.append(recs)
+        if METRICS_LOG.needs_compaction(users):
+            t0 = perf_counter()
+            METRICS_LOG.compact(_all_records())
+            log.info(f"Metrics log compacted: {METRICS_LOG.lines} users in {(perf_counter() - t0) * 1000:.0f}ms")
+        return n
 
 def stats_load():
-    if not os.path.exists(METRICS_PATH): return
     try:
-        snap = json.load(open(METRICS_PATH, "r", encoding="utf-8"))
-        users = snap.get("users", {})
+        t0 = perf_counter()
+        recs = METRICS_LOG.replay()
+        legacy = False
+        if not recs and os.path.exists(METRICS_PATH):
+            # первый старт после перехода с metrics.json
+            snap = json.load(open(METRICS_PATH, "r", encoding="utf-8"))
+            recs = {int(k): v for k, v in (snap.get("users") or {}).items()}
+            legacy = True
         with STATS_LOCK:
-            for uid_s, u in users.items():
-                uid = int(uid_s)
+            for uid, u in recs.items():
                 st = USERS.get(uid) or UserStats(uid)
-                st.name = u.get("name") or st.name; st.username = u.get("username") or st.username
-                st.first_seen = u.get("first_seen", st.first_seen); st.last_seen = u.get("last_seen", st.last_seen)
-                st.kinds = Counter(u.get("kinds", {})); st.subjects = Counter(u.get("subjects", {})); st.langs = Counter(u.get("langs", {}))
-                st.gpt_calls = u.get("gpt_calls", 0); st.gpt_time_sum = u.get("gpt_time_sum", 0.0)
-                st.tok_prompt = u.get("tok_prompt", 0); st.tok_completion = u.get("tok_completion", 0)
-                st.ocr_ok = u.get("ocr_ok", 0); st.ocr_fail = u.get("ocr_fail", 0)
-                st.bytes_images_in = u.get("bytes_images_in", 0)
+                _apply_record(st, u)
                 USERS[uid] = st
-        log.info(f"Loaded metrics (users={len(USERS)})")
+        _rebuild_totals()
+        if legacy or METRICS_LOG.needs_compaction(len(USERS)):
+            METRICS_LOG.compact(_all_records())
+        log.info(f"Loaded metrics (users={len(USERS)}, log lines={METRICS_LOG.lines}) in {(perf_counter() - t0) * 1000:.0f}ms")
     except Exception as e:
         log.warning(f"stats_load failed: {e}")
 
 def _stats_autosave_loop():
     interval = max(10, METRICS_AUTOSAVE_SEC)
-    log.info(f"Metrics autosave every {interval}s -> {METRICS_PATH}")
+    log.info(f"Metrics autosave every {interval}s -> {METRICS_LOG_PATH}")
     while True:
+        time.sleep(interval)
         try: stats_save()
         except Exception as e: log.warning(f"stats_save failed: {e}")
-        time.sleep(interval)
 
 # ---------- Админы ----------
-def _db_admins():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("""CREATE TABLE IF NOT EXISTS admin_users(user_id INTEGER PRIMARY KEY, added_ts INTEGER)""")
-    return conn
+# Реестр в памяти: ADMIN_IDS ∪ admin_users. is_admin — O(1) без I/O. add/del меняют набор и штамп admins_version
+# в app_meta; фоновый поток раз в ADMINS_REFRESH_SEC сверяет штамп (один SELECT) — так подхватываются правки других процессов.
+ADMINS_REFRESH_SEC = max(5, int(os.getenv("ADMINS_REFRESH_SEC", "30")))
+ADMINS_RETRY_SEC = max(1, int(os.getenv("ADMINS_RETRY_SEC", "10")))
+_ADMINS_LOCK = threading.Lock()
+_ADMINS: frozenset = frozenset()
+_ADMINS_VER = -1   # -1 — из базы ещё не загружали (или загрузка упала — тогда в наборе только ADMIN_IDS)
+_ADMINS_RETRY_AT = 0.0   # monotonic: раньше этого момента упавшую загрузку не повторяем
+
 def _env_admin_ids() -> set[int]:
     return {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}
-def _load_admins_from_db() -> set[int]:
-    with _db_admins() as db:
+def _admins_version(db) -> int:
+    row = db.execute("SELECT value FROM app_meta WHERE key='admins_version'").fetchone()
+    return int(row[0]) if row else 0
+def refresh_admins(force: bool = False) -> bool:
+    """Перечитать список, если штамп версии сменился. True — набор обновлён."""
+    global _ADMINS, _ADMINS_VER
+    with _ADMINS_LOCK:
+        db = app_db()
+        ver = _admins_version(db)
+        if not force and ver == _ADMINS_VER:
+            return False
         rows = db.execute("SELECT user_id FROM admin_users").fetchall()
-    return {int(r[0]) for r in rows}
+        _ADMINS = frozenset(_env_admin_ids() | {int(r[0]) for r in rows})
+        _ADMINS_VER = ver
+        return True
+def _admins_refresh_loop():
+    while True:
+        time.sleep(ADMINS_REFRESH_SEC)
+        try:
+            if refresh_admins():
+                log.info(f"Admins reloaded: v{_ADMINS_VER}, {len(_ADMINS)} ids")
+        except Exception as e:
+            log.warning(f"admins refresh failed: {e}")
+def _ensure_admins():
+    """Первая загрузка по требованию. Упала — работаем на ADMIN_IDS и не ходим в базу на каждый is_admin
+    до ADMINS_RETRY_SEC; дальше набор подхватит либо повтор здесь, либо _admins_refresh_loop (штамп ≠ -1)."""
+    global _ADMINS, _ADMINS_RETRY_AT
+    if _ADMINS_VER >= 0 or time.monotonic() < _ADMINS_RETRY_AT:
+        return
+    try: refresh_admins(force=True)
+    except Exception as e:
+        log.warning(f"admins load failed, using ADMIN_IDS only (retry in {ADMINS_RETRY_SEC}s): {e}")
+        with _ADMINS_LOCK:
+            if _ADMINS_VER < 0:
+                _ADMINS = frozenset(_env_admin_ids())
+            _ADMINS_RETRY_AT = time.monotonic() + ADMINS_RETRY_SEC
 def all_admin_ids() -> set[int]:
-    return _env_admin_ids() | _load_admins_from_db()
+    _ensure_admins()
+    return set(_ADMINS)
 def is_admin(uid: int) -> bool:
-    return uid in all_admin_ids()
+    _ensure_admins()
+    return uid in _ADMINS
+def _bump_admins_version(db):
+    db.execute("UPDATE app_meta SET value = value + 1 WHERE key='admins_version'")
 def add_admin(uid: int) -> bool:
     if not isinstance(uid, int) or uid <= 0: return False
-    with _db_admins() as db:
+    with db_tx() as db:
         db.execute("INSERT OR IGNORE INTO admin_users(user_id, added_ts) VALUES(?,?)", (uid, int(time.time())))
+        _bump_admins_version(db)
+    refresh_admins(force=True)
     return True
 def del_admin(uid: int) -> bool:
-    with _db_admins() as db: db.execute("DELETE FROM admin_users WHERE user_id=?", (uid,))
+    with db_tx() as db:
+        db.execute("DELETE FROM admin_users WHERE user_id=?", (uid,))
+        _bump_admins_version(db)
+    refresh_admins(force=True)
     return True
 
 # ---------- Монетизация: consume (админ — всегда Pro) ----------
@@ -641,17 +1003,17 @@ def build_buy_keyboard(stars_enabled: bool, bepaid_url: str | None):
 def consume_request(uid: int, need_pro: bool):
     if is_admin(uid):
         return True, "pro", ""
-    plan = plan_get(uid)
-    if need_pro:
-        if plan["pro_active"]:
-            return True, "pro", ""
-        if dec_credit(uid):
-            return True, "pro", ""
-        return False, "free", "нужен Pro (подписка/кредиты)"
-    if plan["free_left_today"] > 0:
-        inc_free(uid)
-        return True, "free", ""
-    return False, "free", "исчерпан дневной лимит Free"
+    memo = _UPDATE_MEMO.get()
+    if memo is None:
+        return _charge(uid, need_pro)[:3]
+    # мемо общий и для asyncio.to_thread (контекст копируется): замок — чтобы два потока не списали дважды
+    with memo.setdefault(("charge_lock", uid), threading.Lock()):
+        if ("charge", uid) in memo:
+            return memo[("charge", uid)][:3]   # в рамках одного апдейта списываем один раз
+        ok, mode, reason, kind, plan = _charge(uid, need_pro)
+        memo[("charge", uid)] = (ok, mode, reason, kind)
+        memo[("plan", uid)] = plan
+    return ok, mode, reason
 # ---------- Команды / меню ----------
 async def set_commands(app: Application):
     await app.bot.set_my_commands(
@@ -793,26 +1155,41 @@ async def explain_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         USER_STATE[uid] = "AWAIT_EXPLAIN"
         return await update.message.reply_text("🧠 Что объяснить/решить? Напиши одной фразой.", reply_markup=kb(uid))
 
+    # Граф: эмбеддинг стартует сразу; квоты (SQLite, в потоке) и определение предмета — параллельно с ним;
+    # поиск ВБД ждёт только эмбеддинг и предмет и идёт, пока отправляется спиннер.
+    emb = asyncio.create_task(aspan("embed", embed_query(client, clamp_words(text, 40))))
     need_pro = PRO_NEXT[uid] or False
-    ok, mode, reason = consume_request(uid, need_pro=need_pro)
+    subj_task = classify_subject(text) if USER_SUBJECT[uid] == "auto" else asyncio.sleep(0, "auto")
+    try:
+        (ok, mode, reason), subj = await asyncio.gather(
+            aspan("consume_request", asyncio.to_thread(consume_request, uid, need_pro)), subj_task)
+    except BaseException:
+        emb.cancel()
+        raise
     if not ok:
+        emb.cancel()
         kb_i = build_buy_keyboard(TELEGRAM_STARS_ENABLED and (TELEGRAM_PROVIDER_TOKEN == ""), BEPAID_CHECKOUT_URL or None)
         return await update.message.reply_text(f"Нужен Pro: {reason}. Оформи оплату:", reply_markup=kb_i)
     PRO_NEXT[uid] = False
 
-    if USER_SUBJECT[uid] == "auto":
-        subj = await classify_subject(text)
-        if subj in SUBJECTS:
-            USER_SUBJECT[uid] = subj
+    if subj in SUBJECTS:
+        USER_SUBJECT[uid] = subj
+    rag = asyncio.create_task(retrieve_context(uid, text, emb))
 
-    _get_user_stats(uid).kinds["solve_text"] += 1
+    stats_bump(uid, "solve_text")
 
-    spinner_finish, spinner_set = await start_spinner(update, context, "Решаю задачу…")
+    spinner_finish, spinner_set, spinner_take = await start_spinner(update, context, "Решаю задачу…", reply_markup=kb(uid))
     try:
         await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
-        out = await call_model(uid, text, mode=mode)
-        await reply_with_formulas(update.message, out, reply_markup=kb(uid))
-        set_followup_context(uid, text, out)
+        live = LiveAnswer(spinner_take) if LLM_STREAM else None
+        try:
+            out = await call_model(uid, text, mode=mode, on_delta=live.push if live else None, rag=rag,
+                                   on_queue=queue_label(spinner_set, "Решаю задачу…"))
+        except LlmBusy:
+            return await update.message.reply_text(LLM_BUSY_TEXT, reply_markup=kb(uid))
+        await reply_with_formulas(update.message, out, reply_markup=kb(uid), live=live)
+        with span("followup_save"):
+            set_followup_context(uid, text, out)
         keyboard = ReplyKeyboardMarkup([["Да", "Нет"]], resize_keyboard=True, one_time_keyboard=True)
         await update.message.reply_text(
             "Нужно что-то уточнить по решению?\n"
@@ -824,6 +1201,7 @@ async def explain_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log.exception("explain")
         await update.message.reply_text(f"❌ Ошибка: {e}", reply_markup=kb(uid))
     finally:
+        rag.cancel()
         await spinner_finish()
 
 async def essay_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -833,21 +1211,28 @@ async def essay_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         USER_STATE[uid] = "AWAIT_ESSAY"
         return await update.message.reply_text("📝 Тема сочинения?", reply_markup=kb(uid))
 
-    need_pro = PRO_NEXT[uid] or plan_get(uid)["pro_active"]
-    ok, mode, reason = consume_request(uid, need_pro=need_pro)
+    with span("consume_request"):
+        need_pro = PRO_NEXT[uid] or plan_get(uid)["pro_active"]
+        ok, mode, reason = consume_request(uid, need_pro=need_pro)
     if not ok:
         kb_i = build_buy_keyboard(TELEGRAM_STARS_ENABLED and (TELEGRAM_PROVIDER_TOKEN == ""), BEPAID_CHECKOUT_URL or None)
         return await update.message.reply_text(f"Нужен Pro: {reason}. Оформи оплату:", reply_markup=kb_i)
     PRO_NEXT[uid] = False
 
-    _get_user_stats(uid).kinds["essay"] += 1
+    stats_bump(uid, "essay")
 
-    spinner_finish, spinner_set = await start_spinner(update, context, "Готовлю сочинение…")
+    spinner_finish, spinner_set, spinner_take = await start_spinner(update, context, "Готовлю сочинение…", reply_markup=kb(uid))
     try:
         await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
-        out = await call_model(uid, f"Напиши сочинение по теме: {topic}", mode=mode)
-        await reply_with_formulas(update.message, out, reply_markup=kb(uid))
-        set_followup_context(uid, topic, out)
+        live = LiveAnswer(spinner_take) if LLM_STREAM else None
+        try:
+            out = await call_model(uid, f"Напиши сочинение по теме: {topic}", mode=mode, on_delta=live.push if live else None,
+                                   on_queue=queue_label(spinner_set, "Готовлю сочинение…"))
+        except LlmBusy:
+            return await update.message.reply_text(LLM_BUSY_TEXT, reply_markup=kb(uid))
+        await reply_with_formulas(update.message, out, reply_markup=kb(uid), live=live)
+        with span("followup_save"):
+            set_followup_context(uid, topic, out)
         USER_STATE[uid] = "AWAIT_FOLLOWUP_YN"
         keyboard = ReplyKeyboardMarkup([["Да", "Нет"]], resize_keyboard=True, one_time_keyboard=True)
         await update.message.reply_text(
@@ -865,7 +1250,8 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
 
     # Фото-решение только в Pro (включая триал/подписку/админа/кредиты)
-    ok, mode, reason = consume_request(uid, need_pro=True)
+    with span("consume_request"):
+        ok, mode, reason = consume_request(uid, need_pro=True)
     if not ok:
         kb_i = build_buy_keyboard(
             stars_enabled=TELEGRAM_STARS_ENABLED and (TELEGRAM_PROVIDER_TOKEN == ""),
@@ -876,54 +1262,81 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=kb_i
         )
 
-    spinner_finish, spinner_set = await start_spinner(update, context, "Обрабатываю фото…")
+    spinner_finish, spinner_set, spinner_take = await start_spinner(update, context, "Обрабатываю фото…", reply_markup=kb(uid))
     try:
         await context.bot.send_chat_action(update.effective_chat.id, ChatAction.UPLOAD_PHOTO)
 
-        tg_file = None
+        src = None
         if update.message.photo:
-            tg_file = await update.message.photo[-1].get_file()
+            src = update.message.photo[-1]
         elif update.message.document and str(update.message.document.mime_type or "").startswith("image/"):
-            tg_file = await update.message.document.get_file()
+            src = update.message.document
         else:
             raise ValueError("Не найдено изображение")
 
-        data = await tg_file.download_as_bytearray()
-        if len(data) > MAX_IMAGE_BYTES:
-            return await update.message.reply_text(
-                "Файл слишком большой (> 8 МБ). Пожалуйста, сожми изображение или сделай фото покрупнее и чётче.",
-                reply_markup=kb(uid)
-            )
-
-        st = _get_user_stats(uid); st.bytes_images_in += len(data)
-        img = Image.open(io.BytesIO(data))
+        # Кэш OCR: тот же файл (file_unique_id) — даже не скачиваем; SQLite кэша — только в потоке
+        ocr_text = await asyncio.to_thread(ocr_cache.get_by_file_id, src.file_unique_id)
+        if ocr_text is None:
+            with span("download") as sp:
+                tg_file = await src.get_file()
+                data = await tg_file.download_as_bytearray()
+                sp["bytes"] = len(data)
+            if len(data) > MAX_IMAGE_BYTES:
+                refund_request(uid)
+                return await update.message.reply_text(
+                    "Файл слишком большой (> 8 МБ). Пожалуйста, сожми изображение или сделай фото покрупнее и чётче.",
+                    reply_markup=kb(uid)
+                )
+            stats_bump(uid, bytes_images_in=len(data))
 
-        spinner_set("Распознаю текст…")
-        await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
-        ocr_text = ocr_image(img)
+            # …или почти тот же кадр (перцептивный хэш + размеры): хэш и перебор кэша — в потоке, не на loop
+            fp, ocr_text = await aspan("phash", asyncio.to_thread(ocr_cache.lookup_image, bytes(data)))
+            if ocr_text is None:
+                spinner_set("Распознаю текст…")
+                await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
+                try:
+                    with span("ocr"):
+                        ocr_text = await ocr_pool.run_ocr(bytes(data), lang_hint=USER_LANG[uid], subject_hint=USER_SUBJECT[uid])
+                except OcrBusy:
+                    refund_request(uid)
+                    return await update.message.reply_text(
+                        "Сейчас много фото в очереди на распознавание. Попробуй через минуту — или пришли задание текстом.",
+                        reply_markup=kb(uid)
+                    )
+                except OcrTimeout as e:
+                    log.warning(f"OCR timeout uid={uid}: {e}")
+                    ocr_text = ""
+            await asyncio.to_thread(ocr_cache.put, src.file_unique_id, fp, ocr_text)
 
         if not (ocr_text and ocr_text.strip()):
-            st.ocr_fail += 1
+            stats_bump(uid, ocr_fail=1)
+            refund_request(uid)
             return await update.message.reply_text(
                 "Не удалось распознать текст на фото. Попробуй переснять ближе, без бликов и с хорошим освещением — или пришли текстом.",
                 reply_markup=kb(uid)
             )
 
-        st.ocr_ok += 1
+        stats_bump(uid, ocr_ok=1)
 
         if USER_SUBJECT[uid] == "auto":
             subj = await classify_subject(ocr_text)
             if subj in SUBJECTS:
                 USER_SUBJECT[uid] = subj
 
-        st.kinds["solve_photo"] += 1
+        stats_bump(uid, "solve_photo")
 
         spinner_set("Решаю…")
         await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
-        out = await call_model(uid, ocr_text[:4000], mode=mode)
+        live = LiveAnswer(spinner_take) if LLM_STREAM else None
+        try:
+            out = await call_model(uid, ocr_text[:4000], mode=mode, on_delta=live.push if live else None,
+                                   on_queue=queue_label(spinner_set, "Решаю…"))
+        except LlmBusy:
+            return await update.message.reply_text(LLM_BUSY_TEXT, reply_markup=kb(uid))
 
-        await reply_with_formulas(update.message, out, reply_markup=kb(uid))
-        set_followup_context(uid, ocr_text[:800], out)
+        await reply_with_formulas(update.message, out, reply_markup=kb(uid), live=live)
+        with span("followup_save"):
+            set_followup_context(uid, ocr_text[:800], out)
 
         USER_STATE[uid] = "AWAIT_FOLLOWUP_YN"
         keyboard = ReplyKeyboardMarkup([["Да", "Нет"]], resize_keyboard=True, one_time_keyboard=True)
@@ -935,6 +1348,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     except Exception as e:
         log.exception("handle_photo")
+        refund_request(uid)
         USER_STATE[uid] = "AWAIT_TEXT_OR_PHOTO_CHOICE"
         keyboard = ReplyKeyboardMarkup(
             [["📸 Решить по фото", "✍️ Напишу текстом"]],
@@ -999,28 +1413,39 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Бесплатное уточнение
     if state == "AWAIT_FOLLOWUP_FREE":
         USER_STATE[uid] = "AWAIT_FOLLOWUP_NEXT"
-        ctx = get_followup_context(uid)
+        with span("followup_ctx"):
+            ctx = get_followup_context(uid)
         if not ctx or not in_free_window(ctx) or ctx.get("used_free", False):
             USER_STATE[uid] = "AWAIT_FOLLOWUP_PAID"
         else:
-            out = await call_model_followup(uid, ctx["task"], ctx["answer"], raw, mode_tag="free")
+            try:
+                out = await call_model_followup(uid, ctx["task"], ctx["answer"], raw, mode_tag="free")
+            except LlmBusy:
+                USER_STATE[uid] = "AWAIT_FOLLOWUP_FREE"   # бесплатное уточнение не потрачено — можно повторить
+                return await update.message.reply_text(LLM_BUSY_TEXT, reply_markup=kb(uid))
             await reply_with_formulas(update.message, out, reply_markup=kb(uid))
-            mark_followup_used(uid)
+            with span("followup_save"):
+                mark_followup_used(uid)
             keyboard = ReplyKeyboardMarkup([["Да", "Нет"]], resize_keyboard=True, one_time_keyboard=True)
             await update.message.reply_text("Нужно ещё уточнение?\n⚠️ Дальше уточнения будут списывать лимит/кредит.", reply_markup=keyboard)
             return
 
     # Платное уточнение
     if state in {"AWAIT_FOLLOWUP_PAID", "AWAIT_FOLLOWUP_NEXT"}:
-        ctx = get_followup_context(uid)
-        ok, mode, reason = consume_request(uid, need_pro=False)
+        with span("followup_ctx"):
+            ctx = get_followup_context(uid)
+        with span("consume_request"):
+            ok, mode, reason = consume_request(uid, need_pro=False)
         if not ok:
             kb_i = build_buy_keyboard(TELEGRAM_STARS_ENABLED and (TELEGRAM_PROVIDER_TOKEN == ""), BEPAID_CHECKOUT_URL or None)
             USER_STATE[uid] = None
             return await update.message.reply_text(f"Нужно списание. Оформи Pro/кредиты:", reply_markup=kb_i)
         prev_task = (ctx or {}).get("task", "")
         prev_ans = (ctx or {}).get("answer", "")
-        out = await call_model_followup(uid, prev_task or raw, prev_ans, raw, mode_tag=mode)
+        try:
+            out = await call_model_followup(uid, prev_task or raw, prev_ans, raw, mode_tag=mode)
+        except LlmBusy:
+            return await update.message.reply_text(LLM_BUSY_TEXT, reply_markup=kb(uid))
         await reply_with_formulas(update.message, out, reply_markup=kb(uid))
         USER_STATE[uid] = "AWAIT_FOLLOWUP_NEXT"
         keyboard = ReplyKeyboardMarkup([["Да", "Нет"]], resize_keyboard=True, one_time_keyboard=True)
@@ -1096,13 +1521,65 @@ def _format_metrics_for_admin() -> str:
         f"Пользователей: {t['users_count']}",
         f"Задач всего: {t['tasks_total']} (text={t['solve_text']}, photo={t['solve_photo']}, essay={t['essay']})",
         f"GPT вызовов: {t['gpt_calls']} за {t['gpt_time_sum']:.1f}s",
+        f"Токены: вход {t['tok_prompt']} (из кэша {t['tok_cached']}), выход {t['tok_completion']}; ≈${t['cost_usd']:.2f}",
         f"OCR ok/fail: {t['ocr_ok']}/{t['ocr_fail']}",
     ]
+    lc = s.get("llm_cost") or {}
+    if lc.get("models"):
+        per_model = ", ".join(f"{m} ${v['cost_usd']:.3f}/{v['calls']}" for m, v in lc["models"].items())
+        per_mode = ", ".join(f"{m} ${v['cost_usd']:.3f}" for m, v in lc["modes"].items())
+        lines.append(f"LLM с запуска: модели: {per_model}; режимы: {per_mode}")
+    op = s.get("ocr_pool") or {}
+    if op:
+        lines.append(
+            f"OCR пул: очередь {op['depth']} (макс {op['max_depth']}), воркеров {op['workers']}; "
+            f"таймаутов {op['timeouts']}, отказов {op['rejected']}; ожидание ~{op['wait_avg']:.2f}s, OCR ~{op['run_avg']:.2f}s, "
+            f"проходов ~{op['passes_avg']}"
+        )
+    ls = s.get("llm_sched") or {}
+    if ls:
+        waits = ", ".join(f"{n} ~{p['wait_avg']:.2f}s (макс {p['wait_max']:.1f}s)" for n, p in ls["prio"].items() if p["admitted"])
+        lines.append(
+            f"LLM очередь: ждут {ls['waiting']} (макс {ls['max_waiting']}), в работе {ls['running']}/{ls['total']}; "
+            f"отказов {ls['rejected']}, таймаутов {ls['timeouts']}" + (f"; ожидание: {waits}" if waits else "")
+        )
+    rt = s.get("router") or {}
+    if rt:
+        lines.append("Модели: " + "; ".join(
+            f"{m} {h['state']} p90={h['p90'] if h['p90'] is not None else '—'}s ошибок {h['err_rate']:.0%} "
+            f"({h['calls']} за окно, срывов {h['trips']})" for m, h in rt.items()))
+    inf = s.get("inflight") or {}
+    if inf:
+        lines.append(
+            f"Дубли: склеено {inf['coalesced']}; ждали свой предыдущий апдейт {inf['serialized']} "
+            f"(~{inf['lock_wait_avg']:.2f}s, макс {inf['lock_wait_max']:.1f}s)"
+        )
+    tt = s.get("llm_ttft") or {}
+    if tt.get("n"):
+        lines.append(f"LLM TTFT: ~{tt['sum'] / tt['n']:.2f}s (макс {tt['max']:.2f}s) по {tt['n']} потоковым ответам")
+    oc = s.get("ocr_cache") or {}
+    if oc:
+        lines.append(
+            f"OCR кэш: hit-rate {oc['hit_rate']:.0%} (file_id {oc['fid_hits']}, хэш {oc['hash_hits']}, "
+            f"похожие {oc['near_hits']}, с диска {oc['disk_hits']}), промахов {oc['misses']}"
+        )
+    ac = s.get("answer_cache") or {}
+    if ac.get("enabled"):
+        lines.append(
+            f"Кэш ответов: hit-rate {ac['hit_rate']:.0%} (точных {ac['exact_hits']}, похожих {ac['sem_hits']}), "
+            f"промахов {ac['misses']}, в памяти {ac['mem']}; сэкономлено LLM ~{ac['saved_sec']:.0f}s"
+        )
+    ec = s.get("embed_cache") or {}
+    if ec:
+        lines.append(
+            f"Кэш эмбеддингов: hit-rate {ec['hit_rate']:.0%} (с диска {ec['disk_hits']}), вызовов API {ec['api_calls']}"
+        )
     return "\n".join(lines)
 
 def admin_kb(page_users: int = 1) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📈 Метрики", callback_data="admin:metrics")],
+        [InlineKeyboardButton("🐢 Медленные запросы", callback_data="admin:traces")],
         [InlineKeyboardButton("👥 Пользователи", callback_data=f"admin:users:{page_users}")],
         [InlineKeyboardButton("💳 Платежи", callback_data="admin:billing")],
         [InlineKeyboardButton("🧠 ВБД", callback_data="admin:vdb")],
@@ -1116,19 +1593,14 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Админ-панель:", reply_markup=admin_kb())
 
 def _paginate_users(page: int, per_page: int = 10) -> tuple[str, InlineKeyboardMarkup]:
-    ids = sorted(USERS.keys())
-    total = len(ids)
-    pages = max(1, (total + per_page - 1) // per_page)
-    page = max(1, min(page, pages))
-    start = (page - 1) * per_page
-    chunk = ids[start:start + per_page]
+    chunk, page, pages, total = _users_page_ids(page, per_page)
     lines = [f"<b>Пользователи</b> (страница {page}/{pages}, всего {total})"]
     for uid in chunk:
         st = USERS[uid]
         seen = time.strftime("%Y-%m-%d %H:%M", time.localtime(st.last_seen))
         kinds = ", ".join(f"{k}:{v}" for k, v in st.kinds.items()) or "—"
         lines.append(f"• <code>{uid}</code> — {html.escape(st.name or '')} (@{st.username or '—'})")
-        lines.append(f"  seen={seen}; gpt={st.gpt_calls}; {kinds}")
+        lines.append(f"  seen={seen}; gpt={st.gpt_calls}; tok={st.tok_prompt}/{st.tok_completion} ≈${st.cost_usd:.3f}; {kinds}")
     nav = []
     if page > 1: nav.append(InlineKeyboardButton("« Назад", callback_data=f"admin:users:{page-1}"))
     if page < pages: nav.append(InlineKeyboardButton("Вперёд »", callback_data=f"admin:users:{page+1}"))
@@ -1136,6 +1608,20 @@ def _paginate_users(page: int, per_page: int = 10) -> tuple[str, InlineKeyboardM
         else InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data="admin:menu")]])
     return "\n".join(lines), kb_i
 
+def _format_traces_for_admin(n: int = 8) -> str:
+    ts = tracing.traces.stats()
+    slow = tracing.traces.slowest(n)
+    head = f"<b>Самые медленные запросы</b> (из последних {ts['ring']}, трасс всего {ts['finished']})"
+    if not slow:
+        return head + "\nПока пусто."
+    body = ""
+    for tr in slow:
+        chunk = html.escape(tracing.format_trace(tr)) + "\n\n"
+        if len(head) + len(body) + len(chunk) > 3800:   # лимит сообщения Telegram — 4096
+            break
+        body += chunk
+    return f"{head}\n<pre>{body.rstrip()}</pre>"
+
 async def on_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     uid = q.from_user.id
@@ -1151,6 +1637,15 @@ async def on_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("⬅️ Меню", callback_data="admin:menu"),
              InlineKeyboardButton("JSON", callback_data="admin:metrics_json")]
         ])); return
+    if data == "admin:traces":
+        try:
+            await q.edit_message_text(_format_traces_for_admin(), parse_mode="HTML", reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("⬅️ Меню", callback_data="admin:menu"),
+                 InlineKeyboardButton("🔄 Обновить", callback_data="admin:traces")]
+            ]))
+        except BadRequest as e:
+            if "not modified" not in str(e).lower(): raise
+        return
     if data == "admin:metrics_json":
         snap = json.dumps(stats_snapshot(), ensure_ascii=False)[:3500]
         await q.edit_message_text(f"<pre>{html.escape(snap)}</pre>", parse_mode="HTML",
@@ -1239,18 +1734,8 @@ async def vdbtest_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         grade_int = 8
     q_clamped = clamp_words(q, 40)
-    async def _srch(skey): return await search_rules(client, q_clamped, skey, grade_int, top_k=5)
     try:
-        rules = []
-        try:
-            rules = await asyncio.wait_for(_srch(subj_key), timeout=3.0)
-        except Exception as e:
-            log.warning(f"/vdbtest primary timeout/fail: {e}")
-        if not rules and subj_key != subj_raw:
-            try:
-                rules = await asyncio.wait_for(_srch(subj_raw), timeout=3.0)
-            except Exception as e:
-                log.warning(f"/vdbtest fallback timeout/fail: {e}")
+        rules = await search_rules_first(q_clamped, [subj_key, subj_raw], grade_int, top_k=5, where="/vdbtest")
         items = []
         for r in (rules or [])[:5]:
             brief = (r.get("rule_brief") or r.get("text") or r.get("rule") or "") if isinstance(r, dict) else str(r)
@@ -1264,7 +1749,9 @@ async def vdbtest_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ========= HEALTH / WEBHOOKS =========
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     try:
-        log.exception("Unhandled error in handler", exc_info=context.error)
+        log.exception(f"Unhandled error in handler (trace={tracing.current_id()})", exc_info=context.error)
+        tr = tracing.current()
+        if tr: tr.status = "error"
         if isinstance(update, Update) and update.effective_message:
             await update.effective_message.reply_text(
                 "⚠️ Упс, что-то пошло не так. Попробуй ещё раз."
@@ -1280,152 +1767,241 @@ async def on_buy_stars_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "После подтверждения статус обновится автоматически."
     )
 
-class _Health(BaseHTTPRequestHandler):
-    def _ok(self, body: bytes, ctype="text/plain; charset=utf-8"):
-        self.send_response(200)
-        self.send_header("Content-Type", ctype)
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
-
-    def _json(self, code: int, payload: dict):
-        b = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(b)))
-        self.end_headers()
-        self.wfile.write(b)
-
-    def _err(self, code: int, msg):
-        if isinstance(msg, dict):
-            return self._json(code, msg)
-        return self._ok((msg or "").encode("utf-8"), "text/plain; charset=utf-8")
-
-    def do_GET(self):
-        try:
-            if self.path == "/":
-                return self._ok(b"ok")
-            if self.path == "/stats.json":
-                payload = stats_snapshot()
-                return self._ok(
-                    json.dumps(payload, ensure_ascii=False).encode("utf-8"),
-                    "application/json; charset=utf-8",
-                )
-            return self._err(404, "not found")
-        except Exception as e:
-            log.exception("http-get")
-            return self._err(500, f"error: {e}")
+# HTTP: aiohttp на том же event loop, что и Application (стартует в post_init) — запросы параллельны, keep-alive
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", os.getenv("PORT", "8080")))
+HTTP_MAX_BODY = int(os.getenv("HTTP_MAX_BODY_KB", "256")) * 1024       # лимит тела запроса (413 сверх)
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "75"))
+VDB_HTTP_TIMEOUT = float(os.getenv("VDB_HTTP_TIMEOUT", "3.5"))
+INGEST_CHUNK = 64 * 1024
+
+def _http_json(payload: dict, status: int = 200) -> web.Response:
+    return web.Response(status=status, body=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                        content_type="application/json", charset="utf-8")
+
+async def _http_body(request: web.Request) -> dict:
+    if not request.can_read_body:
+        return {}
+    raw = await request.read()   # сверх client_max_size aiohttp сам отдаст 413
+    try:
+        data = json.loads(raw.decode("utf-8") or "{}")
+    except Exception as e:
+        raise web.HTTPBadRequest(text=json.dumps({"ok": False, "error": f"bad json: {e}"}), content_type="application/json")
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest(text=json.dumps({"ok": False, "error": "JSON object expected"}), content_type="application/json")
+    return data
+
+async def http_root(request: web.Request):
+    return web.Response(text="ok")
+
+async def http_stats(request: web.Request):
+    return _http_json(stats_snapshot())
+
+async def http_metrics(request: web.Request):
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": METRICS_CONTENT_TYPE})
 
-    def do_POST(self):
+async def http_stats_users(request: web.Request):
+    try:
+        page = int(request.query.get("page", "1")); per_page = int(request.query.get("per_page", "100"))
+    except ValueError:
+        return _http_json({"ok": False, "error": "bad page/per_page"}, 400)
+    return _http_json(stats_users_page(page, per_page))
+
+async def http_stats_cost(request: web.Request):
+    """Токены/стоимость за N суток из events (GROUP BY по таблице — в потоке, только с секретом)."""
+    if VDB_WEBHOOK_SECRET and request.headers.get("X-Auth", "") != VDB_WEBHOOK_SECRET:
+        return _http_json({"ok": False, "error": "bad auth"}, 401)
+    try:
+        days = max(1, min(90, int(request.query.get("days", "1"))))
+    except ValueError:
+        return _http_json({"ok": False, "error": "bad days"}, 400)
+    def _summary():
+        LLM_EVENTS.flush()   # сводка — с учётом ещё не записанных событий
+        with db_tx() as db:
+            return cost_summary(db, days=days)
+    return _http_json(await asyncio.to_thread(_summary))
+
+async def http_vdb_search(request: web.Request):
+    if VDB_WEBHOOK_SECRET and request.headers.get("X-Auth", "") != VDB_WEBHOOK_SECRET:
+        return _http_json({"ok": False, "error": "bad auth"}, 401)
+    data = await _http_body(request)
+    q = str(data.get("q") or "").strip()
+    if not q:
+        return _http_json({"ok": False, "error": "empty q"}, 400)
+    try:
+        top_k = int(data.get("top_k", 5))
+    except Exception:
+        top_k = 5
+    top_k = max(1, min(20, top_k))
+    subject_in = str(data.get("subject") or "").strip().lower()
+    grade_in = data.get("grade", None)
+    subj_key = subject_to_vdb_key(subject_in) if subject_in else "auto"
+    try:
+        grade_int = int(grade_in) if grade_in is not None else 8
+    except Exception:
+        grade_int = 8
+    subjects = [subj_key] + ([subject_in or "auto"] if subj_key != "auto" else [])
+    t0 = perf_counter()
+    try:
+        res = await asyncio.wait_for(
+            search_rules_multi(client, clamp_words(q, 40), subjects, grade_int, top_k=top_k), timeout=VDB_HTTP_TIMEOUT)
+    except asyncio.TimeoutError:
+        return _http_json({"ok": False, "error": f"timeout {VDB_HTTP_TIMEOUT}s"}, 504)
+    except Exception as e:
+        log.exception("vdb search fail")
+        return _http_json({"ok": False, "error": f"{e}"}, 500)
+    ms = (perf_counter() - t0) * 1000
+    log.info(f"http /vdb/search subj={subj_key} grade={grade_int} top_k={top_k} dt={ms:.0f}ms")
+    rules = next((r for r in res if r), [])
+    items = []
+    for r in rules[:top_k]:
+        brief = (
+            r.get("rule_brief") or r.get("text") or r.get("rule") or ""
+        ).strip() if isinstance(r, dict) else str(r).strip()
+        items.append(
+            {
+                "brief": clamp_words(brief, 120),
+                "meta": {
+                    "book": (r.get("book") or "").strip() if isinstance(r, dict) else "",
+                    "chapter": (r.get("chapter") or "").strip() if isinstance(r, dict) else "",
+                    "page": (r.get("page") if isinstance(r, dict) else None),
+                    "subject": subject_in or subj_key,
+                    "grade": grade_int,
+                },
+            }
+        )
+    return _http_json({"ok": True, "count": len(items), "items": items, "ms": round(ms, 1)})
+
+async def http_vdb_upsert(request: web.Request):
+    """Потоковая заливка правил: тело ({"rules"/"items": [...]}, можно gzip) не читается целиком — см. services/ingest.py."""
+    if not VDB_WEBHOOK_SECRET or request.headers.get("X-Auth", "") != VDB_WEBHOOK_SECRET:
+        return _http_json({"ok": False, "error": "bad auth"}, 401)
+    try:
+        rep = await ingest(request.content.iter_chunked(INGEST_CHUNK),
+                           lambda batch, tm: upsert_rules(client, batch, timings=tm))
+    except IngestError as e:
+        return _http_json({"ok": False, "error": str(e)}, 400)
+    log.info(f"http /vdb/upsert: accepted={rep['accepted']} upserted={rep['upserted']} failed={rep['failed']} "
+             f"invalid={rep['invalid']} dup={rep['duplicates']} batches={len(rep['batches'])} "
+             f"bytes={rep['bytes_in']} dt={rep['ms']:.0f}ms")
+    return _http_json(rep, 200 if rep["ok"] else 502)
+
+async def http_bepaid(request: web.Request):
+    if BEPAID_WEBHOOK_SECRET and request.headers.get("X-Auth", "") != BEPAID_WEBHOOK_SECRET:
+        return _http_json({"ok": False, "error": "bad auth"}, 401)
+    data = await _http_body(request)
+    log.info("bePaid webhook: %s", data)
+    # TODO: отметить оплату (credits/sub). Пока просто 200 OK:
+    return _http_json({"ok": True})
+
+@web.middleware
+async def _http_errors(request: web.Request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise   # 404/405/413 и т.п. — как есть
+    except Exception as e:
+        log.exception(f"http {request.method} {request.path}")
+        return _http_json({"ok": False, "error": f"{e}"}, 500)
+
+def _build_http_app() -> web.Application:
+    http = web.Application(client_max_size=HTTP_MAX_BODY, middlewares=[_http_errors])
+    http.router.add_get("/", http_root)
+    http.router.add_get("/stats.json", http_stats)
+    http.router.add_get("/stats/users.json", http_stats_users)
+    http.router.add_get("/stats/cost.json", http_stats_cost)
+    http.router.add_get("/metrics", http_metrics)
+    http.router.add_post("/vdb/search", http_vdb_search)
+    http.router.add_post("/vdb/upsert", http_vdb_upsert)
+    http.router.add_post("/webhook/bepaid", http_bepaid)
+    return http
+
+async def _start_http(app: Application):
+    runner = web.AppRunner(_build_http_app(), access_log=None, keepalive_timeout=HTTP_KEEPALIVE_SEC)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", HEALTH_PORT).start()
+    app.bot_data["http_runner"] = runner
+    log.info("HTTP server on 0.0.0.0:%s", HEALTH_PORT)
+
+async def _stop_http(app: Application):
+    runner = app.bot_data.pop("http_runner", None)
+    if runner is not None:
+        await runner.cleanup()
+
+# ---------- Метрики: апдейты и Bot API ----------
+_COMMANDS: set = set()   # заполняется в _register_handlers — метка handler не растёт от произвольных /команд
+
+def _update_handler_label(update: object) -> str:
+    if not isinstance(update, Update):
+        return "other"
+    if update.callback_query:
+        return "cb:" + (update.callback_query.data or "").split(":", 1)[0][:16]
+    msg = update.effective_message
+    if msg is None:
+        return "other"
+    if msg.text and msg.text.startswith("/"):
+        cmd = msg.text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() if len(msg.text) > 1 else ""
+        return f"cmd:{cmd}" if cmd in _COMMANDS else "cmd:other"
+    if msg.photo or msg.document:
+        return "photo"
+    return "text" if msg.text else "other"
+
+def _update_dedup_key(update: object) -> str | None:
+    """Ключ склейки дублей (services/inflight.content_key): задание текстом или фото; кнопки/команды/«Да» — None."""
+    msg = update.message if isinstance(update, Update) else None
+    if msg is None:
+        return None
+    return inflight_content_key(text=msg.text, photo_id=msg.photo[-1].file_unique_id if msg.photo else None,
+                                doc_id=msg.document.file_unique_id if msg.document else None, controls=MENU_LABELS)
+
+class MeteredUpdateProcessor(SimpleUpdateProcessor):
+    """Как concurrent_updates(True), плюс: апдейты в работе (gauge), время обработки, метка хэндлера для db_seconds,
+    трасса апдейта (services/tracing.py) и реестр in-flight (services/inflight.py): сообщения одного пользователя —
+    по очереди, повторная отправка того же задания — склеивается с решаемым."""
+    __slots__ = ()
+
+    async def do_process_update(self, update: object, coroutine):
+        label = _update_handler_label(update)
+        METRICS_HANDLER.set(label)
+        user = update.effective_user if isinstance(update, Update) else None
+        tr = tracing.begin(label, user.id if user else None)
+        UPDATES_INFLIGHT.inc()
+        t0 = perf_counter()
+        status = None
         try:
-            length = int(self.headers.get("Content-Length", "0"))
-            raw = self.rfile.read(length) if length > 0 else b"{}"
-            data = json.loads(raw.decode("utf-8") or "{}")
-            auth = self.headers.get("X-Auth", "")
-            path = self.path
-
-            if path == "/vdb/search":
-                if VDB_WEBHOOK_SECRET and auth != VDB_WEBHOOK_SECRET:
-                    return self._err(401, {"ok": False, "error": "bad auth"})
-                q = str(data.get("q") or "").strip()
-                if not q:
-                    return self._err(400, {"ok": False, "error": "empty q"})
-                try:
-                    top_k = int(data.get("top_k", 5))
-                except Exception:
-                    top_k = 5
-                top_k = max(1, min(20, top_k))
-                subject_in = str(data.get("subject") or "").strip().lower()
-                grade_in = data.get("grade", None)
-                subj_key = subject_to_vdb_key(subject_in) if subject_in else "auto"
-                try:
-                    grade_int = int(grade_in) if grade_in is not None else 8
-                except Exception:
-                    grade_int = 8
-                q_clamped = clamp_words(q, 40)
-                loop = getattr(self.server, "loop", None)  # type: ignore
-                if loop is None:
-                    return self._err(500, {"ok": False, "error": "loop missing"})
-
-                async def _run():
-                    try:
-                        rules = await search_rules(
-                            client, q_clamped, subj_key, grade_int, top_k=top_k
-                        )
-                        if not rules and subj_key != "auto":
-                            rules = await search_rules(
-                                client,
-                                q_clamped,
-                                subject_in or "auto",
-                                grade_int,
-                                top_k=top_k,
-                            )
-                    except Exception as e:
-                        log.exception("vdb search fail")
-                        return {"ok": False, "error": f"{e}"}
-                    items = []
-                    for r in (rules or [])[:top_k]:
-                        brief = (
-                            r.get("rule_brief") or r.get("text") or r.get("rule") or ""
-                        ).strip() if isinstance(r, dict) else str(r).strip()
-                        items.append(
-                            {
-                                "brief": clamp_words(brief, 120),
-                                "meta": {
-                                    "book": (r.get("book") or "").strip() if isinstance(r, dict) else "",
-                                    "chapter": (r.get("chapter") or "").strip() if isinstance(r, dict) else "",
-                                    "page": (r.get("page") if isinstance(r, dict) else None),
-                                    "subject": subject_in or subj_key,
-                                    "grade": grade_int,
-                                },
-                            }
-                        )
-                    return {"ok": True, "count": len(items), "items": items}
-
-                fut = asyncio.run_coroutine_threadsafe(_run(), loop)
-                try:
-                    res = fut.result(timeout=3.5)
-                except Exception as e:
-                    return self._err(504, {"ok": False, "error": f"timeout: {e}"})
-                return self._json(200, res)
-
-            if path == "/webhook/bepaid":
-                if BEPAID_WEBHOOK_SECRET and auth != BEPAID_WEBHOOK_SECRET:
-                    return self._err(401, {"ok": False, "error": "bad auth"})
-                log.info("bePaid webhook: %s", data)
-                # TODO: отметить оплату (credits/sub). Пока просто 200 OK:
-                return self._json(200, {"ok": True})
-
-            return self._err(404, "not found")
-        except Exception as e:
-            log.exception("http-post")
-            return self._err(500, {"ok": False, "error": f"{e}"})
-
-class _HealthThread(threading.Thread):
-    daemon = True
-    def __init__(self, port: int):
-        super().__init__(name="health-thread")
-        self.port = port
-        self.loop = None
-    def run(self):
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        httpd = HTTPServer(("0.0.0.0", self.port), _Health)
-        httpd.loop = self.loop  # проброс event loop в handler
-        log.info("Health server on 0.0.0.0:%s", self.port)
-        httpd.serve_forever()
-
-def _start_health_and_metrics():
-    port = int(os.getenv("HEALTH_PORT", os.getenv("PORT", "8080")))
-    ht = _HealthThread(port)
-    ht.start()
-    threading.Thread(
-        target=_stats_autosave_loop, name="stats-autosave", daemon=True
-    ).start()
-    return ht
+            if user is None:
+                await coroutine
+            else:
+                # машина состояний живёт на сообщениях; кнопки/платежи — мимо замка
+                res = await inflight.run(user.id, _update_dedup_key(update), coroutine, kind=label,
+                                         serialize=update.message is not None)
+                status = "coalesced" if res == "coalesced" else None
+        finally:
+            UPDATES_INFLIGHT.dec()
+            UPDATE_SECONDS.observe(perf_counter() - t0, handler="duplicate" if status else label)
+            tracing.end(tr, status)
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest с гистограммой задержки Bot API по методу (sendMessage, editMessageText, ...)."""
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        t0 = perf_counter()
+        api_method = url.rsplit("/", 1)[-1]
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TG_SECONDS.observe(perf_counter() - t0, method=api_method, status=status)
+
+REGISTRY.gauge("ocr_queue_depth", "OCR jobs waiting or running", fn=lambda: ocr_pool.depth)
+REGISTRY.gauge("ocr_running", "OCR jobs running in workers", fn=lambda: ocr_pool.running)
 
 # ---------- Регистрация хэндлеров ----------
+async def _begin_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    _UPDATE_MEMO.set({})
+
 def _register_handlers(app: Application):
+    app.add_handler(TypeHandler(Update, _begin_update), group=-1)
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("menu", menu_cmd))
     app.add_handler(CommandHandler("help", help_cmd))
@@ -1452,9 +2028,15 @@ def _register_handlers(app: Application):
     app.add_handler(MessageHandler(f.TEXT & ~f.COMMAND, on_text))
 
     app.add_error_handler(on_error)
+    _COMMANDS.update(c for hs in app.handlers.values() for h in hs if isinstance(h, CommandHandler) for c in h.commands)
 
 # ---------- post_init: строго в builder ----------
 async def _post_init(app: Application):
+    REGISTRY.gauge("update_queue_depth", "Updates fetched but not yet dispatched", fn=app.update_queue.qsize)
+    try:
+        await _start_http(app)
+    except Exception as e:
+        log.warning(f"http server start failed: {e}")
     try:
         try:
             await app.bot.delete_webhook(drop_pending_updates=True)
@@ -1466,31 +2048,49 @@ async def _post_init(app: Application):
     except Exception as e:
         log.warning(f"post_init failed: {e}")
 
+async def _post_shutdown(app: Application):
+    await _stop_http(app)
+
+def build_application(base_url: str | None = None, base_file_url: str | None = None, with_hooks: bool = True) -> Application:
+    """Application с хэндлерами; base_url/base_file_url — другой Bot API (локальный сервер, scripts/bench_e2e.py)."""
+    b = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(MeteredUpdateProcessor(256))
+        .request(MeteredRequest(connection_pool_size=256))
+    )
+    if base_url: b = b.base_url(base_url)
+    if base_file_url: b = b.base_file_url(base_file_url)
+    if with_hooks: b = b.post_init(_post_init).post_shutdown(_post_shutdown)
+    app = b.build()
+    _register_handlers(app)
+    return app
+
 # ---------- MAIN ----------
 def main():
     if not TELEGRAM_TOKEN:
         raise SystemExit("Нет TELEGRAM_TOKEN (fly secrets set TELEGRAM_TOKEN=...)")
 
+    # OCR-воркеры форкаем до старта потоков и event loop
+    ocr_pool.start()
+    storage.migrate()
+    answer_cache.open()   # прогрев кэша ответов из cache.db — здесь, а не на первом запросе (event loop)
+    embed_cache_open()
+    ocr_cache.open()
+    refresh_admins(force=True)
+    threading.Thread(target=_admins_refresh_loop, name="admins-refresh", daemon=True).start()
+    sessions.start()
+
     try:
         stats_load()
-        _start_health_and_metrics()
+        atexit.register(stats_save)
+        threading.Thread(target=_stats_autosave_loop, name="stats-autosave", daemon=True).start()
     except Exception as e:
-        log.warning(f"stats/health start warn: {e}")
+        log.warning(f"stats start warn: {e}")
 
-    app = (
-        Application.builder()
-        .token(TELEGRAM_TOKEN)
-        .concurrent_updates(True)
-        .post_init(_post_init)
-        .build()
-    )
+    app = build_application()
 
-    _register_handlers(app)
-
-    log.info(
-        "Bot is starting (long-polling). Health on %s",
-        os.getenv("HEALTH_PORT", os.getenv("PORT", "8080")),
-    )
+    log.info("Bot is starting (long-polling). Health on %s", HEALTH_PORT)
     app.run_polling(
         close_loop=False,
         drop_pending_updates=True,
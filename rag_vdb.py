@@ -1,28 +1,48 @@
 # rag_vdb.py — Qdrant (embedded) + OpenAI embeddings (1536)
-import os, json
-from typing import List, Dict, Optional
+import os, json, uuid, struct, sqlite3, threading, time, logging, asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Sequence
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct, Filter, FieldCondition, MatchValue
+from qdrant_client.models import VectorParams, Distance, PointStruct, Filter, FieldCondition, MatchValue, QueryRequest
 from openai import AsyncOpenAI
+from services.metrics import VDB_EMBED_SECONDS, VDB_SEARCH_SECONDS
+from services.write_behind import WriteBehind
+
+log = logging.getLogger("gotovo-bot")
 
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
 VDB_PATH    = os.getenv("VDB_PATH", "/data/vdb")
 COLL        = os.getenv("VDB_COLLECTION", "school_rules")
 DIM         = 1536  # text-embedding-3-*
+EMBED_CACHE_MAX  = int(os.getenv("EMBED_CACHE_MAX", "5000"))          # векторов запросов в памяти
+EMBED_CACHE_DISK = os.getenv("EMBED_CACHE_DISK", "true").lower() == "true"
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join(os.getenv("DATA_DIR", "/data"), "cache.db"))
+EMBED_CACHE_TTL  = int(os.getenv("EMBED_CACHE_TTL_DAYS", "30")) * 86400
 
 _client: Optional[QdrantClient] = None
+_client_lock = threading.Lock()
+# Встроенный Qdrant синхронный и не рассчитан на параллельный доступ: все вызовы — в одном потоке вне event loop
+_VDB_EXEC = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vdb")
 
 def vdb() -> QdrantClient:
     global _client
     if _client is None:
-        os.makedirs(VDB_PATH, exist_ok=True)
-        _client = QdrantClient(path=VDB_PATH)
-        # ensure collection
-        cols = [c.name for c in _client.get_collections().collections]
-        if COLL not in cols:
-            _client.recreate_collection(COLL, vectors_config=VectorParams(size=DIM, distance=Distance.COSINE))
+        with _client_lock:
+            if _client is None:
+                os.makedirs(VDB_PATH, exist_ok=True)
+                c = QdrantClient(path=VDB_PATH)
+                # ensure collection
+                cols = [x.name for x in c.get_collections().collections]
+                if COLL not in cols:
+                    c.recreate_collection(COLL, vectors_config=VectorParams(size=DIM, distance=Distance.COSINE))
+                _client = c
     return _client
 
+async def _in_vdb_thread(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_VDB_EXEC, lambda: fn(*args, **kwargs))
+
 async def embed_texts(ai: AsyncOpenAI, texts: List[str]) -> List[List[float]]:
     # Короткое замыкание: нечего встраивать — нечего звать OpenAI
     if not texts:
@@ -31,35 +51,161 @@ async def embed_texts(ai: AsyncOpenAI, texts: List[str]) -> List[List[float]]:
     resp = await ai.embeddings.create(model=EMBED_MODEL, input=texts)
     return [d.embedding for d in resp.data]
 
-async def upsert_rules(ai: AsyncOpenAI, rules: List[Dict]):
+# ---------- Кэш эмбеддингов запросов ----------
+# Память: LRU по (модель, нормализованный текст); диск: float16 в SQLite (вдвое меньше, для косинуса хватает).
+# На event loop — только память: чтение с диска — в потоке ВБД, запись — пачками в фоне (WriteBehind),
+# открытие базы с чисткой по TTL — embed_cache_open() при старте.
+_EMB_LOCK = threading.Lock()      # память и счётчики — берётся и на event loop, под ним SQLite не трогаем
+_EMB_DB_LOCK = threading.Lock()   # соединение cache.db (поток ВБД, поток записи, старт)
+_EMB_MEM: "OrderedDict[tuple, List[float]]" = OrderedDict()
+_EMB_DB: Optional[sqlite3.Connection] = None
+EMB_STATS = {"hits": 0, "disk_hits": 0, "misses": 0, "api_calls": 0}
+
+def _emb_key(text: str) -> tuple:
+    return (EMBED_MODEL, " ".join((text or "").split()).lower())
+
+def _emb_db() -> Optional[sqlite3.Connection]:
+    global _EMB_DB, EMBED_CACHE_DISK
+    if _EMB_DB is None and EMBED_CACHE_DISK:
+        try:
+            os.makedirs(os.path.dirname(EMBED_CACHE_PATH), exist_ok=True)
+            conn = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS embed_cache(
+                model TEXT NOT NULL, text TEXT NOT NULL, vec BLOB NOT NULL, ts INTEGER NOT NULL,
+                PRIMARY KEY(model, text)
+            )""")
+            conn.execute("DELETE FROM embed_cache WHERE ts < ?", (int(time.time()) - EMBED_CACHE_TTL,))
+            conn.commit()
+            _EMB_DB = conn
+        except Exception as e:
+            log.warning(f"embed cache disk disabled: {e}")
+            EMBED_CACHE_DISK = False
+    return _EMB_DB
+
+def _emb_remember(key: tuple, vec: List[float]):
+    _EMB_MEM[key] = vec
+    _EMB_MEM.move_to_end(key)
+    while len(_EMB_MEM) > EMBED_CACHE_MAX:
+        _EMB_MEM.popitem(last=False)
+
+def _emb_mem_get(key: tuple) -> Optional[List[float]]:
+    with _EMB_LOCK:
+        vec = _EMB_MEM.get(key)
+        if vec is not None:
+            _EMB_MEM.move_to_end(key)
+            EMB_STATS["hits"] += 1
+        return vec
+
+def _emb_disk_get(key: tuple) -> Optional[List[float]]:
+    """Чтение из SQLite — вне event loop (поток ВБД)."""
+    with _EMB_DB_LOCK:
+        db = _emb_db()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT vec FROM embed_cache WHERE model=? AND text=?", key).fetchone()
+        except Exception:
+            row = None
+    if not row:
+        return None
+    blob = row[0]
+    vec = list(struct.unpack(f"<{len(blob) // 2}e", blob))
+    with _EMB_LOCK:
+        _emb_remember(key, vec)
+        EMB_STATS["hits"] += 1; EMB_STATS["disk_hits"] += 1
+        return vec
+
+def _emb_write(rows: List[tuple]):
+    with _EMB_DB_LOCK:
+        db = _emb_db()
+        if db is None:
+            return
+        db.executemany("INSERT OR REPLACE INTO embed_cache(model,text,vec,ts) VALUES(?,?,?,?)", rows)
+        db.commit()
+
+_EMB_WB = WriteBehind("embed-cache-writer", _emb_write)
+
+def _emb_put(key: tuple, vec: List[float]):
+    with _EMB_LOCK:
+        _emb_remember(key, vec)
+    if EMBED_CACHE_DISK:
+        _EMB_WB.add((key[0], key[1], struct.pack(f"<{len(vec)}e", *vec), int(time.time())))
+
+def embed_cache_open():
+    """Открыть дисковый кэш (и вычистить просроченное) при старте, а не на первом запросе."""
+    with _EMB_DB_LOCK:
+        _emb_db()
+
+def embed_cache_stats() -> dict:
+    lookups = EMB_STATS["hits"] + EMB_STATS["misses"]
+    return {**EMB_STATS, "mem": len(_EMB_MEM), "write_pending": _EMB_WB.stats()["pending"],
+            "hit_rate": round(EMB_STATS["hits"] / lookups, 3) if lookups else 0.0}
+
+async def embed_query(ai: AsyncOpenAI, query: str) -> List[float]:
+    """Один вектор запроса — считаем один раз и переиспользуем (поиск правил, кэш ответов, повторы)."""
+    t0 = time.perf_counter()
+    key = _emb_key(query)
+    vec = _emb_mem_get(key)
+    if vec is None and EMBED_CACHE_DISK:
+        vec = await _in_vdb_thread(_emb_disk_get, key)
+    if vec is not None:
+        VDB_EMBED_SECONDS.observe(time.perf_counter() - t0, source="cache")
+        return vec
+    with _EMB_LOCK:
+        EMB_STATS["misses"] += 1
+        EMB_STATS["api_calls"] += 1
+    # нормализованный текст — только ключ кэша; встраиваем запрос как есть (регистр и переносы несут смысл)
+    vec = (await embed_texts(ai, [query]))[0]
+    _emb_put(key, vec)
+    VDB_EMBED_SECONDS.observe(time.perf_counter() - t0, source="api")
+    return vec
+
+def _point_id(rid):
+    """Qdrant принимает только целые и UUID: строковый id правила → детерминированный uuid5 (повторная заливка = перезапись)."""
+    if isinstance(rid, int) or (isinstance(rid, str) and rid.isdigit()):
+        return int(rid)
+    try:
+        return str(uuid.UUID(str(rid)))
+    except ValueError:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"rule:{rid}"))
+
+async def upsert_rules(ai: AsyncOpenAI, rules: List[Dict], timings: Optional[dict] = None):
     """
     rule item:
       {"id": "math_7_2021_algebra_p045_r01",
        "rule_brief": "25–40 слов своими словами...",
        "subject":"math","grade":7,"book":"Алгебра 7 (Иванов, 2021)","chapter":"Линейные уравнения","page":45}
+    timings (если передан) получает embed_ms / upsert_ms.
     """
     # Короткое замыкание: пусто — просто выходим
     if not rules:
         return
+    t0 = time.perf_counter()
     vecs = await embed_texts(ai, [r["rule_brief"] for r in rules])
+    t1 = time.perf_counter()
     points = []
     for r, v in zip(rules, vecs):
         payload = {
+            "rule_id": str(r["id"]),
             "rule_brief": r["rule_brief"],
             "subject": r["subject"], "grade": r["grade"],
             "book": r["book"], "chapter": r.get("chapter",""), "page": r.get("page", None),
             "topic": r.get("topic","")
         }
-        points.append(PointStruct(id=r["id"], vector=v, payload=payload))
-    vdb().upsert(COLL, points=points)
+        points.append(PointStruct(id=_point_id(r["id"]), vector=v, payload=payload))
+    await _in_vdb_thread(lambda: vdb().upsert(COLL, points=points))
+    if timings is not None:
+        timings["embed_ms"] = (t1 - t0) * 1000
+        timings["upsert_ms"] = (time.perf_counter() - t1) * 1000
 
-async def search_rules(ai: AsyncOpenAI, query: str, subject: str, grade: int, top_k=5) -> List[Dict]:
-    qv = (await embed_texts(ai, [query]))[0]
-    flt = Filter(must=[
+def _flt(subject: str, grade: int) -> Filter:
+    return Filter(must=[
         FieldCondition(key="subject", match=MatchValue(value=subject)),
         FieldCondition(key="grade",   match=MatchValue(value=int(grade))),
     ])
-    res = vdb().search(COLL, query_vector=qv, query_filter=flt, limit=top_k, with_payload=True)
+
+def _hits(res) -> List[Dict]:
     out=[]
     for r in res:
         p = r.payload or {}
@@ -72,6 +218,28 @@ async def search_rules(ai: AsyncOpenAI, query: str, subject: str, grade: int, to
         })
     return out
 
+async def search_rules(ai: AsyncOpenAI, query: str, subject: str, grade: int, top_k=5,
+                       qv: Optional[List[float]] = None) -> List[Dict]:
+    if qv is None:
+        qv = await embed_query(ai, query)
+    with VDB_SEARCH_SECONDS.time(op="query"):
+        res = await _in_vdb_thread(
+            lambda: vdb().query_points(COLL, query=qv, query_filter=_flt(subject, grade), limit=top_k, with_payload=True))
+    return _hits(res.points)
+
+async def search_rules_multi(ai: AsyncOpenAI, query: str, subjects: Sequence[str], grade: int, top_k=5,
+                             qv: Optional[List[float]] = None) -> List[List[Dict]]:
+    """Основной и запасные предметы одним пакетным запросом (один вектор, один заход в поток ВБД)."""
+    subjects = list(dict.fromkeys(s for s in subjects if s))
+    if not subjects:
+        return []
+    if qv is None:
+        qv = await embed_query(ai, query)
+    reqs = [QueryRequest(query=qv, filter=_flt(s, grade), limit=top_k, with_payload=True) for s in subjects]
+    with VDB_SEARCH_SECONDS.time(op="query_batch"):
+        res = await _in_vdb_thread(lambda: vdb().query_batch_points(COLL, requests=reqs))
+    return [_hits(r.points) for r in res]
+
 def clamp_words(s: str, max_words=40) -> str:
     w = (s or "").split()
     return " ".join(w[:max_words]).rstrip(",.;:") + ("…" if len(w) > max_words else "")
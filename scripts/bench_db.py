@@ -0,0 +1,93 @@
+# scripts/bench_db.py — время SQLite на одно сообщение: старые хелперы (connect + CREATE TABLE на вызов)
+# против services/storage (соединение потока, WAL, миграции при старте).
+# Набор запросов = текстовая задача: consume_request (админы + план + free-счётчик) + follow-up контекст.
+from __future__ import annotations
+import os, sys, time, sqlite3, argparse, tempfile, statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+def _pct(vals, q):
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))] if vals else 0.0
+
+# ---------- «до»: копия прежних хелперов bot.py ----------
+class Legacy:
+    def __init__(self, path: str):
+        self.path = path
+
+    def _conn(self, ddl: str):
+        conn = sqlite3.connect(self.path)
+        conn.execute(ddl)
+        return conn
+
+    def _plan(self):
+        return self._conn("""CREATE TABLE IF NOT EXISTS user_plan(
+            user_id INTEGER PRIMARY KEY, pro_until INTEGER NOT NULL DEFAULT 0, day INTEGER NOT NULL DEFAULT 0,
+            free_count INTEGER NOT NULL DEFAULT 0, credits INTEGER NOT NULL DEFAULT 0, sub_until INTEGER NOT NULL DEFAULT 0)""")
+
+    def _followup(self):
+        return self._conn("""CREATE TABLE IF NOT EXISTS followup_state(
+            user_id INTEGER PRIMARY KEY, last_task TEXT, last_answer TEXT, ts INTEGER, used_free INTEGER)""")
+
+    def _admins(self):
+        return self._conn("CREATE TABLE IF NOT EXISTS admin_users(user_id INTEGER PRIMARY KEY, added_ts INTEGER)")
+
+    def message(self, uid: int):
+        day = int(time.time() // 86400)
+        with self._admins() as db:
+            db.execute("SELECT user_id FROM admin_users").fetchall()
+        with self._plan() as db:   # _ensure_user_plan
+            if not db.execute("SELECT user_id,pro_until,day,free_count,credits,sub_until FROM user_plan WHERE user_id=?", (uid,)).fetchone():
+                db.execute("INSERT INTO user_plan(user_id,pro_until,day,free_count,credits,sub_until) VALUES(?,?,?,?,?,?)",
+                           (uid, int(time.time()) + 7 * 86400, day, 0, 0, 0))
+        with self._plan() as db:   # _roll_day
+            row = db.execute("SELECT day FROM user_plan WHERE user_id=?", (uid,)).fetchone()
+            if row[0] != day:
+                db.execute("UPDATE user_plan SET day=?, free_count=0 WHERE user_id=?", (day, uid))
+        with self._plan() as db:   # plan_get
+            db.execute("SELECT pro_until,day,free_count,credits,sub_until FROM user_plan WHERE user_id=?", (uid,)).fetchone()
+        with self._plan() as db:   # inc_free
+            db.execute("UPDATE user_plan SET free_count = free_count + 1 WHERE user_id=?", (uid,))
+        with self._followup() as db:
+            db.execute("SELECT last_task,last_answer,ts,used_free FROM followup_state WHERE user_id=?", (uid,)).fetchone()
+        with self._followup() as db:
+            db.execute("""INSERT INTO followup_state(user_id,last_task,last_answer,ts,used_free) VALUES(?,?,?,?,0)
+                          ON CONFLICT(user_id) DO UPDATE SET last_task=?, last_answer=?, ts=?, used_free=0""",
+                       (uid, "задача", "ответ", int(time.time()), "задача", "ответ", int(time.time())))
+
+def main():
+    ap = argparse.ArgumentParser(description="Per-message SQLite time: legacy helpers vs services.storage")
+    ap.add_argument("--messages", type=int, default=2000)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--dir", default="", help="Куда класть app.db (по умолчанию — временная папка)")
+    args = ap.parse_args()
+
+    data_dir = args.dir or tempfile.mkdtemp(prefix="bench_db_")
+    os.environ["DATA_DIR"] = data_dir
+    os.environ.setdefault("OPENAI_API_KEY", "bench")   # bot.py создаёт клиента при импорте; в сеть не ходим
+    os.environ.setdefault("TELEGRAM_TOKEN", "1:bench")  # иначе проверка секретов в bot.py — SystemExit
+    import bot   # «после»: настоящие хелперы bot.py поверх services/storage
+
+    def after(uid: int):
+        bot.consume_request(uid, need_pro=False)
+        bot.get_followup_context(uid)
+        bot.set_followup_context(uid, "задача", "ответ")
+
+    legacy = Legacy(os.path.join(data_dir, "legacy.db"))
+    bot.storage.migrate()
+    res = {}
+    for name, fn in (("before", legacy.message), ("after", after)):
+        ms = []
+        for i in range(args.messages):
+            t0 = time.perf_counter()
+            fn(1000 + i % args.users)
+            ms.append((time.perf_counter() - t0) * 1000)
+        res[name] = ms
+        print(f"{name:>7}: n={len(ms)} mean={statistics.mean(ms):.3f}ms p50={_pct(ms, .5):.3f}ms "
+              f"p95={_pct(ms, .95):.3f}ms max={max(ms):.3f}ms")
+    print(f"speedup (mean): x{statistics.mean(res['before']) / statistics.mean(res['after']):.1f}  [db dir: {data_dir}]")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
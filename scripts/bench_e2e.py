@@ -0,0 +1,270 @@
+# scripts/bench_e2e.py — сквозной бенчмарк без сети: настоящие хэндлеры bot.py (build_application) +
+# локальные заглушки Bot API и OpenAI (задаваемая задержка/длина ответа) + временные SQLite/Qdrant.
+# N виртуальных учеников шлют апдейты по кругу (закрытый цикл); считаем пропускную способность, p50/p95/p99
+# времени обработки апдейта по видам (text / photo / followup) и задержку event loop.
+from __future__ import annotations
+import os, io, sys, json, time, random, asyncio, argparse, tempfile, statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from aiohttp import web
+
+TOKEN = "123456:BENCH"
+DIM = 1536
+
+def _pct(vals, q):
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+# ---------- Заглушка Bot API ----------
+class FakeBotApi:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self.files: dict[str, bytes] = {}
+        self._mid = 1000
+
+    def _msg(self, chat_id, text=None) -> dict:
+        self._mid += 1
+        m = {"message_id": self._mid, "date": int(time.time()), "chat": {"id": int(chat_id or 1), "type": "private"}}
+        if text is not None:
+            m["text"] = text
+        return m
+
+    async def method(self, request: web.Request):
+        name = request.match_info["method"]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = data.get("chat_id")
+        if name == "getMe":
+            res = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif name in ("sendMessage", "sendPhoto", "sendDocument"):
+            res = self._msg(chat_id, data.get("text"))
+        elif name == "editMessageText":
+            res = self._msg(chat_id, data.get("text"))
+        elif name == "getFile":
+            fid = data.get("file_id")
+            res = {"file_id": fid, "file_unique_id": fid, "file_size": len(self.files.get(fid, b"")), "file_path": f"photos/{fid}.png"}
+        else:   # sendChatAction, deleteMessage, setMyCommands, deleteWebhook, answerCallbackQuery, ...
+            res = True
+        return web.json_response({"ok": True, "result": res})
+
+    async def file(self, request: web.Request):
+        fid = Path(request.match_info["path"]).stem
+        return web.Response(body=self.files.get(fid, b""), content_type="image/png")
+
+# ---------- Заглушка OpenAI ----------
+class FakeOpenAI:
+    def __init__(self, ttft: float, tps: float, tokens: int, embed_latency: float):
+        self.ttft = ttft; self.tps = tps; self.tokens = tokens; self.embed_latency = embed_latency
+        self.chat_calls = 0; self.embed_calls = 0
+
+    def _answer(self) -> list[str]:
+        head = ["<b>Ответы</b>\n", "x = 4\n", "<b>Пояснение</b>\n"]
+        return head + [f"шаг{i} " for i in range(max(0, self.tokens - len(head)))]
+
+    async def chat(self, request: web.Request):
+        body = await request.json()
+        self.chat_calls += 1
+        model = body.get("model", "gpt-4o-mini")
+        toks = self._answer()
+        await asyncio.sleep(self.ttft)
+        usage = {"prompt_tokens": 400, "completion_tokens": len(toks), "total_tokens": 400 + len(toks)}
+        if not body.get("stream"):
+            await asyncio.sleep(len(toks) / self.tps)
+            return web.json_response({
+                "id": "cmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(toks)}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        step = max(1, int(self.tps / 20))   # ~20 пачек токенов в секунду
+        for i in range(0, len(toks), step):
+            chunk = {"id": "cmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": "".join(toks[i:i + step])}, "finish_reason": None}]}
+            await resp.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+            await asyncio.sleep(step / self.tps)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            tail = {"id": "cmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [], "usage": usage}
+            await resp.write(b"data: " + json.dumps(tail).encode() + b"\n\n")
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def embeddings(self, request: web.Request):
+        body = await request.json()
+        self.embed_calls += 1
+        inp = body.get("input")
+        inp = inp if isinstance(inp, list) else [inp]
+        await asyncio.sleep(self.embed_latency)
+        data = [{"object": "embedding", "index": i, "embedding": [random.uniform(-1, 1) for _ in range(DIM)]}
+                for i in range(len(inp))]
+        return web.json_response({"object": "list", "data": data, "model": body.get("model"),
+                                  "usage": {"prompt_tokens": 8 * len(inp), "total_tokens": 8 * len(inp)}})
+
+async def _serve(app: web.Application) -> tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+# ---------- Синтетические апдейты ----------
+def _task_image(n: int) -> bytes:
+    from PIL import Image, ImageDraw, ImageFont
+    img = Image.new("L", (900, 260), 255)
+    d = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.load_default(size=44)
+    except TypeError:
+        font = ImageFont.load_default()
+    d.text((30, 40), f"Solve: 2x + {n} = {n + 8}", fill=0, font=font)
+    d.text((30, 140), f"Task {n}: find x", fill=0, font=font)
+    buf = io.BytesIO(); img.save(buf, "PNG")
+    return buf.getvalue()
+
+class Users:
+    def __init__(self, bot_mod, app, api: FakeBotApi):
+        self.bot = bot_mod; self.app = app; self.api = api
+        self._uid = 0; self._n = 0
+
+    def _update(self, uid: int, **msg) -> "object":
+        from telegram import Update
+        self._n += 1
+        m = {"message_id": self._n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+             "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"}, **msg}
+        return Update.de_json({"update_id": self._n, "message": m}, self.app.bot)
+
+    def text(self, uid: int, text: str):
+        ent = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else None
+        return self._update(uid, text=text, **({"entities": ent} if ent else {}))
+
+    def photo(self, uid: int, n: int):
+        fid = f"ph{uid}_{n}"
+        data = _task_image(n)
+        self.api.files[fid] = data
+        return self._update(uid, photo=[{"file_id": fid, "file_unique_id": fid, "width": 900, "height": 260,
+                                         "file_size": len(data)}])
+
+    async def send(self, upd) -> float:
+        t0 = time.perf_counter()
+        await self.app.update_processor.process_update(upd, self.app.process_update(upd))
+        return time.perf_counter() - t0
+
+async def _loop_lag(stop: asyncio.Event, out: list, tick: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t = loop.time()
+        await asyncio.sleep(tick)
+        out.append(max(0.0, loop.time() - t - tick))
+
+async def run(args) -> int:
+    api = FakeBotApi(args.tg_latency)
+    ai = FakeOpenAI(args.llm_ttft, args.llm_tps, args.llm_tokens, args.embed_latency)
+    tg_app = web.Application(client_max_size=32 * 1024 * 1024)
+    tg_app.router.add_post(f"/bot{TOKEN}/{{method}}", api.method)
+    tg_app.router.add_get(f"/file/bot{TOKEN}/{{path:.*}}", api.file)
+    oa_app = web.Application()
+    oa_app.router.add_post("/v1/chat/completions", ai.chat)
+    oa_app.router.add_post("/v1/embeddings", ai.embeddings)
+    tg_runner, tg_port = await _serve(tg_app)
+    oa_runner, oa_port = await _serve(oa_app)
+
+    # bot.py читает окружение при импорте — выставляем всё до него
+    data_dir = args.dir or tempfile.mkdtemp(prefix="bench_e2e_")
+    os.environ.update({
+        "TELEGRAM_TOKEN": TOKEN, "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": f"http://127.0.0.1:{oa_port}/v1",
+        "DATA_DIR": data_dir, "VDB_PATH": os.path.join(data_dir, "vdb"), "LLM_STREAM": "true" if args.stream else "false",
+        "ANSWER_CACHE": os.environ.get("ANSWER_CACHE", "false"), "ADMIN_IDS": "",
+    })
+    import bot
+    bot.storage.migrate()
+    app = bot.build_application(base_url=f"http://127.0.0.1:{tg_port}/bot",
+                                base_file_url=f"http://127.0.0.1:{tg_port}/file/bot", with_hooks=False)
+    await app.initialize()
+    users = Users(bot, app, api)
+
+    lat: dict[str, list] = {"text": [], "photo": [], "followup": []}
+    errors = 0
+    counter = iter(range(10 ** 9))
+    mix = [k for k in args.mix.split(",") if k in lat]
+    deadline = time.perf_counter() + args.duration
+
+    async def student(uid: int):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            kind = random.choice(mix)
+            n = next(counter)
+            try:
+                if kind == "text":
+                    lat["text"].append(await users.send(users.text(uid, f"/explain Реши уравнение 3x + {n} = {n + 9}, задача №{n}")))
+                elif kind == "photo":
+                    lat["photo"].append(await users.send(users.photo(uid, n)))
+                else:   # решение → «Да» → вопрос: замеряем сам follow-up
+                    await users.send(users.text(uid, f"/explain Найди площадь квадрата со стороной {n % 50 + 1} см"))
+                    await users.send(users.text(uid, "Да"))
+                    lat["followup"].append(await users.send(users.text(uid, f"А почему сторона {n % 50 + 1} в квадрате?")))
+            except Exception as e:
+                errors += 1
+                if errors <= 3:
+                    print(f"[WARN] {kind}: {e!r}")
+            if args.think:
+                await asyncio.sleep(random.expovariate(1 / args.think))
+
+    lag: list = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(_loop_lag(stop, lag))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(student(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - t0
+    stop.set(); await lag_task
+    await app.shutdown()
+    await tg_runner.cleanup(); await oa_runner.cleanup()
+
+    print(f"users={args.users} duration={elapsed:.1f}s mix={','.join(mix)} stream={args.stream} "
+          f"llm: ttft={args.llm_ttft}s tps={args.llm_tps} tokens={args.llm_tokens}; tg_latency={args.tg_latency}s")
+    total = 0
+    for kind, vals in lat.items():
+        if not vals:
+            continue
+        total += len(vals)
+        print(f"{kind:>9}: n={len(vals)} thr={len(vals) / elapsed:.2f}/s mean={statistics.mean(vals):.3f}s "
+              f"p50={_pct(vals, .5):.3f}s p95={_pct(vals, .95):.3f}s p99={_pct(vals, .99):.3f}s max={max(vals):.3f}s")
+    print(f"    total: {total} updates measured, {total / elapsed:.2f}/s; errors={errors}")
+    if lag:
+        print(f" loop lag: p50={_pct(lag, .5) * 1000:.1f}ms p95={_pct(lag, .95) * 1000:.1f}ms "
+              f"p99={_pct(lag, .99) * 1000:.1f}ms max={max(lag) * 1000:.1f}ms")
+    top = sorted(api.calls.items(), key=lambda x: -x[1])[:6]
+    print(f"  bot api: {sum(api.calls.values())} calls ({', '.join(f'{k}={v}' for k, v in top)}); "
+          f"openai: chat={ai.chat_calls} embeddings={ai.embed_calls}  [data dir: {data_dir}]")
+    return 0
+
+def main():
+    ap = argparse.ArgumentParser(description="End-to-end throughput: real handlers, fake Bot API and OpenAI")
+    ap.add_argument("--users", type=int, default=20, help="Одновременных учеников (закрытый цикл)")
+    ap.add_argument("--duration", type=float, default=30.0, help="Секунд нагрузки")
+    ap.add_argument("--mix", default="text,followup", help="Через запятую: text,photo,followup")
+    ap.add_argument("--think", type=float, default=0.0, help="Средняя пауза ученика между сообщениями, сек")
+    ap.add_argument("--llm-ttft", type=float, default=0.6, help="Задержка до первого токена, сек")
+    ap.add_argument("--llm-tps", type=float, default=60.0, help="Токенов в секунду")
+    ap.add_argument("--llm-tokens", type=int, default=250, help="Токенов в ответе")
+    ap.add_argument("--embed-latency", type=float, default=0.08, help="Задержка эмбеддингов, сек")
+    ap.add_argument("--tg-latency", type=float, default=0.03, help="Задержка Bot API на вызов, сек")
+    ap.add_argument("--no-stream", dest="stream", action="store_false", help="LLM_STREAM=false")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--dir", default="", help="DATA_DIR (по умолчанию — временная папка)")
+    args = ap.parse_args()
+    random.seed(args.seed)
+    return asyncio.run(run(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+# scripts/bench_ocr.py — OCR на размеченном корпусе: точность (CER) и цена (время, вызовы Tesseract, пик памяти)
+# Корпус: папка с фото; эталон — рядом, <имя>.txt (или <имя>.gt.txt). Подпапки первого уровня = категории
+# (например rus/, bel/, eng/, rotated/, lowlight/) — по ним отдельная сводка.
+# Стратегии: detect (OSD + целевой проход), bruteforce (старый перебор); настройки — через «+»:
+#   --strategies "detect,detect+OCR_MAX_SIDE=2400+OCR_SHARPNESS=1.0,bruteforce"
+from __future__ import annotations
+import os, sys, json, time, argparse, resource, threading, statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from PIL import Image
+from services import ocr, ocr_backend
+
+IMG_EXT = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+
+STRATEGIES = {
+    "detect": lambda img, a: ocr.ocr_image_ex(img, lang_hint=a.lang, subject_hint=a.subject, detect=True),
+    "bruteforce": lambda img, a: ocr.ocr_image_bruteforce(img),
+}
+
+def _pct(vals, q):
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+# ---------- Точность ----------
+def _norm(s: str, ci: bool) -> str:
+    s = " ".join((s or "").split())
+    return s.lower() if ci else s
+
+def edit_distance(a: str, b: str) -> int:
+    """Левенштейн по символам, O(len(a)·len(b)) памяти O(min)."""
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+def _label(p: Path):
+    for cand in (p.with_suffix(".gt.txt"), p.with_suffix(".txt")):
+        if cand.exists():
+            return cand.read_text(encoding="utf-8")
+    return None
+
+# ---------- Стоимость ----------
+def _invocations() -> int:
+    """Проходы распознавания + OSD по обоим бэкендам процесса."""
+    n = 0
+    for be in {id(b): b for b in (ocr_backend._BACKEND, ocr_backend._FALLBACK) if b is not None}.values():
+        n += be.calls + getattr(be, "osd_calls", 0)
+    return n
+
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def _rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE
+    except Exception:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024   # без /proc — только максимум процесса
+
+class PeakRss:
+    """Пик RSS процесса за время блока (опрос раз в 2 мс): tesserocr работает в процессе — его память видна."""
+    def __enter__(self):
+        self.base = self.peak = _rss()
+        self._stop = threading.Event()
+        self._t = threading.Thread(target=self._run, daemon=True); self._t.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(0.002):
+            self.peak = max(self.peak, _rss())
+
+    def __exit__(self, *exc):
+        self._stop.set(); self._t.join()
+        self.peak = max(self.peak, _rss())
+
+def _strategy(spec: str):
+    """'detect+OCR_MAX_SIDE=2400+OCR_SHARPNESS=1.0' → (функция, {атрибут services.ocr: значение})."""
+    name, *kvs = spec.split("+")
+    if name not in STRATEGIES:
+        raise SystemExit(f"[FATAL] unknown strategy {name!r}; known: {', '.join(STRATEGIES)}")
+    over = {}
+    for kv in kvs:
+        k, _, v = kv.partition("=")
+        if not hasattr(ocr, k):
+            raise SystemExit(f"[FATAL] services.ocr has no setting {k!r}")
+        cur = getattr(ocr, k)
+        over[k] = (v.lower() in ("1", "true", "yes")) if isinstance(cur, bool) else type(cur)(v)
+    return STRATEGIES[name], over
+
+def _run_one(fn, over: dict, img, args) -> dict:
+    saved = {k: getattr(ocr, k) for k in over}
+    for k, v in over.items():
+        setattr(ocr, k, v)
+    try:
+        inv0 = _invocations()
+        with PeakRss() as mem:
+            t0 = time.perf_counter()
+            info = fn(img, args)
+            wall = (time.perf_counter() - t0) * 1000
+        info.update(wall_ms=wall, invocations=_invocations() - inv0,
+                    peak_mb=mem.peak / 2 ** 20, peak_delta_mb=(mem.peak - mem.base) / 2 ** 20)
+        return info
+    finally:
+        for k, v in saved.items():
+            setattr(ocr, k, v)
+
+def _summary(rows: list) -> str:
+    ms = [r["wall_ms"] for r in rows]
+    lab = [r for r in rows if r["ref_len"]]
+    cer_micro = sum(r["edits"] for r in lab) / max(1, sum(r["ref_len"] for r in lab)) if lab else None
+    cer_macro = statistics.mean(r["cer"] for r in lab) if lab else None
+    cer = f"CER={cer_micro:.3f} (по картинкам {cer_macro:.3f}, размечено {len(lab)})" if lab else "CER=n/a"
+    return (f"n={len(rows)} {cer} empty={sum(1 for r in rows if not r['text'])} "
+            f"mean={statistics.mean(ms):.0f}ms p50={_pct(ms, .5):.0f}ms p95={_pct(ms, .95):.0f}ms max={max(ms):.0f}ms "
+            f"tess/img={statistics.mean(r['invocations'] for r in rows):.2f} passes/img={statistics.mean(r['passes'] for r in rows):.2f} "
+            f"peak={max(r['peak_mb'] for r in rows):.0f}MB (+{max(r['peak_delta_mb'] for r in rows):.0f}MB)")
+
+def main():
+    ap = argparse.ArgumentParser(description="OCR accuracy (CER) and cost on a labelled corpus, per strategy")
+    ap.add_argument("--dir", required=True, help="Папка с фото заданий (+ эталоны <имя>.txt)")
+    ap.add_argument("--strategies", default="detect,bruteforce",
+                    help="Через запятую: " + ",".join(STRATEGIES) + "; настройки services.ocr — через +KEY=VAL")
+    ap.add_argument("--lang", default="ru", help="Подсказка USER_LANG (ru/be/en/...)")
+    ap.add_argument("--subject", default="auto", help="Подсказка предмета")
+    ap.add_argument("--ci", action="store_true", help="CER без учёта регистра")
+    ap.add_argument("--json", default="", help="Сохранить построчные результаты в JSON")
+    args = ap.parse_args()
+
+    root = Path(args.dir)
+    files = sorted(p for p in root.rglob("*") if p.suffix.lower() in IMG_EXT)
+    if not files:
+        print(f"[FATAL] no images in {args.dir}")
+        return 2
+    specs = [s.strip() for s in args.strategies.split(",") if s.strip()]
+    strategies = {s: _strategy(s) for s in specs}
+    ocr.installed_langs()   # движок и список языков — до замеров, не в счёт первой картинки
+
+    res = {s: [] for s in specs}
+    for p in files:
+        img = Image.open(p); img.load()
+        ref = _label(p)
+        ref_n = _norm(ref, args.ci) if ref is not None else ""
+        cat = p.relative_to(root).parts[0] if len(p.relative_to(root).parts) > 1 else "."
+        row = []
+        for s, (fn, over) in strategies.items():
+            info = _run_one(fn, over, img, args)
+            hyp = _norm(info["text"], args.ci)
+            edits = edit_distance(hyp, ref_n) if ref is not None else 0
+            r = {"file": str(p.relative_to(root)), "category": cat, "text": info["text"], "passes": info["passes"],
+                 "wall_ms": info["wall_ms"], "invocations": info["invocations"], "peak_mb": info["peak_mb"],
+                 "peak_delta_mb": info["peak_delta_mb"], "edits": edits, "ref_len": len(ref_n),
+                 "cer": edits / max(1, len(ref_n)) if ref is not None else None}
+            res[s].append(r)
+            cer = f" cer={r['cer']:.3f}" if r["cer"] is not None else ""
+            row.append(f"{s}: {r['wall_ms']:.0f}ms tess={r['invocations']}{cer} +{r['peak_delta_mb']:.0f}MB")
+        print(f"[{p.relative_to(root)}] " + " | ".join(row))
+
+    print()
+    for s in specs:
+        print(f"{s}: {_summary(res[s])}")
+        cats = sorted({r["category"] for r in res[s]})
+        if len(cats) > 1:
+            for c in cats:
+                print(f"    {c:>10}: {_summary([r for r in res[s] if r['category'] == c])}")
+    child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if child:
+        print(f"tesseract CLI (pytesseract) max RSS: {child / 1024:.0f}MB")
+    if args.json:
+        Path(args.json).write_text(json.dumps(res, ensure_ascii=False, indent=1), encoding="utf-8")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
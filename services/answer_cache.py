@@ -0,0 +1,218 @@
+# services/answer_cache.py — кэш ответов LLM: точное совпадение задания + «почти такое же» по эмбеддингу
+# Ключ: нормализованный текст + предмет + класс + режим + родительский режим.
+# Память: LRU; второй уровень: SQLite в DATA_DIR/cache.db (рядом с кэшем OCR), вектор — float32 BLOB.
+# На event loop — только память: прогрев из SQLite — open() при старте, запись — пачками в фоне (WriteBehind).
+from __future__ import annotations
+import os, re, time, sqlite3, hashlib, logging, threading
+from array import array
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+from services.write_behind import WriteBehind
+
+try:
+    import numpy as np  # ставится вместе с qdrant-client
+except Exception:
+    np = None
+
+log = logging.getLogger("gotovo-bot")
+
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+CACHE_DB_PATH = os.path.join(DATA_DIR, "cache.db")
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "true").lower() == "true"
+ANSWER_CACHE_MAX = int(os.getenv("ANSWER_CACHE_MAX", "2000"))               # записей в памяти
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL_HOURS", "72")) * 3600
+ANSWER_SEM_MIN_SIM = float(os.getenv("ANSWER_SEM_MIN_SIM", "0.97"))         # косинус для «почти такого же»
+
+_NUM_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+def normalize_task(text: str) -> str:
+    """Регистр, ё/е, кавычки/тире, пробелы и хвостовая пунктуация не должны менять ключ."""
+    t = (text or "").lower().replace("ё", "е")
+    t = t.translate(str.maketrans({"«": '"', "»": '"', "“": '"', "”": '"', "„": '"', "—": "-", "–": "-", "−": "-", " ": " "}))
+    t = re.sub(r"\s+", " ", t).strip()
+    return t.rstrip(" .!?;:,")
+
+def _scope(subject: str, grade: str, mode: str, parent: bool, norm: str) -> str:
+    # числа — часть области поиска: «2x+3=7» и «2x+5=7» по эмбеддингу почти одинаковы, а ответы разные
+    nums = ",".join(_NUM_RE.findall(norm))
+    return f"{subject}|{grade}|{mode}|{int(bool(parent))}|{nums}"
+
+def _key(scope: str, norm: str) -> str:
+    return hashlib.sha1(f"{scope}\n{norm}".encode("utf-8")).hexdigest()
+
+def _vec_to_blob(vec: Sequence[float]) -> bytes:
+    return array("f", vec).tobytes()
+
+def _unit(vec):
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+class _Entry:
+    __slots__ = ("key", "scope", "vec", "answer", "dt", "ts")
+    def __init__(self, key, scope, vec, answer, dt, ts):
+        self.key = key; self.scope = scope; self.vec = vec
+        self.answer = answer; self.dt = dt; self.ts = ts
+
+class AnswerCache:
+    def __init__(self, path: str = CACHE_DB_PATH, max_items: int = ANSWER_CACHE_MAX,
+                 ttl: int = ANSWER_CACHE_TTL, min_sim: float = ANSWER_SEM_MIN_SIM):
+        self.path = path
+        self.max_items = max_items
+        self.ttl = ttl
+        self.min_sim = min_sim
+        self._lock = threading.RLock()
+        self._items: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_scope: dict[str, set] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self.exact_hits = 0; self.sem_hits = 0
+        self.misses = 0; self.stores = 0
+        self.saved_sec = 0.0   # сумма времени LLM, которое не пришлось ждать
+        self._wb = WriteBehind("answer-cache-writer", self._write)
+        self._purge_at = 0
+
+    # ---------- SQLite (вне event loop: open() из main(), _write() — поток WriteBehind) ----------
+    def _db(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""CREATE TABLE IF NOT EXISTS answer_cache(
+                    key TEXT PRIMARY KEY,
+                    scope TEXT NOT NULL,
+                    vec BLOB,
+                    answer TEXT NOT NULL,
+                    dt REAL NOT NULL,
+                    ts INTEGER NOT NULL
+                )""")
+                conn.execute("DELETE FROM answer_cache WHERE ts < ?", (int(time.time()) - self.ttl,))
+                conn.commit()
+                self._conn = conn
+                self._warm()
+            return self._conn
+
+    def open(self):
+        """Открыть cache.db, вычистить просроченное и прогреть память. Синхронно — при старте, до event loop."""
+        if not ANSWER_CACHE:
+            return
+        try:
+            self._db()
+            log.info(f"answer_cache: warmed {len(self._items)} entries")
+        except Exception as e:
+            log.warning(f"answer_cache open failed: {e}")
+
+    def _write(self, rows):
+        db = self._db()
+        db.executemany(
+            """INSERT INTO answer_cache(key,scope,vec,answer,dt,ts) VALUES(?,?,?,?,?,?)
+               ON CONFLICT(key) DO UPDATE SET vec=excluded.vec, answer=excluded.answer, dt=excluded.dt, ts=excluded.ts""",
+            rows,
+        )
+        if self.stores >= self._purge_at:
+            self._purge_at = self.stores + 200
+            db.execute("DELETE FROM answer_cache WHERE ts < ?", (int(time.time()) - self.ttl,))
+        db.commit()
+
+    def _warm(self):
+        rows = self._conn.execute(
+            "SELECT key, scope, vec, answer, dt, ts FROM answer_cache ORDER BY ts DESC LIMIT ?", (self.max_items,)
+        ).fetchall()
+        for key, scope, blob, answer, dt, ts in reversed(rows):
+            vec = None
+            if blob and np is not None:
+                vec = np.frombuffer(blob, dtype=np.float32)
+            self._remember(_Entry(key, scope, vec, answer, dt, ts))
+
+    def _remember(self, e: _Entry):
+        old = self._items.pop(e.key, None)
+        if old is not None:
+            self._forget_scope(old)
+        self._items[e.key] = e
+        self._by_scope.setdefault(e.scope, set()).add(e.key)
+        while len(self._items) > self.max_items:
+            _, gone = self._items.popitem(last=False)
+            self._forget_scope(gone)
+
+    def _forget_scope(self, e: _Entry):
+        keys = self._by_scope.get(e.scope)
+        if keys is not None:
+            keys.discard(e.key)
+            if not keys:
+                del self._by_scope[e.scope]
+
+    def _fresh(self, e: _Entry) -> bool:
+        return e.ts >= time.time() - self.ttl
+
+    def _hit(self, e: _Entry) -> str:
+        self._items.move_to_end(e.key)
+        self.saved_sec += e.dt
+        return e.answer
+
+    # ---------- API ----------
+    def get_exact(self, text: str, subject: str, grade: str, mode: str, parent: bool) -> Optional[str]:
+        """Точное совпадение нормализованного задания (до эмбеддинга и RAG)."""
+        if not ANSWER_CACHE:
+            return None
+        norm = normalize_task(text)
+        if not norm:
+            return None
+        scope = _scope(subject, grade, mode, parent, norm)
+        key = _key(scope, norm)
+        with self._lock:
+            e = self._items.get(key)
+            if e is not None and self._fresh(e):
+                self.exact_hits += 1
+                return self._hit(e)
+            return None
+
+    def get_similar(self, text: str, subject: str, grade: str, mode: str, parent: bool, qv) -> Optional[str]:
+        """Ближайший сосед по эмбеддингу запроса (того же, что уходит в search_rules) в той же области."""
+        if not ANSWER_CACHE or qv is None or np is None:
+            self.misses += 1
+            return None
+        norm = normalize_task(text)
+        scope = _scope(subject, grade, mode, parent, norm)
+        q = _unit(qv)
+        with self._lock:
+            best, best_sim = None, self.min_sim
+            for key in self._by_scope.get(scope, ()):
+                e = self._items[key]
+                if e.vec is None or e.vec.shape != q.shape or not self._fresh(e):
+                    continue
+                sim = float(np.dot(e.vec, q))
+                if sim >= best_sim:
+                    best, best_sim = e, sim
+            if best is not None:
+                self.sem_hits += 1
+                return self._hit(best)
+            self.misses += 1
+            return None
+
+    def put(self, text: str, subject: str, grade: str, mode: str, parent: bool, answer: str, dt: float, qv=None):
+        if not ANSWER_CACHE or not (answer and answer.strip()):
+            return
+        norm = normalize_task(text)
+        if not norm:
+            return
+        scope = _scope(subject, grade, mode, parent, norm)
+        key = _key(scope, norm)
+        vec = _unit(qv) if (qv is not None and np is not None) else None
+        ts = int(time.time())
+        with self._lock:
+            self._remember(_Entry(key, scope, vec, answer, float(dt), ts))
+            self.stores += 1
+        self._wb.add((key, scope, _vec_to_blob(vec) if vec is not None else None, answer, float(dt), ts))
+
+    def stats(self) -> dict:
+        hits = self.exact_hits + self.sem_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": ANSWER_CACHE, "mem": len(self._items),
+            "exact_hits": self.exact_hits, "sem_hits": self.sem_hits, "misses": self.misses, "stores": self.stores,
+            "saved_sec": round(self.saved_sec, 1), "write_pending": self._wb.stats()["pending"],
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+answer_cache = AnswerCache()
@@ -0,0 +1,114 @@
+# services/inflight.py — реестр апдейтов пользователя «в работе»: сообщения одного ученика обрабатываются по очереди
+# (USER_STATE, списание квоты, followup-контекст не гоняются), а то же задание (текст/фото), присланное повторно, пока
+# первое ещё решается, не запускает второй call_model — дубль просто дожидается оригинала (ответ придёт один).
+# Склеиваем только содержательные отправки (content_key): «Да»/«Нет», кнопки меню и команды всегда обрабатываются.
+# Всё на event loop: замки asyncio, без потоков.
+from __future__ import annotations
+import os, time, asyncio, logging
+from typing import Dict, Optional
+
+from services.metrics import REGISTRY
+
+log = logging.getLogger("gotovo-bot")
+
+INFLIGHT_SERIALIZE = os.getenv("INFLIGHT_SERIALIZE", "true").lower() == "true"
+INFLIGHT_DEDUP_SEC = float(os.getenv("INFLIGHT_DEDUP_SEC", "30"))   # окно склейки дублей (от первого сообщения); 0 — выкл
+INFLIGHT_MIN_TEXT = int(os.getenv("INFLIGHT_MIN_TEXT", "24"))        # короче — это ответ/реплика, а не задание
+
+INFLIGHT_DUPLICATES = REGISTRY.counter("inflight_duplicates", "Duplicate submissions merged into an in-flight update", ("kind",))
+INFLIGHT_LOCK_SECONDS = REGISTRY.histogram("inflight_lock_wait_seconds", "Wait for the previous update of the same user")
+
+def content_key(text: Optional[str] = None, photo_id: Optional[str] = None, doc_id: Optional[str] = None,
+                controls: tuple = ()) -> Optional[str]:
+    """Ключ склейки дублей → None, если сообщение не задание: команда, подпись кнопки (controls — префиксы
+    в нижнем регистре) или короткая реплика. Фото/документ — по file_unique_id, текст — нормализованный."""
+    if photo_id:
+        return "photo:" + photo_id
+    if doc_id:
+        return "doc:" + doc_id
+    t = " ".join((text or "").split()).lower()
+    if len(t) < INFLIGHT_MIN_TEXT or t.startswith("/") or t.startswith(controls):
+        return None
+    return "text:" + t
+
+class _Entry:
+    __slots__ = ("t", "done", "dups")
+
+    def __init__(self):
+        self.t = time.monotonic(); self.done = asyncio.Event(); self.dups = 0
+
+class _User:
+    __slots__ = ("lock", "refs", "entries")
+
+    def __init__(self):
+        self.lock = asyncio.Lock(); self.refs = 0
+        self.entries: Dict[str, _Entry] = {}   # ключ сообщения → апдейт в работе
+
+class InflightRegistry:
+    def __init__(self, serialize: bool = INFLIGHT_SERIALIZE, dedup_sec: float = INFLIGHT_DEDUP_SEC):
+        self.serialize = serialize
+        self.dedup_sec = dedup_sec
+        self._users: Dict[int, _User] = {}
+        # счётчики (читаются из /stats.json и админки)
+        self.started = 0
+        self.coalesced = 0
+        self.serialized = 0     # сколько апдейтов ждали предыдущий того же пользователя
+        self.lock_wait_sum = 0.0
+        self.lock_wait_max = 0.0
+
+    def busy(self, uid: int) -> bool:
+        u = self._users.get(uid)
+        return bool(u and u.lock.locked())
+
+    async def run(self, uid: int, key: Optional[str], coroutine, kind: str = "text", serialize: bool = True) -> str:
+        """Выполнить апдейт пользователя → "ok" | "coalesced".
+        key — нормализованный текст/фото сообщения (None — не склеивать); serialize=False — мимо замка (кнопки)."""
+        u = self._users.get(uid)
+        if u is None:
+            u = self._users[uid] = _User()
+        if key and self.dedup_sec > 0:
+            e = u.entries.get(key)
+            if e is not None and time.monotonic() - e.t <= self.dedup_sec:
+                coroutine.close()   # хэндлер не запускаем: ни второго списания, ни второго вызова LLM
+                e.dups += 1; self.coalesced += 1
+                INFLIGHT_DUPLICATES.inc(kind=kind)
+                log.info(f"inflight: duplicate {kind} from uid={uid} merged (x{e.dups + 1})")
+                await e.done.wait()
+                return "coalesced"
+        e = None
+        if key:
+            e = u.entries[key] = _Entry()
+        u.refs += 1
+        self.started += 1
+        try:
+            if self.serialize and serialize:
+                if u.lock.locked():
+                    self.serialized += 1
+                t0 = time.monotonic()
+                async with u.lock:
+                    waited = time.monotonic() - t0
+                    INFLIGHT_LOCK_SECONDS.observe(waited)
+                    self.lock_wait_sum += waited
+                    self.lock_wait_max = max(self.lock_wait_max, waited)
+                    await coroutine
+            else:
+                await coroutine
+            return "ok"
+        finally:
+            if e is not None:
+                e.done.set()
+                if u.entries.get(key) is e:
+                    del u.entries[key]
+            u.refs -= 1
+            if u.refs == 0 and self._users.get(uid) is u:
+                del self._users[uid]
+
+    def stats(self) -> dict:
+        return {
+            "serialize": self.serialize, "dedup_sec": self.dedup_sec, "users": len(self._users),
+            "started": self.started, "coalesced": self.coalesced, "serialized": self.serialized,
+            "lock_wait_avg": round(self.lock_wait_sum / max(1, self.serialized), 3),
+            "lock_wait_max": round(self.lock_wait_max, 3),
+        }
+
+inflight = InflightRegistry()
@@ -0,0 +1,240 @@
+# services/ingest.py — потоковая заливка правил в ВБД (/vdb/upsert): тело читается кусками, gzip — на лету,
+# элементы массива "rules"/"items" разбираются по одному; эмбеддинг+upsert — пачками с ограниченной параллельностью.
+# В памяти одновременно: буфер одного элемента + INGEST_CONCURRENCY пачек (а не весь файл — VM на 1 ГБ).
+from __future__ import annotations
+import os, json, time, zlib, codecs, asyncio, logging
+from typing import AsyncIterable, Awaitable, Callable, Dict, List, Optional
+
+log = logging.getLogger("gotovo-bot")
+
+INGEST_BATCH = int(os.getenv("INGEST_BATCH", "128"))                       # правил на один запрос эмбеддингов
+INGEST_BATCH_CHARS = int(os.getenv("INGEST_BATCH_CHARS", "60000"))        # ~20k токенов на запрос
+INGEST_CONCURRENCY = max(1, int(os.getenv("INGEST_CONCURRENCY", "2")))    # пачек в работе одновременно
+INGEST_MAX_MB = float(os.getenv("INGEST_MAX_MB", "512"))                  # лимит распакованного тела
+INGEST_MAX_ITEM_KB = int(os.getenv("INGEST_MAX_ITEM_KB", "256"))          # лимит одного элемента/значения
+_GZIP_MAGIC = b"\x1f\x8b"
+_INFLATE_STEP = 1 << 20
+
+class IngestError(ValueError):
+    pass
+
+def normalize_item(r) -> Optional[Dict]:
+    """Те же правила, что _normalize_items в scripts/upsert_rules.py; невалидное → None."""
+    if not isinstance(r, dict):
+        return None
+    id_ = r.get("id")
+    brief = (r.get("rule_brief") or "").strip()
+    subj = r.get("subject")
+    grade = r.get("grade")
+    book = r.get("book")
+    if not (id_ and isinstance(id_, (str, int))):
+        return None
+    if not (brief and subj and (grade is not None) and book):
+        return None
+    try:
+        grade = int(grade)
+    except Exception:
+        return None
+    return {
+        "id": str(id_),
+        "rule_brief": brief,
+        "subject": str(subj),
+        "grade": grade,
+        "book": str(book),
+        "chapter": r.get("chapter") or "",
+        "page": r.get("page", None),
+        "topic": r.get("topic", ""),
+    }
+
+class RulesStream:
+    """Инкрементальный разбор {"rules": [...]} / {"items": [...]}: feed(кусок байт) → готовые элементы массива.
+    Как и obj.get("rules") or obj.get("items"): берётся первый непустой из этих массивов (по порядку в документе),
+    остальные ключи верхнего уровня пропускаются."""
+
+    def __init__(self, max_bytes: int = int(INGEST_MAX_MB * 1024 * 1024), max_item: int = INGEST_MAX_ITEM_KB * 1024):
+        self.max_bytes = max_bytes; self.max_item = max_item
+        self.bytes_in = 0; self.bytes_raw = 0
+        self._inflate = None; self._sniffed = False; self._head = b""
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._dec = json.JSONDecoder()
+        self._buf = ""; self._i = 0
+        self._state = "start"; self._key = None; self._taken = False
+
+    def feed(self, chunk: bytes, final: bool = False) -> list:
+        self.bytes_in += len(chunk)
+        if not self._sniffed:
+            # сигнатура gzip может прийти разрезанной: копим первые 2 байта
+            self._head += chunk
+            if len(self._head) < 2 and not final:
+                return []
+            chunk, self._head = self._head, b""
+            self._sniffed = True
+            if chunk[:2] == _GZIP_MAGIC:
+                self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out: list = []
+        if self._inflate is None:
+            self._text(chunk, final, out)
+            return out
+        data = self._inflate.decompress(chunk, _INFLATE_STEP)
+        while True:
+            self._text(data, False, out)
+            if not self._inflate.unconsumed_tail:
+                break
+            data = self._inflate.decompress(self._inflate.unconsumed_tail, _INFLATE_STEP)
+        if final:
+            self._text(self._inflate.flush(), True, out)
+            if not self._inflate.eof:
+                raise IngestError("truncated gzip stream")
+        return out
+
+    def close(self) -> list:
+        out = self.feed(b"", final=True)
+        if self._state != "done":
+            raise IngestError("unexpected end of JSON")
+        return out
+
+    def _text(self, data: bytes, final: bool, out: list):
+        self.bytes_raw += len(data)
+        if self.bytes_raw > self.max_bytes:
+            raise IngestError(f"body larger than {self.max_bytes // (1024 * 1024)} MB")
+        self._buf = self._buf[self._i:] + self._utf8.decode(data, final)
+        self._i = 0
+        self._parse(final, out)
+        if len(self._buf) - self._i > self.max_item:
+            raise IngestError(f"JSON value larger than {self.max_item // 1024} KB (or malformed JSON)")
+
+    def _ws(self):
+        buf, i = self._buf, self._i
+        while i < len(buf) and buf[i] in " \t\r\n":
+            i += 1
+        self._i = i
+        return buf[i] if i < len(buf) else ""
+
+    def _value(self, final: bool):
+        """Следующее JSON-значение или None, если данных пока не хватает."""
+        try:
+            val, end = self._dec.raw_decode(self._buf, self._i)
+        except json.JSONDecodeError as e:
+            if final:
+                raise IngestError(f"bad JSON: {e}")
+            return None
+        if end == len(self._buf) and not final:
+            return None   # число/литерал на краю куска может продолжиться
+        self._i = end
+        return (val,)
+
+    def _parse(self, final: bool, out: list):
+        while True:
+            c = self._ws()
+            if not c:
+                return
+            st = self._state
+            if st == "start":
+                if c != "{":
+                    raise IngestError('expected JSON object {"rules": [...]}')
+                self._i += 1; self._state = "key"
+            elif st == "key":
+                if c in ",":
+                    self._i += 1; continue
+                if c == "}":
+                    self._i += 1; self._state = "done"; continue
+                v = self._value(final)
+                if v is None:
+                    return
+                self._key = v[0]; self._state = "colon"
+            elif st == "colon":
+                if c != ":":
+                    raise IngestError("bad JSON: ':' expected")
+                self._i += 1; self._state = "value"
+            elif st == "value":
+                if self._key in ("rules", "items") and not self._taken and c == "[":
+                    self._i += 1; self._state = "array"; continue
+                v = self._value(final)   # прочие ключи (и второй массив) — пропускаем целиком
+                if v is None:
+                    return
+                self._state = "key"
+            elif st == "array":
+                if c == ",":
+                    self._i += 1; continue
+                if c == "]":
+                    self._i += 1; self._state = "key"; continue
+                v = self._value(final)
+                if v is None:
+                    return
+                self._taken = True
+                out.append(v[0])
+            else:   # done: после объекта допускаем только пробелы
+                raise IngestError("bad JSON: trailing data")
+
+UpsertFn = Callable[[List[Dict], dict], Awaitable[None]]
+
+async def ingest(chunks: AsyncIterable[bytes], upsert: UpsertFn, batch_size: int = INGEST_BATCH,
+                 batch_chars: int = INGEST_BATCH_CHARS, concurrency: int = INGEST_CONCURRENCY) -> dict:
+    """Разобрать поток, отвалидировать, сдедуплицировать по id и залить пачками через upsert(batch, timings).
+    Чтение тела ждёт, пока в работе больше `concurrency` пачек (обратное давление вместо роста памяти)."""
+    t0 = time.perf_counter()
+    stream = RulesStream()
+    seen: set = set()
+    rep = {"received": 0, "accepted": 0, "invalid": 0, "duplicates": 0}
+    batches: List[dict] = []
+    pending: set = set()
+    cur: List[Dict] = []; cur_chars = 0
+
+    async def _run(no: int, batch: List[Dict]) -> dict:
+        tm: dict = {}
+        t = time.perf_counter()
+        res = {"batch": no, "n": len(batch)}
+        try:
+            await upsert(batch, tm)
+            res["ok"] = True
+        except Exception as e:
+            log.warning(f"ingest: batch {no} ({len(batch)}) failed: {e!r}")
+            res.update(ok=False, error=str(e)[:300])
+        res["ms"] = round((time.perf_counter() - t) * 1000, 1)
+        res.update({k: round(v, 1) for k, v in tm.items()})
+        return res
+
+    async def _submit():
+        nonlocal cur, cur_chars
+        if not cur:
+            return
+        while len(pending) >= concurrency:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for d in done:
+                pending.discard(d); batches.append(d.result())
+        pending.add(asyncio.create_task(_run(len(batches) + len(pending) + 1, cur)))
+        cur, cur_chars = [], 0
+
+    async def _take(items: list):
+        nonlocal cur_chars
+        for raw in items:
+            rep["received"] += 1
+            r = normalize_item(raw)
+            if r is None:
+                rep["invalid"] += 1; continue
+            if r["id"] in seen:
+                rep["duplicates"] += 1; continue
+            seen.add(r["id"])
+            rep["accepted"] += 1
+            if cur and (len(cur) >= batch_size or cur_chars + len(r["rule_brief"]) > batch_chars):
+                await _submit()
+            cur.append(r); cur_chars += len(r["rule_brief"])
+
+    try:
+        async for chunk in chunks:
+            await _take(stream.feed(chunk))
+        await _take(stream.close())
+        await _submit()
+    finally:
+        if pending:
+            for d in (await asyncio.wait(pending))[0]:
+                batches.append(d.result())
+    batches.sort(key=lambda b: b["batch"])
+    rep.update(
+        ok=all(b["ok"] for b in batches),
+        upserted=sum(b["n"] for b in batches if b["ok"]),
+        failed=sum(b["n"] for b in batches if not b["ok"]),
+        bytes_in=stream.bytes_in, bytes_json=stream.bytes_raw, gzip=stream._inflate is not None,
+        ms=round((time.perf_counter() - t0) * 1000, 1), batches=batches,
+    )
+    return rep
@@ -0,0 +1,224 @@
+# services/llm_sched.py — диспетчер вызовов LLM: лимиты параллельности (на модель и общий), классы приоритета,
+# честная очередь по пользователям внутри класса, позиция в очереди для спиннера.
+# Классы: админ > Pro/кредит > Free > уточнение. Строгий приоритет смягчён «старением»: каждые LLM_AGING_SEC
+# ожидания поднимают заявку на класс — Free не голодает, пока Pro льётся потоком.
+# Всё на event loop (без потоков): состояние меняется только в корутинах и колбэках loop.
+from __future__ import annotations
+import os, time, asyncio, logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional
+
+from services.metrics import REGISTRY
+
+log = logging.getLogger("gotovo-bot")
+
+PRIO_ADMIN, PRIO_PRO, PRIO_FREE, PRIO_FOLLOWUP = range(4)
+PRIO_NAMES = ("admin", "pro", "free", "followup")
+
+LLM_CONCURRENCY = max(1, int(os.getenv("LLM_CONCURRENCY", "16")))       # всего запросов к OpenAI одновременно
+LLM_MODEL_CONCURRENCY = max(1, int(os.getenv("LLM_MODEL_CONCURRENCY", "8")))   # на модель по умолчанию
+LLM_MODEL_CAPS = os.getenv("LLM_MODEL_CAPS", "gpt-4o=4,o4-mini=4")     # "модель=лимит,…" (тяжёлые — меньше)
+LLM_QUEUE_MAX = max(0, int(os.getenv("LLM_QUEUE_MAX", "200")))         # ждущих сверх работающих, дальше — отказ
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))        # сек в очереди
+LLM_AGING_SEC = float(os.getenv("LLM_AGING_SEC", "15"))                # 0 — строгий приоритет
+
+LLM_QUEUE_SECONDS = REGISTRY.histogram("llm_queue_seconds", "Wait for an LLM slot (before the model call)", ("model", "prio"))
+LLM_QUEUE_DEPTH = REGISTRY.gauge("llm_queue_depth", "LLM requests waiting for a slot", ("model", "prio"))
+LLM_QUEUE_DROPS = REGISTRY.counter("llm_queue_drops", "LLM requests not admitted", ("reason",))
+
+class LlmBusy(Exception):
+    """Очередь LLM переполнена или ожидание вышло за LLM_QUEUE_TIMEOUT — просим повторить позже."""
+
+def _parse_caps(s: str) -> Dict[str, int]:
+    caps = {}
+    for part in (s or "").split(","):
+        k, _, v = part.partition("=")
+        if k.strip() and v.strip().isdigit():
+            caps[k.strip()] = max(1, int(v))
+    return caps
+
+class _Waiter:
+    __slots__ = ("uid", "prio", "t", "fut", "on_queue", "pos")
+
+    def __init__(self, uid: int, prio: int, fut: asyncio.Future, on_queue: Optional[Callable[[int], None]]):
+        self.uid = uid; self.prio = prio; self.fut = fut; self.on_queue = on_queue
+        self.t = time.monotonic(); self.pos = 0
+
+class _Lane:
+    """Одна модель: лимит, занятые слоты и по классу — очередь пользователей (round-robin) с их заявками."""
+    def __init__(self, model: str, cap: int):
+        self.model = model; self.cap = cap
+        self.running = 0; self.waiting = 0
+        self.classes = [OrderedDict() for _ in PRIO_NAMES]   # uid → deque[_Waiter]
+
+class LlmScheduler:
+    def __init__(self, total: int = LLM_CONCURRENCY, per_model: int = LLM_MODEL_CONCURRENCY, caps: str = LLM_MODEL_CAPS,
+                 queue_max: int = LLM_QUEUE_MAX, wait_timeout: float = LLM_QUEUE_TIMEOUT, aging: float = LLM_AGING_SEC):
+        self.total = total; self.per_model = per_model; self.caps = _parse_caps(caps)
+        self.queue_max = queue_max; self.wait_timeout = wait_timeout; self.aging = aging
+        self._lanes: Dict[str, _Lane] = {}
+        self.running = 0; self.waiting = 0
+        # счётчики (читаются из /stats.json и админки)
+        self.admitted = [0] * len(PRIO_NAMES)
+        self.queued = [0] * len(PRIO_NAMES)      # сколько из них реально ждали
+        self.wait_sum = [0.0] * len(PRIO_NAMES)
+        self.wait_max = [0.0] * len(PRIO_NAMES)
+        self.max_waiting = 0
+        self.rejected = 0; self.timeouts = 0; self.cancelled = 0
+
+    def _lane(self, model: str) -> _Lane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            lane = self._lanes[model] = _Lane(model, self.caps.get(model, self.per_model))
+        return lane
+
+    # ---------- выбор следующей заявки ----------
+    def _head(self, lane: _Lane, now: float):
+        """Лучший класс дорожки: (ключ, класс). Ключ = класс минус «возраст» старейшей заявки в нём."""
+        best = None
+        for i, cls in enumerate(lane.classes):
+            if not cls:
+                continue
+            t = min(q[0].t for q in cls.values())
+            eff = i - (now - t) / self.aging if self.aging > 0 else i
+            if best is None or (eff, t) < best[0]:
+                best = ((eff, t), i)
+        return best
+
+    def _pop(self, lane: _Lane, i: int) -> _Waiter:
+        cls = lane.classes[i]
+        uid, q = next(iter(cls.items()))   # round-robin: первый пользователь отдаёт одну заявку и уходит в хвост
+        w = q.popleft()
+        if q:
+            cls.move_to_end(uid)
+        else:
+            del cls[uid]
+        lane.waiting -= 1; self.waiting -= 1
+        return w
+
+    def _remove(self, lane: _Lane, w: _Waiter):
+        cls = lane.classes[w.prio]
+        q = cls.get(w.uid)
+        if q is None or w not in q:
+            return
+        q.remove(w)
+        if not q:
+            del cls[w.uid]
+        lane.waiting -= 1; self.waiting -= 1
+
+    def _dispatch(self):
+        now = time.monotonic()
+        touched = set()
+        while self.running < self.total:
+            best = None
+            for lane in self._lanes.values():
+                if lane.waiting and lane.running < lane.cap:
+                    h = self._head(lane, now)
+                    if h and (best is None or h[0] < best[0]):
+                        best = (h[0], lane, h[1])
+            if best is None:
+                break
+            _, lane, i = best
+            w = self._pop(lane, i)
+            if w.fut.done():       # отменённый, но ещё не убранный — пропускаем
+                continue
+            lane.running += 1; self.running += 1
+            w.fut.set_result(None)
+            touched.add(lane)
+        for lane in touched:
+            self._notify(lane)
+
+    # ---------- позиции и метрики ----------
+    def _notify(self, lane: _Lane):
+        """Позиция каждой ждущей заявки при текущем порядке (классы по старшинству, внутри — round-robin)."""
+        base = 0
+        for i, cls in enumerate(lane.classes):
+            queues = list(cls.values())
+            lens = [len(q) for q in queues]
+            for k, q in enumerate(queues):
+                for r, w in enumerate(q):
+                    if w.on_queue is None:
+                        continue
+                    # до заявки №r пользователя k каждый пользователь выше по кругу отдаст r+1, ниже — r
+                    pos = base + sum(min(n, r + (j < k)) for j, n in enumerate(lens)) + 1
+                    if pos != w.pos:
+                        w.pos = pos
+                        try: w.on_queue(pos)
+                        except Exception: pass
+            base += sum(lens)
+            LLM_QUEUE_DEPTH.set(sum(lens), model=lane.model, prio=PRIO_NAMES[i])
+
+    # ---------- API ----------
+    async def acquire(self, model: str, prio: int = PRIO_FREE, uid: int = 0,
+                      on_queue: Optional[Callable[[int], None]] = None) -> float:
+        """Ждать слот модели → секунды в очереди. После вызова — обязательно release(model).
+        on_queue(pos) — позиция (1 = следующий); 0 — слот получен. LlmBusy — очередь полна / долгое ожидание."""
+        prio = min(max(int(prio), 0), len(PRIO_NAMES) - 1)
+        lane = self._lane(model)
+        if self.waiting >= self.queue_max and (self.running >= self.total or lane.running >= lane.cap):
+            self.rejected += 1
+            LLM_QUEUE_DROPS.inc(reason="full")
+            raise LlmBusy(f"LLM queue full ({self.waiting})")
+        w = _Waiter(uid, prio, asyncio.get_running_loop().create_future(), on_queue)
+        lane.classes[prio].setdefault(uid, deque()).append(w)
+        lane.waiting += 1; self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        self._dispatch()
+        queued = not w.fut.done()
+        if queued:
+            self._notify(lane)
+            try:
+                await asyncio.wait_for(asyncio.shield(w.fut), timeout=self.wait_timeout)
+            except BaseException as e:
+                if w.fut.done() and not w.fut.cancelled():
+                    self.release(model)   # слот выдан в тот же момент — возвращаем
+                else:
+                    w.fut.cancel()
+                    self._remove(lane, w)
+                    self._notify(lane)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                    LLM_QUEUE_DROPS.inc(reason="timeout")
+                    raise LlmBusy(f"LLM queue wait timeout ({self.wait_timeout:.0f}s)") from None
+                self.cancelled += 1
+                raise
+        waited = time.monotonic() - w.t
+        self.admitted[prio] += 1
+        self.queued[prio] += queued
+        self.wait_sum[prio] += waited
+        self.wait_max[prio] = max(self.wait_max[prio], waited)
+        LLM_QUEUE_SECONDS.observe(waited, model=model, prio=PRIO_NAMES[prio])
+        if queued and on_queue is not None:
+            try: on_queue(0)
+            except Exception: pass
+        return waited
+
+    def release(self, model: str):
+        lane = self._lane(model)
+        lane.running -= 1; self.running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, model: str, prio: int = PRIO_FREE, uid: int = 0,
+                   on_queue: Optional[Callable[[int], None]] = None):
+        """async with llm_sched.slot(model, prio, uid) as waited: …"""
+        waited = await self.acquire(model, prio, uid, on_queue)
+        try:
+            yield waited
+        finally:
+            self.release(model)
+
+    def stats(self) -> dict:
+        return {
+            "total": self.total, "per_model": self.per_model, "caps": self.caps, "queue_max": self.queue_max,
+            "running": self.running, "waiting": self.waiting, "max_waiting": self.max_waiting,
+            "rejected": self.rejected, "timeouts": self.timeouts, "cancelled": self.cancelled,
+            "models": {m: {"cap": l.cap, "running": l.running, "waiting": l.waiting} for m, l in self._lanes.items()},
+            "prio": {n: {"admitted": self.admitted[i], "queued": self.queued[i],
+                         "wait_avg": round(self.wait_sum[i] / max(1, self.admitted[i]), 3),
+                         "wait_max": round(self.wait_max[i], 3)}
+                     for i, n in enumerate(PRIO_NAMES)},
+        }
+
+llm_sched = LlmScheduler()
@@ -0,0 +1,183 @@
+# services/metrics.py — реестр метрик в формате Prometheus (text exposition 0.0.4) для GET /metrics
+# Без внешних зависимостей: гистограммы/счётчики/гейджи с метками, потокобезопасно (OCR-колбэки, поток ВБД, sqlite).
+from __future__ import annotations
+import math, threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+PREFIX = "gotovo_"
+
+# секунды: от единиц мс (sqlite, кэш) до десятков секунд (LLM, OCR)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+def _labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple, object] = {}
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n: float = 1, **labels):
+        k = self._key(labels)
+        with self._lock:
+            self._series[k] = self._series.get(k, 0) + n
+
+    def render(self) -> list:
+        with self._lock:
+            items = list(self._series.items())
+        return self.header() + [f"{self.name}_total{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+class Gauge(_Metric):
+    """set/inc/dec или fn — значение считается в момент выдачи /metrics (глубина очередей и т.п.)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+
+    def set(self, v: float, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = v
+
+    def inc(self, n: float = 1, **labels):
+        k = self._key(labels)
+        with self._lock:
+            self._series[k] = self._series.get(k, 0) + n
+
+    def dec(self, n: float = 1, **labels):
+        self.inc(-n, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def render(self) -> list:
+        if self.fn is not None:
+            try:
+                items = [((), self.fn())]
+            except Exception:
+                items = []
+        else:
+            with self._lock:
+                items = list(self._series.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, v: float, **labels):
+        k = self._key(labels)
+        i = bisect_left(self.buckets, v)   # le-семантика: v == граница попадает в эту корзину
+        with self._lock:
+            s = self._series.get(k)
+            if s is None:
+                s = self._series[k] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1; s[1] += v; s[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - t0, **labels)
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(k, (list(s[0]), s[1], s[2])) for k, s in self._series.items()]
+        out = self.header()
+        for k, (counts, total, n) in items:
+            acc = 0
+            for le, c in zip(self.buckets + (math.inf,), counts):
+                acc += c
+                le_label = 'le="%s"' % _fmt(le)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, k, le_label)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, k)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, k)} {n}")
+        return out
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, m: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(m.name, m)
+
+    def counter(self, name: str, doc: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, doc, labels))  # type: ignore[return-value]
+
+    def gauge(self, name: str, doc: str, labels: Sequence[str] = (), fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(name, doc, labels, fn))  # type: ignore[return-value]
+
+    def histogram(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, doc, labels, buckets))  # type: ignore[return-value]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: list = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Метка «какой хэндлер сейчас работает» — ставится на апдейт в bot.py, наследуется в asyncio.to_thread
+HANDLER: ContextVar[str] = ContextVar("metrics_handler", default="background")
+
+# ---------- Метрики конвейера (общие для bot.py, rag_vdb.py, services/*) ----------
+LLM_SECONDS = REGISTRY.histogram("llm_request_seconds", "LLM call latency (full answer)", ("model", "tag", "kind", "status"))
+LLM_TTFT_SECONDS = REGISTRY.histogram("llm_ttft_seconds", "LLM time to first streamed token", ("model", "tag"))
+OCR_SECONDS = REGISTRY.histogram("ocr_image_seconds", "ocr_image duration inside the worker", ("backend",))
+OCR_WAIT_SECONDS = REGISTRY.histogram("ocr_queue_wait_seconds", "Wait for a free OCR worker")
+OCR_ATTEMPTS = REGISTRY.histogram("ocr_image_attempts", "Tesseract passes per image", (), (1, 2, 3, 4, 6, 8, 12, 16))
+OCR_JOBS = REGISTRY.counter("ocr_jobs", "OCR jobs by outcome", ("status",))
+VDB_EMBED_SECONDS = REGISTRY.histogram("vdb_embed_seconds", "Query embedding time in search_rules (incl. cache)", ("source",))
+VDB_SEARCH_SECONDS = REGISTRY.histogram("vdb_search_seconds", "Qdrant query time in search_rules", ("op",))
+DB_SECONDS = REGISTRY.histogram("db_seconds", "SQLite (app.db) time per transaction", ("handler",))
+TG_SECONDS = REGISTRY.histogram("telegram_request_seconds", "Bot API request latency", ("method", "status"))
+UPDATE_SECONDS = REGISTRY.histogram("update_seconds", "Update handling time end to end", ("handler",))
+UPDATES_INFLIGHT = REGISTRY.gauge("updates_inflight", "Updates being handled right now")
+LLM_INFLIGHT = REGISTRY.gauge("llm_inflight", "LLM requests in flight", ("model",))
+LLM_TOKENS = REGISTRY.counter("llm_tokens", "LLM tokens from resp.usage", ("model", "type"))   # prompt|cached|completion
+LLM_COST_USD = REGISTRY.counter("llm_cost_usd", "LLM cost by the price table in services/usage.py", ("model", "mode"))
@@ -0,0 +1,91 @@
+# services/metrics_log.py — журнал метрик только на дозапись (JSON Lines) + периодическое сжатие
+# Строка = полное состояние одного изменившегося пользователя {"uid": ..., ...}; при чтении побеждает последняя.
+# Автосохранение пишет только изменившихся (стоимость ~ активности), сжатие переписывает файл снимком (~ редко).
+from __future__ import annotations
+import os, json, logging, tempfile
+from typing import Iterable
+
+log = logging.getLogger("gotovo-bot")
+
+try:
+    import orjson  # type: ignore
+    def _dumps(o) -> bytes: return orjson.dumps(o)
+    _loads = orjson.loads
+except Exception:
+    def _dumps(o) -> bytes: return json.dumps(o, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    _loads = json.loads
+
+METRICS_LOG_MAX_MB = float(os.getenv("METRICS_LOG_MAX_MB", "16"))
+METRICS_LOG_SLACK = float(os.getenv("METRICS_LOG_SLACK", "4"))   # сжимать, когда строк > SLACK × пользователей
+
+class MetricsLog:
+    def __init__(self, path: str):
+        self.path = path
+        self.lines = 0          # строк в файле (после replay/append/compact)
+        self.bytes = 0
+        self.appends = 0; self.compactions = 0
+
+    def replay(self) -> dict[int, dict]:
+        """Прочитать журнал: {uid: последняя запись}. Битую хвостовую строку (обрыв записи) пропускаем."""
+        out: dict[int, dict] = {}
+        if not os.path.exists(self.path):
+            return out
+        n = bad = 0; torn = b""
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    torn = line   # запись оборвалась посреди строки — дальше отрежем
+                    break
+                n += 1
+                try:
+                    rec = _loads(line)
+                    out[int(rec["uid"])] = rec
+                except Exception:
+                    bad += 1
+        if torn:
+            # без обрезки следующая дозапись прилипла бы к обрывку и тоже пропала бы
+            os.truncate(self.path, os.path.getsize(self.path) - len(torn))
+            log.warning(f"metrics log: dropped torn tail ({len(torn)} bytes)")
+        self.lines = n
+        self.bytes = os.path.getsize(self.path)
+        if bad:
+            log.warning(f"metrics log: skipped {bad} broken lines")
+        return out
+
+    def append(self, records: Iterable[dict]) -> int:
+        data = b"".join(_dumps(r) + b"\n" for r in records)
+        if not data:
+            return 0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        cnt = data.count(b"\n")
+        self.lines += cnt; self.bytes += len(data); self.appends += 1
+        return cnt
+
+    def needs_compaction(self, users: int) -> bool:
+        return (self.lines > METRICS_LOG_SLACK * max(users, 256)) or (self.bytes > METRICS_LOG_MAX_MB * 1024 * 1024)
+
+    def compact(self, records: Iterable[dict]):
+        """Переписать журнал снимком (по строке на пользователя) атомарно через временный файл."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".metrics.", suffix=".tmp")
+        n = size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for r in records:
+                    b = _dumps(r) + b"\n"
+                    f.write(b); n += 1; size += len(b)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                try: os.remove(tmp)
+                except Exception: pass
+        self.lines = n; self.bytes = size; self.compactions += 1
+
+    def stats(self) -> dict:
+        return {"lines": self.lines, "bytes": self.bytes, "appends": self.appends, "compactions": self.compactions}
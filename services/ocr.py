@@ -0,0 +1,210 @@
+# services/ocr.py — OCR-пайплайн (Tesseract). Выполняется в воркерах пула (services/ocr_pool.py)
+# Схема: предобработка один раз → OSD (ориентация + письменность) один раз → 1 целевой проход Tesseract,
+# дальше — короткая лестница фолбэков (не более OCR_MAX_PASSES проходов вместо 4 углов × 4 языка).
+# Сам Tesseract — через бэкенд воркера (services/ocr_backend.py): по умолчанию движок tesserocr в памяти.
+from __future__ import annotations
+import io, os, time
+from time import perf_counter
+from typing import Optional
+from PIL import Image, ImageOps, ImageEnhance
+import pytesseract
+from services.ocr_backend import get_backend, fallback_backend, OcrDeadline
+
+# === Анти-OOM настройки изображений (действуют и в воркерах) ===
+Image.MAX_IMAGE_PIXELS = 24_000_000  # ~24 мегапикселя
+TESS_LANGS_DEFAULT = "rus+eng"
+TESS_LANGS = os.getenv("TESS_LANGS", TESS_LANGS_DEFAULT)
+TESS_CONFIG = os.getenv("TESS_CONFIG", "--oem 3 --psm 6 -c preserve_interword_spaces=1")
+
+OCR_DETECT = os.getenv("OCR_DETECT", "true").lower() == "true"   # false → старый перебор углов/языков
+OCR_MAX_PASSES = max(1, int(os.getenv("OCR_MAX_PASSES", "3")))
+OSD_MIN_CONF = float(os.getenv("OCR_OSD_MIN_CONF", "1.5"))       # ниже — ориентации не доверяем
+OCR_MIN_CONF = float(os.getenv("OCR_MIN_CONF", "60"))            # ниже — идём дальше по лестнице, храним лучший
+# Предобработка (подбирается по scripts/bench_ocr.py — CER/время на размеченном корпусе)
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "1800"))
+OCR_AUTOCONTRAST = os.getenv("OCR_AUTOCONTRAST", "true").lower() == "true"
+OCR_SHARPNESS = float(os.getenv("OCR_SHARPNESS", "1.1"))           # 1.0 — без изменений
+
+# Подсказки: язык пользователя (USER_LANG) и предмет (USER_SUBJECT)
+_HINT_LANGS = {"ru": "rus", "be": "bel", "en": "eng", "de": "deu", "fr": "fra"}
+_SUBJECT_LANGS = {"английский": "eng", "беларуская мова": "bel", "беларуская літаратура": "bel"}
+
+def _preprocess_image(img: Image.Image) -> Image.Image:
+    img = ImageOps.exif_transpose(img)
+    max_side = OCR_MAX_SIDE
+    if max(img.width, img.height) > max_side:
+        scale = max_side / max(img.width, img.height)
+        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+    img = img.convert("L")
+    if OCR_AUTOCONTRAST:
+        img = ImageOps.autocontrast(img)
+    if OCR_SHARPNESS != 1.0:
+        img = ImageEnhance.Sharpness(img).enhance(OCR_SHARPNESS)
+    return img
+
+def _remaining(deadline: Optional[float]) -> float:
+    """Сколько секунд осталось до дедлайна (0 — дедлайна нет)."""
+    if deadline is None:
+        return 0
+    left = deadline - time.time()
+    if left <= 0:
+        raise OcrDeadline()
+    return left
+
+# ---------- Языки ----------
+_INSTALLED: Optional[set] = None
+
+def installed_langs() -> set:
+    """Установленные traineddata (кэшируется на время жизни воркера); пусто — не удалось узнать."""
+    global _INSTALLED
+    if _INSTALLED is None:
+        try:
+            _INSTALLED = get_backend().languages()
+        except Exception:
+            _INSTALLED = set()
+    return _INSTALLED
+
+def _only_installed(langs: str) -> str:
+    have = installed_langs()
+    if not have:
+        return langs
+    parts = [x for x in langs.split("+") if x in have]
+    return "+".join(parts) if parts else TESS_LANGS
+
+def pick_langs(script: Optional[str], lang_hint: Optional[str] = None, subject_hint: Optional[str] = None) -> str:
+    hint = _HINT_LANGS.get((lang_hint or "").strip().lower())
+    subj = _SUBJECT_LANGS.get((subject_hint or "").strip().lower())
+    if script == "Cyrillic":
+        main = "bel" if "bel" in (subj, hint) else "rus"
+        langs = f"{main}+eng"  # обозначения/формулы латиницей
+    elif script == "Latin":
+        langs = hint if hint in ("deu", "fra") and subj != "eng" else "eng"
+    elif subj:
+        langs = f"{subj}+rus"
+    elif hint in ("rus", "bel"):
+        langs = f"{hint}+eng"
+    elif hint:
+        langs = hint
+    else:
+        langs = TESS_LANGS
+    return _only_installed(langs)
+
+# ---------- Стадия детекции ----------
+def detect_osd(img: Image.Image, deadline: Optional[float] = None) -> Optional[dict]:
+    """Ориентация и письменность за один прогон OSD. None — текста слишком мало/OSD недоступен."""
+    osd = get_backend().osd(img, timeout=_remaining(deadline))
+    if osd and osd["script_conf"] < 0.5:
+        osd["script"] = None
+    return osd
+
+def plan_passes(osd: Optional[dict], lang_hint: Optional[str] = None, subject_hint: Optional[str] = None) -> list[tuple[int, str]]:
+    """Ограниченная лестница (угол, языки): первый элемент — целевой проход."""
+    fallback_langs = _only_installed(TESS_LANGS) if TESS_LANGS else pick_langs(None, lang_hint, subject_hint)
+    if osd:
+        angle = osd["rotate"]
+        langs = pick_langs(osd["script"], lang_hint, subject_hint)
+        passes = [(angle, langs), (angle, fallback_langs)]
+        if osd["orientation_conf"] < OSD_MIN_CONF:
+            passes.append(((angle + 180) % 360, langs))
+    else:
+        langs = pick_langs(None, lang_hint, subject_hint)
+        passes = [(0, langs), (0, fallback_langs), (90, langs), (270, langs), (180, langs)]
+    out = []
+    for p in passes:
+        if p not in out:
+            out.append(p)
+    return out[:OCR_MAX_PASSES]
+
+# ---------- Проходы Tesseract ----------
+def _tess(img: Image.Image, langs: str, deadline: Optional[float]) -> tuple[str, Optional[float]]:
+    """Один проход: (текст, средняя уверенность или None, если бэкенд её не даёт)."""
+    timeout = _remaining(deadline)
+    be = get_backend()
+    try:
+        txt = be.image_to_string(img, langs, TESS_CONFIG, timeout=timeout)
+    except RuntimeError:
+        # движок не поднял этот набор языков — проход через pytesseract
+        be = fallback_backend()
+        txt = be.image_to_string(img, langs, TESS_CONFIG, timeout=timeout)
+    return (txt or "").strip(), be.last_conf
+
+def _rotated(base: Image.Image, angle: int) -> Image.Image:
+    return base.rotate(-angle, expand=True) if angle else base  # кратные 90° — без потерь
+
+def ocr_image_ex(img: Image.Image, deadline: Optional[float] = None, lang_hint: Optional[str] = None,
+                 subject_hint: Optional[str] = None, detect: Optional[bool] = None) -> dict:
+    """Распознать и вернуть текст вместе с деталями прогона (проходы, OSD, время)."""
+    detect = OCR_DETECT if detect is None else detect
+    if not detect:
+        return ocr_image_bruteforce(img, deadline=deadline)
+    t0 = perf_counter()
+    info = {"text": "", "passes": 0, "osd": None, "osd_ms": 0.0, "angle": None, "langs": None, "conf": None, "ms": 0.0}
+    try:
+        base = _preprocess_image(img)
+        t_osd = perf_counter()
+        osd = detect_osd(base, deadline)
+        info["osd"] = osd; info["osd_ms"] = (perf_counter() - t_osd) * 1000
+        best = -1.0
+        for angle, langs in plan_passes(osd, lang_hint, subject_hint):
+            info["passes"] += 1
+            txt, conf = _tess(_rotated(base, angle), langs, deadline)
+            if not txt:
+                continue
+            score = 100.0 if conf is None else conf
+            if score > best:
+                best = score
+                info.update(text=txt, angle=angle, langs=langs, conf=conf)
+            if score >= OCR_MIN_CONF:
+                break
+    except OcrDeadline:
+        pass
+    info["ms"] = (perf_counter() - t0) * 1000
+    return info
+
+def ocr_image_bruteforce(img: Image.Image, deadline: Optional[float] = None) -> dict:
+    """Прежняя стратегия: 4 угла × цепочка языков. Оставлена для OCR_DETECT=false и бенчмарка."""
+    t0 = perf_counter()
+    info = {"text": "", "passes": 0, "osd": None, "osd_ms": 0.0, "angle": None, "langs": None, "conf": None, "ms": 0.0}
+    base = ImageOps.exif_transpose(img)
+    langs_chain = [TESS_LANGS, "rus", "eng", "bel"] if TESS_LANGS else ["rus", "eng", "bel"]
+
+    def _ladder():
+        for angle in (0, 90, 180, 270):
+            p = _preprocess_image(base.rotate(-angle, expand=True))
+            for langs in langs_chain:
+                info["passes"] += 1
+                txt, _ = _tess(p, langs, deadline)
+                if txt:
+                    info.update(text=txt, angle=angle, langs=langs)
+                    return
+    try:
+        _ladder()
+    except OcrDeadline:
+        pass
+    info["ms"] = (perf_counter() - t0) * 1000
+    return info
+
+def ocr_image(img: Image.Image, deadline: Optional[float] = None, lang_hint: Optional[str] = None,
+              subject_hint: Optional[str] = None) -> str:
+    return ocr_image_ex(img, deadline=deadline, lang_hint=lang_hint, subject_hint=subject_hint)["text"]
+
+def ocr_bytes(data: bytes, deadline: Optional[float] = None, lang_hint: Optional[str] = None,
+              subject_hint: Optional[str] = None) -> dict:
+    """Точка входа воркера: сырые байты → {text, passes, osd, ...}. Декодирование тоже вне event loop."""
+    img = Image.open(io.BytesIO(data))
+    try:
+        info = ocr_image_ex(img, deadline=deadline, lang_hint=lang_hint, subject_hint=subject_hint)
+    except pytesseract.TesseractNotFoundError as e:
+        # исключение pytesseract не переживает pickle между процессами → отдаём обычное
+        raise RuntimeError(str(e)) from None
+    be = get_backend()
+    info.update(backend=be.name, model_loads=be.model_loads)
+    return info
+
+def init_worker():
+    """Инициализатор процесса пула: бэкенд и список языков — один раз на жизнь воркера."""
+    get_backend()
+    installed_langs()
+
+def warmup() -> bool:
+    return True
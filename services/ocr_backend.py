@@ -0,0 +1,206 @@
+# services/ocr_backend.py — бэкенды Tesseract для OCR-воркеров
+# tesserocr: долгоживущий движок libtesseract в процессе воркера (модели грузятся один раз, картинка — буфером в памяти)
+# pytesseract: запасной вариант (subprocess + временный файл на каждый вызов)
+from __future__ import annotations
+import os, shlex, logging
+from collections import OrderedDict
+from typing import Optional
+from PIL import Image
+import pytesseract
+from pytesseract import TesseractError
+
+log = logging.getLogger("gotovo-bot")
+
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto").strip().lower()      # auto | tesserocr | pytesseract
+OCR_ENGINE_CACHE = max(1, int(os.getenv("OCR_ENGINE_CACHE", "3")))  # сколько наборов языков держать загруженными
+TESSDATA_DIR = os.getenv("TESSDATA_DIR", "")
+_TESSDATA_CANDIDATES = ("/usr/share/tesseract-ocr/5/tessdata/", "/usr/share/tesseract-ocr/4.00/tessdata/",
+                        "/usr/share/tessdata/", "/usr/local/share/tessdata/")
+
+try:
+    import tesserocr  # type: ignore
+    from tesserocr import PyTessBaseAPI, PSM  # type: ignore
+except Exception:
+    tesserocr = None
+
+class OcrDeadline(Exception):
+    """Проход не уложился в отведённое время."""
+
+def parse_tess_config(config: str) -> tuple[Optional[int], Optional[int], dict]:
+    """'--oem 3 --psm 6 -c k=v' → (oem, psm, {k: v}) для движка tesserocr."""
+    oem = psm = None; variables = {}
+    parts = shlex.split(config or "")
+    i = 0
+    while i < len(parts):
+        p = parts[i]
+        nxt = parts[i + 1] if i + 1 < len(parts) else ""
+        if p == "--oem" and nxt.isdigit():
+            oem = int(nxt); i += 2; continue
+        if p == "--psm" and nxt.isdigit():
+            psm = int(nxt); i += 2; continue
+        if p == "-c" and "=" in nxt:
+            k, v = nxt.split("=", 1); variables[k] = v; i += 2; continue
+        i += 1
+    return oem, psm, variables
+
+class OcrBackend:
+    name = "base"
+    def __init__(self):
+        self.calls = 0        # проходов распознавания
+        self.osd_calls = 0    # вызовов OSD (ориентация/письменность)
+        self.model_loads = 0  # загрузок traineddata
+        self.last_conf: Optional[float] = None  # средняя уверенность последнего прохода (если бэкенд умеет)
+    def languages(self) -> set:
+        raise NotImplementedError
+    def osd(self, img: Image.Image, timeout: float = 0) -> Optional[dict]:
+        raise NotImplementedError
+    def image_to_string(self, img: Image.Image, langs: str, config: str, timeout: float = 0) -> str:
+        raise NotImplementedError
+
+class PytesseractBackend(OcrBackend):
+    name = "pytesseract"
+
+    def languages(self) -> set:
+        return set(pytesseract.get_languages(config=""))
+
+    def osd(self, img, timeout=0):
+        self.osd_calls += 1; self.model_loads += 1
+        try:
+            d = pytesseract.image_to_osd(img, output_type=pytesseract.Output.DICT,
+                                         config="-c min_characters_to_try=10", timeout=timeout)
+        except (TesseractError, ValueError):
+            return None
+        except RuntimeError:
+            raise OcrDeadline()
+        return {
+            "rotate": int(d.get("rotate", 0) or 0) % 360,
+            "orientation_conf": float(d.get("orientation_conf", 0) or 0),
+            "script": str(d.get("script") or ""),
+            "script_conf": float(d.get("script_conf", 0) or 0),
+        }
+
+    def image_to_string(self, img, langs, config, timeout=0):
+        self.calls += 1; self.model_loads += 1; self.last_conf = None
+        try:
+            return pytesseract.image_to_string(img, lang=langs, config=config, timeout=timeout) or ""
+        except TesseractError:
+            return ""
+        except RuntimeError:
+            # pytesseract убивает tesseract по таймауту
+            raise OcrDeadline()
+
+class TesserocrBackend(OcrBackend):
+    """Движки PyTessBaseAPI живут столько же, сколько воркер; LRU по набору языков."""
+    name = "tesserocr"
+
+    def __init__(self, path: str = ""):
+        super().__init__()
+        self.path = path or self._find_tessdata()
+        self._engines: "OrderedDict[tuple, PyTessBaseAPI]" = OrderedDict()
+        self._osd_api = None
+        self._osd_broken = False
+
+    @staticmethod
+    def _find_tessdata() -> str:
+        if TESSDATA_DIR:
+            return TESSDATA_DIR.rstrip("/") + "/"
+        prefix = os.getenv("TESSDATA_PREFIX", "")
+        for p in ((prefix.rstrip("/") + "/") if prefix else "",) + _TESSDATA_CANDIDATES:
+            if p and os.path.isdir(p) and tesserocr.get_languages(p)[1]:
+                return p
+        return tesserocr.get_languages()[0]
+
+    def languages(self) -> set:
+        return set(tesserocr.get_languages(self.path)[1])
+
+    def _engine(self, langs: str, config: str):
+        key = (langs, config)
+        api = self._engines.get(key)
+        if api is not None:
+            self._engines.move_to_end(key)
+            return api
+        oem, psm, variables = parse_tess_config(config)
+        kw = {"path": self.path, "lang": langs, "variables": variables}
+        if oem is not None: kw["oem"] = oem
+        if psm is not None: kw["psm"] = psm
+        api = PyTessBaseAPI(**kw)
+        self.model_loads += 1
+        self._engines[key] = api
+        while len(self._engines) > OCR_ENGINE_CACHE:
+            _, old = self._engines.popitem(last=False)
+            try: old.End()
+            except Exception: pass
+        return api
+
+    @staticmethod
+    def _set_image(api, img: Image.Image):
+        if img.mode != "L":
+            img = img.convert("L")
+        api.SetImageBytes(img.tobytes(), img.width, img.height, 1, img.width)
+
+    def osd(self, img, timeout=0):
+        if self._osd_broken:
+            return None
+        if self._osd_api is None:
+            try:
+                self._osd_api = PyTessBaseAPI(path=self.path, lang="osd", psm=PSM.OSD_ONLY)
+                self._osd_api.SetVariable("min_characters_to_try", "10")
+                self.model_loads += 1
+            except RuntimeError as e:
+                log.warning(f"OCR: OSD engine unavailable: {e}")
+                self._osd_broken = True
+                return None
+        self.osd_calls += 1
+        self._set_image(self._osd_api, img)
+        d = self._osd_api.DetectOrientationScript()
+        if not d:
+            return None
+        orient = int(d.get("orient_deg", 0) or 0) % 360
+        return {
+            "rotate": (360 - orient) % 360,  # как «Rotate:» у tesseract CLI — поворот по часовой
+            "orientation_conf": float(d.get("orient_conf", 0) or 0),
+            "script": str(d.get("script_name") or ""),
+            "script_conf": float(d.get("script_conf", 0) or 0),
+        }
+
+    def image_to_string(self, img, langs, config, timeout=0):
+        # libtesseract не умеет прерываться по таймауту: дедлайн проверяется между проходами
+        self.calls += 1
+        api = self._engine(langs, config)
+        self._set_image(api, img)
+        try:
+            txt = api.GetUTF8Text() or ""
+            self.last_conf = float(api.MeanTextConf()) if txt.strip() else None
+            return txt
+        finally:
+            api.Clear()
+
+_BACKEND: Optional[OcrBackend] = None
+_FALLBACK: Optional[OcrBackend] = None
+
+def get_backend() -> OcrBackend:
+    """Бэкенд текущего процесса (создаётся один раз на воркер)."""
+    global _BACKEND
+    if _BACKEND is None:
+        if OCR_BACKEND in ("auto", "tesserocr") and tesserocr is not None:
+            try:
+                _BACKEND = TesserocrBackend()
+                if not _BACKEND.languages():
+                    raise RuntimeError(f"no traineddata in {_BACKEND.path}")
+            except Exception as e:
+                log.warning(f"OCR: tesserocr unavailable, falling back to pytesseract: {e}")
+                _BACKEND = None
+        elif OCR_BACKEND == "tesserocr":
+            log.warning("OCR: tesserocr not installed, falling back to pytesseract")
+        if _BACKEND is None:
+            _BACKEND = PytesseractBackend()
+    return _BACKEND
+
+def fallback_backend() -> OcrBackend:
+    """pytesseract на случай, если движок tesserocr не смог загрузить набор языков."""
+    global _FALLBACK
+    if isinstance(get_backend(), PytesseractBackend):
+        return get_backend()
+    if _FALLBACK is None:
+        _FALLBACK = PytesseractBackend()
+    return _FALLBACK
@@ -0,0 +1,212 @@
+# services/ocr_cache.py — кэш результатов OCR: file_unique_id (до скачивания) + перцептивный хэш (после декодирования)
+# Память: LRU; второй уровень: SQLite в DATA_DIR/cache.db (переживает деплой).
+# «Почти тот же кадр» — только кандидат: кроме близкого хэша нужны те же размеры и пропорции снимка.
+# Все методы с SQLite синхронные — из bot.py зовутся через asyncio.to_thread; прогрев — open() при старте.
+from __future__ import annotations
+import io, os, time, sqlite3, logging, threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+from PIL import Image, ImageOps
+
+log = logging.getLogger("gotovo-bot")
+
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+CACHE_DB_PATH = os.path.join(DATA_DIR, "cache.db")
+OCR_CACHE_MAX = int(os.getenv("OCR_CACHE_MAX", "2000"))                   # записей в памяти
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL_DAYS", "60")) * 86400
+OCR_PHASH_MAX_DIST = int(os.getenv("OCR_PHASH_MAX_DIST", "6"))           # из 256 бит
+OCR_NEAR_SIZE_TOL = float(os.getenv("OCR_NEAR_SIZE_TOL", "0.05"))         # расхождение сторон (и пропорций) для near-hit
+HASH_SIDE = 16                                                             # dHash 16×16 = 256 бит
+_MIN_BITS = 24   # почти пустые кадры (белый лист) дают вырожденный хэш — для «похожих» не используем
+
+Fingerprint = Tuple[int, int, int]   # (dHash, ширина, высота) — размеры исходника после EXIF-поворота
+
+def image_fingerprint(data: bytes) -> Optional[Fingerprint]:
+    """dHash 256 бит + размеры кадра. JPEG декодируется сразу в уменьшенном виде (draft), так что это единицы мс."""
+    try:
+        img = Image.open(io.BytesIO(data))
+        w, h = img.size
+        if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):   # Orientation: повёрнут на 90° — стороны меняются
+            w, h = h, w
+        img.draft("L", (128, 128))
+        img = ImageOps.exif_transpose(img).convert("L").resize((HASH_SIDE + 1, HASH_SIDE), Image.BILINEAR)
+    except Exception:
+        return None
+    px = list(img.getdata())
+    n = HASH_SIDE + 1
+    ph = 0
+    for row in range(HASH_SIDE):
+        for col in range(HASH_SIDE):
+            ph = (ph << 1) | (1 if px[row * n + col] > px[row * n + col + 1] else 0)
+    return ph, w, h
+
+def _to_sql(h: int) -> str:
+    return format(h, "064x")
+
+def _from_sql(v: str) -> int:
+    return int(v, 16)
+
+def _informative(h: int) -> bool:
+    n = h.bit_count()
+    return _MIN_BITS <= n <= HASH_SIDE * HASH_SIDE - _MIN_BITS
+
+def _same_frame(a: Tuple[int, int], b: Tuple[int, int], tol: float) -> bool:
+    """Те же размеры и пропорции с точностью tol; размер неизвестен (старые записи) — не кандидат."""
+    (aw, ah), (bw, bh) = a, b
+    if not (aw and ah and bw and bh):
+        return False
+    return (abs(aw - bw) <= tol * max(aw, bw) and abs(ah - bh) <= tol * max(ah, bh)
+            and abs(aw / ah - bw / bh) <= tol * max(aw / ah, bw / bh))
+
+class OcrCache:
+    def __init__(self, path: str = CACHE_DB_PATH, max_items: int = OCR_CACHE_MAX,
+                 ttl: int = OCR_CACHE_TTL, max_dist: int = OCR_PHASH_MAX_DIST, size_tol: float = OCR_NEAR_SIZE_TOL):
+        self.path = path
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_dist = max_dist
+        self.size_tol = size_tol
+        self._lock = threading.RLock()
+        self._by_fid: "OrderedDict[str, str]" = OrderedDict()
+        self._by_hash: "OrderedDict[int, Tuple[str, int, int]]" = OrderedDict()   # dHash → (текст, ширина, высота)
+        self._conn: Optional[sqlite3.Connection] = None
+        self.fid_hits = 0; self.hash_hits = 0; self.near_hits = 0; self.disk_hits = 0
+        self.misses = 0; self.stores = 0
+
+    # ---------- SQLite ----------
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS ocr_cache(
+                fid TEXT PRIMARY KEY,
+                phash TEXT,
+                text TEXT NOT NULL,
+                ts INTEGER NOT NULL
+            )""")
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(ocr_cache)")}
+            for col in ("w", "h"):
+                if col not in cols:   # база от прошлой версии: размеров нет — такие записи годятся только для точного хэша
+                    conn.execute(f"ALTER TABLE ocr_cache ADD COLUMN {col} INTEGER")
+            conn.execute("DELETE FROM ocr_cache WHERE ts < ?", (int(time.time()) - self.ttl,))
+            conn.commit()
+            self._conn = conn
+            self._warm()
+        return self._conn
+
+    def _warm(self):
+        """Свежие хэши — в память, чтобы поиск «почти такого же кадра» не ходил в БД."""
+        rows = self._conn.execute(
+            "SELECT phash, text, w, h FROM ocr_cache WHERE phash IS NOT NULL ORDER BY ts DESC LIMIT ?", (self.max_items,)
+        ).fetchall()
+        for ph, text, w, h in reversed(rows):
+            self._by_hash[_from_sql(ph)] = (text, w or 0, h or 0)
+
+    def _remember(self, od: "OrderedDict", key, text: str):
+        od[key] = text
+        od.move_to_end(key)
+        while len(od) > self.max_items:
+            od.popitem(last=False)
+
+    # ---------- API ----------
+    def open(self):
+        """Открыть cache.db и прогреть хэши в памяти — при старте, а не на первом фото."""
+        try:
+            with self._lock:
+                self._db()
+        except Exception as e:
+            log.warning(f"ocr_cache open failed: {e}")
+
+    def get_by_file_id(self, fid: Optional[str]) -> Optional[str]:
+        if not fid:
+            return None
+        with self._lock:
+            text = self._by_fid.get(fid)
+            if text is not None:
+                self._by_fid.move_to_end(fid)
+                self.fid_hits += 1
+                return text
+            try:
+                row = self._db().execute(
+                    "SELECT text FROM ocr_cache WHERE fid=? AND ts>=?", (fid, int(time.time()) - self.ttl)
+                ).fetchone()
+            except Exception as e:
+                log.warning(f"ocr_cache read failed: {e}")
+                row = None
+            if row:
+                self._remember(self._by_fid, fid, row[0])
+                self.fid_hits += 1; self.disk_hits += 1
+                return row[0]
+            return None
+
+    def get_by_fingerprint(self, fp: Optional[Fingerprint]) -> Optional[str]:
+        """Точный хэш или близкий (≤ max_dist бит) — и те же размеры кадра; у старых записей без размеров — только
+        точный хэш. Линейный проход по памяти — зовём вне event loop (lookup_image через asyncio.to_thread)."""
+        if fp is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        phash, w, h = fp
+        with self._lock:
+            try:
+                self._db()   # первый вызов прогревает память из SQLite
+            except Exception as e:
+                log.warning(f"ocr_cache open failed: {e}")
+            hit = self._by_hash.get(phash)
+            if hit is not None and (_same_frame((w, h), hit[1:], self.size_tol) or not all(hit[1:])):
+                self._by_hash.move_to_end(phash)
+                self.hash_hits += 1
+                return hit[0]
+            best, best_d = None, self.max_dist + 1
+            for ph, (_, cw, ch) in (self._by_hash.items() if _informative(phash) else ()):
+                d = (ph ^ phash).bit_count()
+                if d < best_d and _same_frame((w, h), (cw, ch), self.size_tol):
+                    best, best_d = ph, d
+            if best is not None:
+                self._by_hash.move_to_end(best)
+                self.near_hits += 1
+                return self._by_hash[best][0]
+            self.misses += 1
+            return None
+
+    def lookup_image(self, data: bytes) -> Tuple[Optional[Fingerprint], Optional[str]]:
+        """Отпечаток кадра + поиск по нему → (отпечаток, текст|None). Синхронно: декодирование и перебор — в потоке."""
+        fp = image_fingerprint(data)
+        return fp, self.get_by_fingerprint(fp)
+
+    def put(self, fid: Optional[str], fp: Optional[Fingerprint], text: str):
+        if not (text and text.strip()):
+            return
+        phash, w, h = fp if fp is not None else (None, None, None)
+        with self._lock:
+            if fid:
+                self._remember(self._by_fid, fid, text)
+            if phash is not None:
+                self._remember(self._by_hash, phash, (text, w, h))
+            self.stores += 1
+            if not fid:
+                return
+            try:
+                db = self._db()
+                db.execute(
+                    """INSERT INTO ocr_cache(fid,phash,text,w,h,ts) VALUES(?,?,?,?,?,?)
+                       ON CONFLICT(fid) DO UPDATE SET phash=excluded.phash, text=excluded.text,
+                                                      w=excluded.w, h=excluded.h, ts=excluded.ts""",
+                    (fid, _to_sql(phash) if phash is not None else None, text, w, h, int(time.time())),
+                )
+                db.commit()
+            except Exception as e:
+                log.warning(f"ocr_cache write failed: {e}")
+
+    def stats(self) -> dict:
+        hits = self.fid_hits + self.hash_hits + self.near_hits
+        lookups = hits + self.misses
+        return {
+            "mem_fid": len(self._by_fid), "mem_hash": len(self._by_hash),
+            "fid_hits": self.fid_hits, "hash_hits": self.hash_hits, "near_hits": self.near_hits,
+            "disk_hits": self.disk_hits, "misses": self.misses, "stores": self.stores,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+ocr_cache = OcrCache()
@@ -0,0 +1,173 @@
+# services/ocr_pool.py — OCR вне event loop: пул процессов, ограниченная очередь, таймауты, счётчики
+from __future__ import annotations
+import os, time, asyncio, logging, threading
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from services import ocr
+from services.metrics import OCR_SECONDS, OCR_WAIT_SECONDS, OCR_ATTEMPTS, OCR_JOBS
+
+log = logging.getLogger("gotovo-bot")
+
+OCR_WORKERS = max(1, int(os.getenv("OCR_WORKERS", "1")))
+OCR_QUEUE_MAX = max(0, int(os.getenv("OCR_QUEUE_MAX", "8")))    # сколько задач ждёт сверх работающих
+OCR_JOB_TIMEOUT = float(os.getenv("OCR_JOB_TIMEOUT", "45"))      # сек, очередь + распознавание
+
+class OcrBusy(Exception):
+    """Очередь OCR заполнена — backpressure, просим пользователя повторить позже."""
+
+class OcrTimeout(Exception):
+    """Задача не уложилась в OCR_JOB_TIMEOUT."""
+
+class OcrPool:
+    def __init__(self, workers: int = OCR_WORKERS, queue_max: int = OCR_QUEUE_MAX, job_timeout: float = OCR_JOB_TIMEOUT):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.job_timeout = job_timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._exec_lock = threading.Lock()
+        self._slots = asyncio.Semaphore(workers)
+        # счётчики (читаются из /stats.json и админки)
+        self.depth = 0          # ждут + выполняются
+        self.running = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.wait_sum = 0.0
+        self.run_sum = 0.0
+        self.passes_sum = 0     # проходов Tesseract (без OSD)
+        self.osd_hits = 0       # сколько раз OSD дал ориентацию/письменность
+        self.backend = ""
+        self.model_loads = 0    # загрузок моделей в воркере (для tesserocr — не растёт от фото к фото)
+
+    # ---------- жизненный цикл ----------
+    def start(self):
+        """Поднять воркеры заранее (до старта потоков/loop), чтобы fork был дешёвым и предсказуемым."""
+        ex = self._get_executor()
+        try:
+            ex.submit(ocr.warmup).result(timeout=30)
+            log.info(f"OCR pool: workers={self.workers} queue_max={self.queue_max} timeout={self.job_timeout}s")
+        except Exception as e:
+            log.warning(f"OCR pool warmup failed: {e}")
+
+    def shutdown(self):
+        with self._exec_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._exec_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=ocr.init_worker)
+            return self._executor
+
+    def _reset_executor(self):
+        with self._exec_lock:
+            ex, self._executor = self._executor, None
+        if ex is not None:
+            try: ex.shutdown(wait=False, cancel_futures=True)
+            except Exception: pass
+
+    # ---------- задачи ----------
+    async def run_ocr(self, data: bytes, lang_hint: Optional[str] = None, subject_hint: Optional[str] = None) -> str:
+        if self.depth >= self.workers + self.queue_max:
+            self.rejected += 1
+            OCR_JOBS.inc(status="rejected")
+            raise OcrBusy(f"OCR queue full ({self.depth})")
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self.submitted += 1
+        t_enq = perf_counter()
+        deadline = time.time() + self.job_timeout
+        released = False
+        try:
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.job_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                OCR_JOBS.inc(status="timeout")
+                raise OcrTimeout("OCR queue wait timeout")
+            t_start = perf_counter()
+            self.wait_sum += t_start - t_enq
+            OCR_WAIT_SECONDS.observe(t_start - t_enq)
+            self.running += 1
+            loop = asyncio.get_running_loop()
+            try:
+                try:
+                    fut = loop.run_in_executor(self._get_executor(), ocr.ocr_bytes, bytes(data), deadline, lang_hint, subject_hint)
+                except BrokenProcessPool:
+                    # воркер убит (OOM и т.п.) — пересоздаём пул и пробуем один раз
+                    self._reset_executor()
+                    fut = loop.run_in_executor(self._get_executor(), ocr.ocr_bytes, bytes(data), deadline, lang_hint, subject_hint)
+            except Exception:
+                self.running -= 1; self.failed += 1
+                self._slots.release()
+                raise
+
+            def _free(_f):
+                # слот освобождается, только когда воркер реально закончил (а не когда мы перестали ждать)
+                self.running -= 1
+                self.run_sum += perf_counter() - t_start
+                self._slots.release()
+            fut.add_done_callback(_free)
+            released = True
+
+            # fut не отменяем: воркер уже занят, а остановится он сам по тому же deadline
+            try:
+                res = await asyncio.wait_for(asyncio.shield(fut), timeout=max(0.1, deadline - time.time()))
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                OCR_JOBS.inc(status="timeout")
+                raise OcrTimeout(f"OCR job timeout ({self.job_timeout:.0f}s)")
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            except BrokenProcessPool:
+                self.failed += 1
+                OCR_JOBS.inc(status="failed")
+                self._reset_executor()
+                raise
+            except Exception:
+                self.failed += 1
+                OCR_JOBS.inc(status="failed")
+                raise
+            self.completed += 1
+            OCR_JOBS.inc(status="ok")
+            OCR_SECONDS.observe(float(res.get("ms", 0)) / 1000, backend=res.get("backend") or "")
+            OCR_ATTEMPTS.observe(int(res.get("passes", 0)))
+            self.passes_sum += int(res.get("passes", 0))
+            self.osd_hits += 1 if res.get("osd") else 0
+            self.backend = res.get("backend") or self.backend
+            self.model_loads = max(self.model_loads, int(res.get("model_loads", 0)))
+            log.info(
+                f"OCR backend={res.get('backend')} passes={res.get('passes')} angle={res.get('angle')} langs={res.get('langs')} "
+                f"osd={'yes' if res.get('osd') else 'no'} osd_ms={res.get('osd_ms', 0):.0f} ms={res.get('ms', 0):.0f}"
+            )
+            return res.get("text") or ""
+        except asyncio.CancelledError:
+            if not released:
+                self.cancelled += 1
+            raise
+        finally:
+            self.depth -= 1
+
+    def stats(self) -> dict:
+        done = max(1, self.completed + self.failed + self.timeouts)
+        return {
+            "workers": self.workers, "queue_max": self.queue_max, "job_timeout": self.job_timeout,
+            "depth": self.depth, "running": self.running, "max_depth": self.max_depth,
+            "submitted": self.submitted, "completed": self.completed, "failed": self.failed,
+            "timeouts": self.timeouts, "rejected": self.rejected, "cancelled": self.cancelled,
+            "wait_avg": round(self.wait_sum / done, 3), "run_avg": round(self.run_sum / done, 3),
+            "passes_avg": round(self.passes_sum / max(1, self.completed), 2), "osd_hits": self.osd_hits,
+            "backend": self.backend, "model_loads": self.model_loads,
+        }
+
+ocr_pool = OcrPool()
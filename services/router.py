@@ -1,29 +1,224 @@
-# services/router.py — гибридный выбор модели для R1+VDB (4o-mini / o4-mini / 4o)
-from typing import Tuple
+# services/router.py — выбор модели (4o-mini / o4-mini / 4o): статическое правило по тарифу и тексту задания
+# + здоровье моделей. Скользящее окно задержек/ошибок на модель, предохранитель (closed → open → half-open)
+# и бюджет задержки на тариф: модель «горит» или медленнее бюджета — уходим на запасную из цепочки.
+# Единственная реализация select_model (раньше — копия в bot.py); часы подменяются (clock=) — удобно проверять.
+# Порядок вызова: select() → record() по итогу вызова модели; не дошли до модели (очередь отказала, отмена) — release().
+from __future__ import annotations
+import os, time, logging, threading
+from collections import deque
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
 
-HEAVY_MARKERS = (
-    "докажи","обоснуй","подробно","по шагам","поиндукции",
-    "уравнение","система","дробь","производная","интеграл",
-    "доказать","программа","алгоритм","код"
-)
+from services.metrics import REGISTRY
 
-def select_model(prompt: str, mode: str) -> Tuple[str, int, str]:
-    """
-    Возвращает (model, max_tokens, tag)
-      tag: '4o-mini'|'o4-mini'|'4o'
-    Правила:
-      - free  -> gpt-4o-mini (жёсткий кап)
-      - trial -> gpt-4o (средний кап)
-      - paid  -> эвристика: o4-mini для логики/математики/длинного ввода, иначе 4o-mini
-    """
+log = logging.getLogger("gotovo-bot")
+
+HEAVY_MARKERS = ("докажи","обоснуй","подробно","по шагам","поиндукции","уравнен","система",
+                 "дроб","производн","интеграл","доказат","программа","алгоритм","код","теорем")
+
+MODEL_TAGS = {"gpt-4o-mini": "4o-mini", "o4-mini": "o4-mini", "gpt-4o": "4o"}
+
+ROUTER_WINDOW_SEC = float(os.getenv("ROUTER_WINDOW_SEC", "300"))     # окно статистики модели
+ROUTER_MIN_CALLS = int(os.getenv("ROUTER_MIN_CALLS", "8"))           # меньше вызовов в окне — выводов не делаем
+ROUTER_ERR_RATE = float(os.getenv("ROUTER_ERR_RATE", "0.5"))         # доля ошибок в окне → open
+ROUTER_CONSEC_FAIL = int(os.getenv("ROUTER_CONSEC_FAIL", "5"))       # подряд ошибок → open (не ждём окна)
+ROUTER_OPEN_SEC = float(os.getenv("ROUTER_OPEN_SEC", "30"))          # первая пауза; повторный срыв — вдвое, до ROUTER_OPEN_MAX_SEC
+ROUTER_OPEN_MAX_SEC = float(os.getenv("ROUTER_OPEN_MAX_SEC", "600"))
+ROUTER_PROBE_SEC = float(os.getenv("ROUTER_PROBE_SEC", "60"))        # пробный запрос не отчитался — разрешаем новый
+# бюджет p90 полного ответа по тарифу, сек: медленнее — на запасную модель
+ROUTER_BUDGETS = {"free": float(os.getenv("ROUTER_BUDGET_FREE", "20")), "pro": float(os.getenv("ROUTER_BUDGET_PRO", "45"))}
+# цепочки запасных: "модель:запасная>ещё;…"; у gpt-4o-mini по умолчанию запасных нет (Free не уводим на дорогую)
+ROUTER_FALLBACKS = os.getenv("ROUTER_FALLBACKS", "gpt-4o:o4-mini>gpt-4o-mini;o4-mini:gpt-4o-mini")
+
+ROUTER_DECISIONS = REGISTRY.counter("router_decisions", "Model routing decisions that reached the model", ("model", "reason"))
+ROUTER_BREAKER = REGISTRY.gauge("router_breaker_state", "Circuit breaker per model: 0 closed, 1 open, 2 half-open", ("model",))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+_STATE_CODE = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+class Route(NamedTuple):
+    model: str
+    max_tokens: int
+    tag: str
+    reason: str    # static | breaker:<модель> | slow:<модель> | probe
+    probe: bool = False   # пробный запрос half-open: не дошёл до модели — release(route)
+
+def _parse_fallbacks(s: str) -> Dict[str, Tuple[str, ...]]:
+    out = {}
+    for part in (s or "").split(";"):
+        k, _, v = part.partition(":")
+        if k.strip():
+            out[k.strip()] = tuple(m.strip() for m in v.split(">") if m.strip())
+    return out
+
+def tier(mode: str) -> str:
+    """free → free; pro/trial/credit/sub → pro."""
+    return "free" if mode in ("free", "", None) else "pro"
+
+def static_route(prompt: str, mode: str) -> Tuple[str, int, str]:
+    """Правило без учёта здоровья: Free — 4o-mini; Pro — o4-mini для логики/математики/длинного ввода,
+    gpt-4o для длинных тяжёлых, иначе 4o-mini."""
     p = (prompt or "").lower()
-    if mode == "free":
-        return "gpt-4o-mini", 700, "4o-mini"
-    if mode == "trial":
-        return "gpt-4o", 1200, "4o"
-    # paid (credit/sub)
+    if tier(mode) == "free":
+        return "gpt-4o-mini", 800, "4o-mini"
     long_input = len(p) > 600
     heavy = long_input or any(k in p for k in HEAVY_MARKERS)
+    if heavy and len(p) > 1200:
+        return "gpt-4o", 1100, "4o"
     if heavy:
         return "o4-mini", 1100, "o4-mini"
     return "gpt-4o-mini", 900, "4o-mini"
+
+class ModelHealth:
+    """Окно (ts, секунды, ok) + состояние предохранителя одной модели."""
+    def __init__(self, model: str):
+        self.model = model
+        self.samples: deque = deque()
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.open_for = ROUTER_OPEN_SEC
+        self.consec_fail = 0
+        self.probe_at = 0.0      # когда выдан пробный запрос в half-open (0 — не выдан)
+        self.trips = 0
+
+    def trim(self, now: float, window: float):
+        while self.samples and now - self.samples[0][0] > window:
+            self.samples.popleft()
+
+    def error_rate(self) -> float:
+        n = len(self.samples)
+        return sum(1 for _, _, ok in self.samples if not ok) / n if n else 0.0
+
+    def p90(self) -> Optional[float]:
+        lat = sorted(s for _, s, ok in self.samples if ok)
+        return lat[min(len(lat) - 1, int(0.9 * len(lat)))] if lat else None
+
+class ModelRouter:
+    def __init__(self, clock: Callable[[], float] = time.monotonic, window: float = ROUTER_WINDOW_SEC,
+                 min_calls: int = ROUTER_MIN_CALLS, err_rate: float = ROUTER_ERR_RATE, consec_fail: int = ROUTER_CONSEC_FAIL,
+                 budgets: Optional[Dict[str, float]] = None, fallbacks: str = ROUTER_FALLBACKS):
+        self.clock = clock
+        self.window = window; self.min_calls = min_calls; self.err_rate = err_rate; self.consec_fail = consec_fail
+        self.budgets = dict(ROUTER_BUDGETS if budgets is None else budgets)
+        self.fallbacks = _parse_fallbacks(fallbacks)
+        self._health: Dict[str, ModelHealth] = {}
+        self._lock = threading.Lock()   # record() зовут и из потоков (на всякий), select() — с loop
+
+    def _h(self, model: str) -> ModelHealth:
+        h = self._health.get(model)
+        if h is None:
+            h = self._health[model] = ModelHealth(model)
+            ROUTER_BREAKER.set(0, model=model)
+        return h
+
+    def _set_state(self, h: ModelHealth, state: str, now: float):
+        if h.state == state:
+            return
+        log.warning(f"router: {h.model} breaker {h.state} → {state} (err={h.error_rate():.0%}, n={len(h.samples)})")
+        h.state = state
+        if state == OPEN:
+            h.opened_at = now; h.trips += 1; h.probe_at = 0.0
+        elif state == CLOSED:
+            h.open_for = ROUTER_OPEN_SEC; h.consec_fail = 0
+            h.samples.clear()   # старые ошибки не должны сразу снова разомкнуть
+        ROUTER_BREAKER.set(_STATE_CODE[state], model=h.model)
+
+    # ---------- состояние модели ----------
+    def _available(self, h: ModelHealth, now: float) -> Tuple[bool, bool]:
+        """(можно слать, это проба). open → half-open по таймеру; в half-open — один пробный запрос за раз."""
+        if h.state == OPEN and now - h.opened_at >= h.open_for:
+            self._set_state(h, HALF_OPEN, now)
+        if h.state == CLOSED:
+            return True, False
+        if h.state == HALF_OPEN and (not h.probe_at or now - h.probe_at >= ROUTER_PROBE_SEC):
+            return True, True
+        return False, False
+
+    def _slow(self, h: ModelHealth, budget: Optional[float]) -> bool:
+        if budget is None or len(h.samples) < self.min_calls:
+            return False
+        p = h.p90()
+        return p is not None and p > budget
+
+    # ---------- API ----------
+    def select(self, prompt: str, mode: str) -> Route:
+        model, max_out, tag = static_route(prompt, mode)
+        budget = self.budgets.get(tier(mode))
+        now = self.clock()
+        with self._lock:
+            chain = (model,) + self.fallbacks.get(model, ())
+            first_slow = None
+            reason = "static"
+            for i, m in enumerate(chain):
+                h = self._h(m)
+                h.trim(now, self.window)
+                ok, probe = self._available(h, now)
+                if not ok:
+                    if i == 0: reason = f"breaker:{model}"
+                    continue
+                if self._slow(h, budget):
+                    first_slow = first_slow or (m, probe)
+                    if i == 0: reason = f"slow:{model}"
+                    continue
+                if probe:
+                    h.probe_at = now
+                    reason = "probe" if i == 0 else reason
+                route = Route(m, max_out, MODEL_TAGS.get(m, m), reason, probe)
+                break
+            else:
+                # все в цепочке недоступны/медленные: медленная лучше сломанной, иначе — основная как есть
+                m = first_slow[0] if first_slow else model
+                probe = bool(first_slow and first_slow[1])
+                if probe:
+                    self._h(m).probe_at = now
+                route = Route(m, max_out, MODEL_TAGS.get(m, m), reason + ":no_fallback", probe)
+        return route
+
+    def release(self, route: Route):
+        """Запрос по route до модели не дошёл (LlmBusy, отмена): вернуть пробу half-open, иначе следующая
+        ждала бы ROUTER_PROBE_SEC. Не проба — ничего не делает."""
+        if not route.probe:
+            return
+        with self._lock:
+            h = self._health.get(route.model)
+            if h is not None and h.state == HALF_OPEN:
+                h.probe_at = 0.0
+
+    def record(self, model: str, seconds: float, ok: bool, reason: Optional[str] = None):
+        """Итог вызова модели (время без ожидания в очереди). Ошибки нашей очереди (LlmBusy) сюда не попадают —
+        для них release(). reason — Route.reason: решение учитывается в метрике, только когда запрос дошёл до модели."""
+        if reason:
+            ROUTER_DECISIONS.inc(model=model, reason=reason.split(":", 1)[0])
+        now = self.clock()
+        with self._lock:
+            h = self._h(model)
+            h.samples.append((now, float(seconds), bool(ok)))
+            h.trim(now, self.window)
+            h.consec_fail = 0 if ok else h.consec_fail + 1
+            if h.state == HALF_OPEN and h.probe_at:
+                if ok:
+                    self._set_state(h, CLOSED, now)
+                else:
+                    h.open_for = min(h.open_for * 2, ROUTER_OPEN_MAX_SEC)
+                    self._set_state(h, OPEN, now)
+                return
+            if h.state == CLOSED and not ok and (
+                    h.consec_fail >= self.consec_fail
+                    or (len(h.samples) >= self.min_calls and h.error_rate() >= self.err_rate)):
+                self._set_state(h, OPEN, now)
+
+    def stats(self) -> dict:
+        now = self.clock()
+        with self._lock:
+            out = {}
+            for m, h in self._health.items():
+                h.trim(now, self.window)
+                p = h.p90()
+                out[m] = {"state": h.state, "calls": len(h.samples), "err_rate": round(h.error_rate(), 3),
+                          "p90": round(p, 2) if p is not None else None, "trips": h.trips}
+            return out
+
+router = ModelRouter()
+
+def select_model(prompt: str, mode: str) -> Tuple[str, int, str]:
+    """(model, max_tokens, tag) с учётом здоровья моделей; причина выбора — router.select()."""
+    return tuple(router.select(prompt, mode)[:3])  # type: ignore[return-value]
@@ -0,0 +1,134 @@
+# services/sessions.py — настройки и состояние диалога пользователя (предмет, класс, режим родителя, state, язык, Pro-next)
+# Память: LRU из компактных записей (__slots__), размер ограничен SESSIONS_MAX — не растёт с базой пользователей.
+# Диск: таблица user_session в app.db; запись — пачками в фоне (write-behind), чтение — при первом обращении к пользователю.
+from __future__ import annotations
+import os, time, atexit, logging, threading
+from collections import OrderedDict
+
+from services.storage import tx as db_tx
+
+log = logging.getLogger("gotovo-bot")
+
+SESSIONS_MAX = max(100, int(os.getenv("SESSIONS_MAX", "20000")))
+SESSIONS_FLUSH_SEC = max(1.0, float(os.getenv("SESSIONS_FLUSH_SEC", "5")))
+
+FIELDS = ("subject", "grade", "parent", "state", "lang", "pro_next")
+
+class Session:
+    __slots__ = ("uid",) + FIELDS
+
+    def __init__(self, uid: int, subject="auto", grade="8", parent=True, state=None, lang="ru", pro_next=False):
+        self.uid = uid
+        self.subject = subject; self.grade = grade; self.parent = parent
+        self.state = state; self.lang = lang; self.pro_next = pro_next
+
+    def row(self) -> tuple:
+        return (self.uid, self.subject, self.grade, int(bool(self.parent)), self.state, self.lang,
+                int(bool(self.pro_next)), int(time.time()))
+
+class SessionStore:
+    def __init__(self, max_items: int = SESSIONS_MAX):
+        self.max_items = max_items
+        self._lock = threading.RLock()
+        self._lru: "OrderedDict[int, Session]" = OrderedDict()
+        self._dirty: dict[int, Session] = {}     # изменённые, ещё не записанные
+        self._flushing: dict[int, Session] = {}  # пачка, которая пишется прямо сейчас
+        self._flush_lock = threading.Lock()
+        self.loads = 0; self.evictions = 0; self.flushed = 0
+
+    def get(self, uid: int) -> Session:
+        with self._lock:
+            s = self._lru.get(uid)
+            if s is not None:
+                self._lru.move_to_end(uid)
+                return s
+            s = self._dirty.get(uid) or self._flushing.get(uid) or self._load(uid)
+            self._lru[uid] = s
+            while len(self._lru) > self.max_items:
+                # вытеснение не теряет изменений: грязная запись остаётся в _dirty до ближайшего flush
+                self._lru.popitem(last=False)
+                self.evictions += 1
+            return s
+
+    def _load(self, uid: int) -> Session:
+        self.loads += 1
+        try:
+            with db_tx() as db:
+                row = db.execute(
+                    "SELECT subject,grade,parent,state,lang,pro_next FROM user_session WHERE user_id=?", (uid,)
+                ).fetchone()
+        except Exception as e:
+            log.warning(f"sessions: load failed uid={uid}: {e}")
+            row = None
+        if not row:
+            return Session(uid)
+        return Session(uid, row[0] or "auto", row[1] or "8", bool(row[2]), row[3], row[4] or "ru", bool(row[5]))
+
+    def set(self, uid: int, field: str, value):
+        with self._lock:
+            s = self.get(uid)
+            if getattr(s, field) != value:
+                setattr(s, field, value)
+                self._dirty[uid] = s
+
+    def flush(self) -> int:
+        with self._lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            self._flushing = batch
+            rows = [s.row() for s in batch.values()]
+        with self._flush_lock:
+            try:
+                with db_tx() as db:
+                    db.executemany(
+                        """INSERT INTO user_session(user_id,subject,grade,parent,state,lang,pro_next,ts) VALUES(?,?,?,?,?,?,?,?)
+                           ON CONFLICT(user_id) DO UPDATE SET subject=excluded.subject, grade=excluded.grade,
+                               parent=excluded.parent, state=excluded.state, lang=excluded.lang,
+                               pro_next=excluded.pro_next, ts=excluded.ts""",
+                        rows,
+                    )
+            except Exception as e:
+                log.warning(f"sessions: flush failed ({len(rows)} rows), will retry: {e}")
+                with self._lock:
+                    for uid, s in batch.items():
+                        self._dirty.setdefault(uid, s)
+                    self._flushing = {}
+                return 0
+        with self._lock:
+            self._flushing = {}
+        self.flushed += len(rows)
+        return len(rows)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(SESSIONS_FLUSH_SEC)
+            self.flush()
+
+    def start(self):
+        threading.Thread(target=self._flush_loop, name="sessions-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def stats(self) -> dict:
+        return {"mem": len(self._lru), "max": self.max_items, "dirty": len(self._dirty),
+                "loads": self.loads, "evictions": self.evictions, "flushed": self.flushed}
+
+class FieldView:
+    """Mapping-обёртка над одним полем сессии: USER_SUBJECT[uid] / USER_SUBJECT[uid] = ... / .get(uid, default)."""
+    __slots__ = ("_store", "_field")
+
+    def __init__(self, store: SessionStore, field: str):
+        self._store = store
+        self._field = field
+
+    def __getitem__(self, uid: int):
+        return getattr(self._store.get(uid), self._field)
+
+    def __setitem__(self, uid: int, value):
+        self._store.set(uid, self._field, value)
+
+    def get(self, uid: int, default=None):
+        v = self[uid]
+        return default if v is None else v
+
+sessions = SessionStore()
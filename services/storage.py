@@ -0,0 +1,131 @@
+# services/storage.py — SQLite app.db: долгоживущие соединения (по одному на поток), WAL, миграции один раз
+# Раньше каждый хелпер открывал новое соединение и гонял CREATE TABLE на каждый вызов.
+# Теперь: соединение потока переиспользуется (и его кэш подготовленных выражений тоже), схема — при старте.
+from __future__ import annotations
+import os, sqlite3, logging, threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from services.metrics import DB_SECONDS, HANDLER
+
+log = logging.getLogger("gotovo-bot")
+
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+DB_PATH = os.path.join(DATA_DIR, "app.db")
+SQLITE_BUSY_MS = int(os.getenv("SQLITE_BUSY_MS", "5000"))
+SQLITE_STMT_CACHE = 256   # подготовленные выражения на соединение (sqlite3 кэширует их по тексту SQL)
+
+# (версия, SQL) — применяются по PRAGMA user_version, каждая ровно один раз
+MIGRATIONS: list[tuple[int, str]] = [
+    (1, """
+        CREATE TABLE IF NOT EXISTS followup_state(
+            user_id INTEGER PRIMARY KEY,
+            last_task TEXT,
+            last_answer TEXT,
+            ts INTEGER,
+            used_free INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS user_plan(
+            user_id INTEGER PRIMARY KEY,
+            pro_until INTEGER NOT NULL DEFAULT 0,
+            day INTEGER NOT NULL DEFAULT 0,
+            free_count INTEGER NOT NULL DEFAULT 0,
+            credits INTEGER NOT NULL DEFAULT 0,
+            sub_until INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS admin_users(user_id INTEGER PRIMARY KEY, added_ts INTEGER);
+    """),
+    (2, """
+        -- штампы версий для кэшей в памяти (например, список админов): меняется → другие процессы перечитывают
+        CREATE TABLE IF NOT EXISTS app_meta(key TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0);
+        INSERT OR IGNORE INTO app_meta(key, value) VALUES('admins_version', 0);
+    """),
+    (3, """
+        -- настройки/состояние диалога (services/sessions.py); пишется пачками, читается при первом сообщении
+        CREATE TABLE IF NOT EXISTS user_session(
+            user_id INTEGER PRIMARY KEY,
+            subject TEXT, grade TEXT, parent INTEGER, state TEXT, lang TEXT, pro_next INTEGER,
+            ts INTEGER NOT NULL
+        );
+    """),
+    (4, """
+        -- журнал событий services/usage.py + токены и стоимость вызовов LLM (usage.record_llm)
+        CREATE TABLE IF NOT EXISTS events(
+            ts INTEGER, day INTEGER, ym TEXT, user_id INTEGER, type TEXT, mode TEXT, model TEXT, amount INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_events_day ON events(day);
+        CREATE INDEX IF NOT EXISTS idx_events_ym ON events(ym);
+        ALTER TABLE events ADD COLUMN model_name TEXT;      -- полное имя модели (model — короткий тег)
+        ALTER TABLE events ADD COLUMN kind TEXT;            -- solve|followup
+        ALTER TABLE events ADD COLUMN tok_prompt INTEGER;
+        ALTER TABLE events ADD COLUMN tok_cached INTEGER;   -- из них попали в кэш промптов OpenAI
+        ALTER TABLE events ADD COLUMN tok_completion INTEGER;
+        ALTER TABLE events ADD COLUMN cost_usd REAL;
+        CREATE INDEX IF NOT EXISTS idx_events_user_day ON events(user_id, day);
+    """),
+]
+
+_local = threading.local()
+_migrate_lock = threading.Lock()
+_migrated = False
+_all: list[sqlite3.Connection] = []
+
+def _open(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_MS / 1000, cached_statements=SQLITE_STMT_CACHE,
+                           check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")   # в WAL это безопасно для целостности и без fsync на каждый коммит
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def migrate(path: str = DB_PATH):
+    """Довести схему до последней версии. Вызывается из main() один раз; повторно — no-op."""
+    global _migrated
+    with _migrate_lock:
+        if _migrated:
+            return
+        conn = _open(path)
+        try:
+            cur = conn.execute("PRAGMA user_version").fetchone()[0]
+            for ver, sql in MIGRATIONS:
+                if ver > cur:
+                    # executescript сам транзакцию не открывает: без BEGIN упавший ALTER оставил бы половину
+                    # схемы при старой user_version, и следующий запуск споткнулся бы о «duplicate column».
+                    # Версия ставится в той же транзакции — миграция применяется целиком или никак.
+                    try:
+                        conn.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version={int(ver)};\nCOMMIT;")
+                    except Exception:
+                        if conn.in_transaction:
+                            conn.rollback()
+                        raise
+                    log.info(f"storage: migrated app.db to v{ver}")
+        finally:
+            conn.close()
+        _migrated = True
+
+def db() -> sqlite3.Connection:
+    """Соединение текущего потока. `with db() as c:` — транзакция (commit/rollback), соединение не закрывается."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        if not _migrated:
+            migrate()
+        conn = _open(DB_PATH)
+        _local.conn = conn
+        _all.append(conn)
+    return conn
+
+@contextmanager
+def tx():
+    """`with tx() as c:` — то же, что `with db() as c:`, плюс время транзакции в gotovo_db_seconds{handler}."""
+    t0 = perf_counter()
+    try:
+        with db() as conn:
+            yield conn
+    finally:
+        DB_SECONDS.observe(perf_counter() - t0, handler=HANDLER.get())
+
+def close_all():
+    while _all:
+        try: _all.pop().close()
+        except Exception: pass
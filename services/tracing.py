@@ -0,0 +1,142 @@
+# services/tracing.py — лёгкая трассировка апдейта: trace_id + спаны этапов (квота, предмет, эмбеддинг, ВБД, LLM, ответ, TeX)
+# Трасса живёт в ContextVar: задачи asyncio (gather/create_task) и asyncio.to_thread видят ту же трассу.
+# Хранение: кольцо последних трасс со спанами (для admin:traces берём самые медленные) + опционально JSONL-файл.
+from __future__ import annotations
+import os, json, time, logging, threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+from typing import Optional
+
+log = logging.getLogger("gotovo-bot")
+
+TRACE_RING = int(os.getenv("TRACE_RING", "256"))                   # последних трасс в памяти
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")              # JSONL; пусто — не пишем
+TRACE_EXPORT_MIN_MS = float(os.getenv("TRACE_EXPORT_MIN_MS", "0"))  # в файл — только трассы не быстрее
+
+class Trace:
+    __slots__ = ("trace_id", "name", "uid", "ts", "t0", "spans", "ms", "status")
+
+    def __init__(self, name: str, uid: Optional[int] = None):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name; self.uid = uid
+        self.ts = time.time(); self.t0 = perf_counter()
+        self.spans: list = []   # (name, start_ms, dur_ms, attrs)
+        self.ms = 0.0; self.status = "ok"
+
+    def to_dict(self) -> dict:
+        return {"trace_id": self.trace_id, "name": self.name, "uid": self.uid, "ts": round(self.ts, 3),
+                "ms": round(self.ms, 1), "status": self.status,
+                "spans": [{"name": n, "start_ms": round(s, 1), "ms": round(d, 1), **({"attrs": a} if a else {})}
+                          for n, s, d, a in self.spans]}
+
+_CURRENT: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+class TraceStore:
+    def __init__(self, size: int = TRACE_RING, export_path: str = TRACE_EXPORT_PATH):
+        self._ring: "deque[Trace]" = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.export_path = export_path
+        self._fh = None
+        self.finished = 0; self.exported = 0
+
+    def add(self, tr: Trace):
+        self.finished += 1
+        if not tr.spans:
+            return   # кнопки/меню без этапов конвейера — не интересны, только занимали бы кольцо
+        with self._lock:
+            self._ring.append(tr)
+        if self.export_path and tr.ms >= TRACE_EXPORT_MIN_MS:
+            self._export(tr)
+
+    def _export(self, tr: Trace):
+        line = json.dumps(tr.to_dict(), ensure_ascii=False) + "\n"
+        try:
+            with self._lock:
+                if self._fh is None:
+                    os.makedirs(os.path.dirname(self.export_path) or ".", exist_ok=True)
+                    self._fh = open(self.export_path, "a", encoding="utf-8", buffering=1)   # построчная буферизация
+                self._fh.write(line)
+            self.exported += 1
+        except Exception as e:
+            log.warning(f"trace export failed: {e}")
+            self.export_path = ""
+
+    def slowest(self, n: int = 10) -> list[Trace]:
+        with self._lock:
+            items = list(self._ring)
+        return sorted(items, key=lambda t: t.ms, reverse=True)[:n]
+
+    def find(self, trace_id: str) -> Optional[Trace]:
+        with self._lock:
+            return next((t for t in self._ring if t.trace_id.startswith(trace_id)), None)
+
+    def stats(self) -> dict:
+        return {"ring": len(self._ring), "size": self._ring.maxlen, "finished": self.finished,
+                "exported": self.exported, "export_path": self.export_path}
+
+traces = TraceStore()
+
+def begin(name: str, uid: Optional[int] = None) -> Trace:
+    """Новая трасса в текущем контексте (задача апдейта)."""
+    tr = Trace(name, uid)
+    _CURRENT.set(tr)
+    return tr
+
+def end(tr: Trace, status: Optional[str] = None):
+    tr.ms = (perf_counter() - tr.t0) * 1000
+    if status:
+        tr.status = status
+    traces.add(tr)
+
+def current() -> Optional[Trace]:
+    return _CURRENT.get()
+
+def current_id() -> str:
+    tr = _CURRENT.get()
+    return tr.trace_id if tr else "-"
+
+@contextmanager
+def span(name: str, **attrs):
+    """with span("llm", model=...) as a: a["ttft_ms"] = ... — без активной трассы ничего не записывает."""
+    tr = _CURRENT.get()
+    if tr is None:
+        yield attrs
+        return
+    t = perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        tr.spans.append((name, (t - tr.t0) * 1000, (perf_counter() - t) * 1000, attrs))
+
+async def aspan(name: str, aw, **attrs):
+    """await aspan("classify_subject", coro) — спан вокруг awaitable (удобно внутри gather)."""
+    with span(name, **attrs):
+        return await aw
+
+def traced(name: str):
+    """Декоратор корутины: весь вызов — один спан."""
+    def deco(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def format_trace(tr: Trace, width: int = 16) -> str:
+    """Текстовый «водопад» для админки: смещение, длительность, полоска."""
+    scale = max(tr.ms, 1.0)
+    lines = [f"{tr.trace_id} {tr.name} uid={tr.uid} {tr.ms:.0f}ms {tr.status} "
+             f"{time.strftime('%m-%d %H:%M:%S', time.localtime(tr.ts))}"]
+    for n, s, d, a in sorted(tr.spans, key=lambda x: x[1]):
+        lo = int(s / scale * width); hi = max(lo + 1, int((s + d) / scale * width))
+        bar = "·" * lo + "█" * (hi - lo) + "·" * max(0, width - hi)
+        extra = (" " + " ".join(f"{k}={v}" for k, v in a.items())) if a else ""
+        lines.append(f"  {bar} {n} +{s:.0f} {d:.0f}ms{extra}")
+    return "\n".join(lines)
@@ -1,5 +1,6 @@
 # services/usage.py — SQLite: лимиты free/trial/sub/credit + события и отчёты (месячной учёт подписки)
-import os, sqlite3, time
+# + токены и стоимость вызовов LLM: таблица цен, запись в events (колонки — миграция v4 в services/storage.py), сводки.
+import os, json, sqlite3, time
 from typing import Optional, Tuple
 
 DB = os.getenv("SQLITE_PATH", "/data/app.db")
@@ -168,3 +169,67 @@ def stats_export_json():
         users = db.execute("SELECT user_id,credits,sub_until FROM users").fetchall()
     return {"events":[{"ts":r[0],"day":r[1],"ym":r[2],"user_id":r[3],"type":r[4],"mode":r[5],"model":r[6],"amount":r[7]} for r in ev],
             "users":[{"user_id":r[0],"credits":r[1],"sub_until":r[2]} for r in users]}
+
+# ---------- Токены и стоимость LLM ----------
+# USD за 1M токенов: (вход, вход из кэша промптов, выход). LLM_PRICES_JSON='{"gpt-4o":[2.5,1.25,10]}' — поверх.
+LLM_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o":      (2.50, 1.25, 10.00),
+    "o4-mini":     (1.10, 0.275, 4.40),
+}
+try:
+    LLM_PRICES.update({k: tuple(map(float, v)) for k, v in json.loads(os.getenv("LLM_PRICES_JSON", "") or "{}").items()})
+except Exception:
+    pass
+
+def llm_price(model: str) -> Optional[tuple]:
+    """Цена по самому длинному префиксу: API отдаёт датированные имена (gpt-4o-mini-2024-07-18)."""
+    m = (model or "").lower()
+    best = max((k for k in LLM_PRICES if m.startswith(k)), key=len, default=None)
+    return LLM_PRICES.get(best) if best else None
+
+def llm_usage(u) -> Tuple[int, int, int]:
+    """resp.usage (объект SDK или dict) → (prompt, cached, completion)."""
+    if u is None:
+        return 0, 0, 0
+    g = (lambda o, k: o.get(k) if isinstance(o, dict) else getattr(o, k, None))
+    details = g(u, "prompt_tokens_details")
+    return int(g(u, "prompt_tokens") or 0), int((details and g(details, "cached_tokens")) or 0), int(g(u, "completion_tokens") or 0)
+
+def llm_cost(model: str, prompt: int, cached: int, completion: int) -> float:
+    p = llm_price(model)
+    if p is None:
+        return 0.0
+    return ((prompt - cached) * p[0] + cached * p[1] + completion * p[2]) / 1e6
+
+def llm_event(uid: int, mode: str, tag: str, model_name: str, kind: str,
+              prompt: int, cached: int, completion: int, cost: float) -> tuple:
+    """Строка события 'query' с токенами: время — момент вызова, запись — позже пачкой (record_llm)."""
+    ts, day, ym = _now_day_ym()
+    return (ts, day, ym, uid, mode, tag, model_name, kind, prompt, cached, completion, cost)
+
+def record_llm(db, rows):
+    """Пачка строк llm_event — в соединении вызывающего (services/storage.tx)."""
+    db.executemany("""INSERT INTO events(ts,day,ym,user_id,type,mode,model,amount,model_name,kind,tok_prompt,tok_cached,tok_completion,cost_usd)
+                      VALUES(?,?,?,?,'query',?,?,NULL,?,?,?,?,?,?)""", rows)
+
+_COST_COLS = "COUNT(*), SUM(tok_prompt), SUM(tok_cached), SUM(tok_completion), SUM(cost_usd)"
+_COST_WHERE = "FROM events WHERE type='query' AND day>=? AND tok_prompt IS NOT NULL"
+
+def _cost_row(r) -> dict:
+    return {"calls": r[0] or 0, "prompt": r[1] or 0, "cached": r[2] or 0, "completion": r[3] or 0,
+            "cost_usd": round(r[4] or 0.0, 4)}
+
+def cost_summary(db, days: int = 1, top: int = 5) -> dict:
+    """Токены/стоимость за последние days суток: по модели, по режиму, самые дорогие пользователи."""
+    _, day, _ = _now_day_ym()
+    d0 = day - days + 1
+    total = db.execute(f"SELECT {_COST_COLS} {_COST_WHERE}", (d0,)).fetchone()
+    by_model = db.execute(f"SELECT model_name, {_COST_COLS} {_COST_WHERE} GROUP BY model_name ORDER BY 6 DESC", (d0,)).fetchall()
+    by_mode = db.execute(f"SELECT mode, {_COST_COLS} {_COST_WHERE} GROUP BY mode ORDER BY 6 DESC", (d0,)).fetchall()
+    users = db.execute(f"SELECT user_id, {_COST_COLS} {_COST_WHERE} GROUP BY user_id ORDER BY 6 DESC LIMIT ?",
+                       (d0, top)).fetchall()
+    return {"days": days, "total": _cost_row(total),
+            "models": {r[0] or "?": _cost_row(r[1:]) for r in by_model},
+            "modes": {r[0] or "?": _cost_row(r[1:]) for r in by_mode},
+            "top_users": [{"user_id": r[0], **_cost_row(r[1:])} for r in users]}
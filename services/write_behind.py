@@ -0,0 +1,64 @@
+# services/write_behind.py — запись в SQLite пачками в фоне (write-behind), как у services/sessions.py:
+# хэндлер на event loop только кладёт строку в очередь, INSERT + commit делает поток раз в WRITE_BEHIND_SEC
+# (и при выходе). Для данных, которые можно дописать с задержкой в секунды: кэши в cache.db, журналы.
+from __future__ import annotations
+import os, time, atexit, logging, threading
+from typing import Callable, List
+
+log = logging.getLogger("gotovo-bot")
+
+WRITE_BEHIND_SEC = max(0.2, float(os.getenv("WRITE_BEHIND_SEC", "2")))
+WRITE_BEHIND_MAX = max(100, int(os.getenv("WRITE_BEHIND_MAX", "10000")))   # строк в очереди; сверх — старые теряем
+
+class WriteBehind:
+    """add(row) — с любого потока, мгновенно; flush_fn(rows) зовётся в фоновом потоке name.
+    Ошибка записи — пачка возвращается в очередь до следующего прохода."""
+    def __init__(self, name: str, flush_fn: Callable[[List[tuple]], None], interval: float = WRITE_BEHIND_SEC,
+                 max_pending: int = WRITE_BEHIND_MAX):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rows: List[tuple] = []
+        self._started = False
+        self.written = 0; self.dropped = 0; self.failures = 0
+
+    def add(self, row: tuple):
+        with self._lock:
+            self._rows.append(row)
+            if len(self._rows) > self.max_pending:
+                over = len(self._rows) - self.max_pending
+                del self._rows[:over]
+                self.dropped += over
+            start = not self._started
+            self._started = True
+        if start:
+            threading.Thread(target=self._loop, name=self.name, daemon=True).start()
+            atexit.register(self.flush)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            try:
+                self.flush_fn(rows)
+            except Exception as e:
+                self.failures += 1
+                log.warning(f"{self.name}: write failed ({len(rows)} rows), will retry: {e}")
+                with self._lock:
+                    self._rows[:0] = rows[-self.max_pending:]
+                return 0
+            self.written += len(rows)
+            return len(rows)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def stats(self) -> dict:
+        return {"pending": len(self._rows), "written": self.written, "dropped": self.dropped, "failures": self.failures}
@@ -0,0 +1,13 @@
+# tests/conftest.py — окружение до импорта bot.py: фиктивные секреты и свой DATA_DIR (app.db, cache.db, журналы)
+import os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+_DATA = tempfile.mkdtemp(prefix="gotovo-tests-")
+os.environ.setdefault("TELEGRAM_TOKEN", "1:test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("DATA_DIR", _DATA)
+os.environ.setdefault("VDB_PATH", os.path.join(_DATA, "vdb"))
+os.environ.setdefault("SQLITE_PATH", os.path.join(_DATA, "app.db"))
@@ -0,0 +1,37 @@
+# tests/test_admins.py — реестр админов: упавшая первая загрузка не повторяет I/O на каждый is_admin, повтор после паузы
+import pytest
+
+import bot
+
+@pytest.fixture
+def unloaded(monkeypatch):
+    monkeypatch.setenv("ADMIN_IDS", "7,8")
+    monkeypatch.setattr(bot, "_ADMINS", frozenset())
+    monkeypatch.setattr(bot, "_ADMINS_VER", -1)
+    monkeypatch.setattr(bot, "_ADMINS_RETRY_AT", 0.0)
+    clock = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: clock[0])
+    return clock
+
+def test_failed_load_falls_back_to_env_and_backs_off(unloaded, monkeypatch):
+    real_db = bot.app_db
+    calls = []
+    def broken_db():
+        calls.append(1)
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(bot, "app_db", broken_db)
+    assert bot.is_admin(7) and not bot.is_admin(9)
+    assert bot.all_admin_ids() == {7, 8}
+    assert len(calls) == 1                    # одна попытка на всю паузу, а не на каждый вызов
+
+    unloaded[0] += bot.ADMINS_RETRY_SEC - 1
+    bot.is_admin(7)
+    assert len(calls) == 1
+    unloaded[0] += 1
+    bot.is_admin(7)
+    assert len(calls) == 2 and bot._ADMINS_VER == -1
+
+    unloaded[0] += bot.ADMINS_RETRY_SEC
+    monkeypatch.setattr(bot, "app_db", real_db)   # база снова доступна
+    assert bot.is_admin(7)
+    assert bot._ADMINS_VER >= 0               # загрузилось из базы — дальше только refresh по штампу
@@ -0,0 +1,42 @@
+# tests/test_inflight.py — склейка дублей: управляющие ответы не теряются, задания склеиваются
+import asyncio
+
+from services.inflight import InflightRegistry, content_key
+
+CONTROLS = ("🧠 объяснить", "📚 предмет:")
+
+def _run_twice(key):
+    reg = InflightRegistry(dedup_sec=30)
+    handled = []
+
+    async def handler(n):
+        await asyncio.sleep(0.01)
+        handled.append(n)
+
+    async def main():
+        return await asyncio.gather(reg.run(1, key, handler(1)), reg.run(1, key, handler(2)))
+
+    return asyncio.run(main()), handled
+
+def test_two_identical_yes_replies_are_both_handled():
+    key = content_key(text="Да", controls=CONTROLS)
+    assert key is None
+    res, handled = _run_twice(key)
+    assert res == ["ok", "ok"]
+    assert handled == [1, 2]
+
+def test_buttons_and_commands_are_not_coalesced():
+    assert content_key(text="🧠 Объяснить", controls=CONTROLS) is None
+    assert content_key(text="📚 Предмет: беларуская літаратура", controls=CONTROLS) is None
+    assert content_key(text="/explain реши уравнение 2x + 3 = 7 подробно", controls=CONTROLS) is None
+
+def test_identical_task_text_is_coalesced():
+    key = content_key(text="Реши   уравнение 2x + 3 = 7 подробно", controls=CONTROLS)
+    assert key == content_key(text="реши уравнение 2x + 3 = 7 подробно", controls=CONTROLS)
+    res, handled = _run_twice(key)
+    assert res == ["ok", "coalesced"]
+    assert handled == [1]
+
+def test_photo_keyed_by_file_unique_id():
+    assert content_key(photo_id="AQADx") == "photo:AQADx"
+    assert content_key(text=None, photo_id=None) is None
@@ -0,0 +1,102 @@
+# tests/test_ingest.py — потоковый разбор {"rules": [...]}: битые данные, куски на любой границе (в т.ч. посреди
+# UTF-8 и числа), gzip, пачки по числу/символам, дубли и упавшая пачка
+import asyncio, gzip, json
+
+import pytest
+
+from services.ingest import RulesStream, IngestError, ingest
+
+def _rule(i, brief=None, **kw):
+    r = {"id": f"r{i}", "rule_brief": brief or f"Правило №{i}: ё, «кавычки», 3.14159", "subject": "math",
+         "grade": 7, "book": "Алгебра 7", "page": 10 + i}
+    r.update(kw)
+    return r
+
+def _parse(body: bytes, step: int) -> list:
+    s = RulesStream()
+    out = []
+    for i in range(0, len(body), step):
+        out += s.feed(body[i:i + step])
+    return out + s.close()
+
+def _chunks(body: bytes, step: int):
+    async def gen():
+        for i in range(0, len(body), step):
+            yield body[i:i + step]
+    return gen()
+
+def _run(body: bytes, step: int = 7, **kw):
+    calls = []
+    async def upsert(batch, timings):
+        calls.append([r["id"] for r in batch])
+    rep = asyncio.run(ingest(_chunks(body, step), upsert, **kw))
+    return rep, calls
+
+BODY = json.dumps({"meta": {"v": [1, 2, {"x": "]"}]}, "rules": [_rule(i) for i in range(5)], "tail": 12345},
+                  ensure_ascii=False).encode("utf-8")
+
+@pytest.mark.parametrize("step", [1, 2, 3, 5, 64, len(BODY)])
+def test_any_chunk_boundary_gives_same_items(step):
+    assert _parse(BODY, step) == json.loads(BODY)["rules"]
+
+@pytest.mark.parametrize("step", [1, 13, 4096])
+def test_gzip_body_in_chunks(step):
+    assert _parse(gzip.compress(BODY), step) == json.loads(BODY)["rules"]
+
+def test_number_split_at_chunk_edge_is_not_cut():
+    s = RulesStream()
+    assert s.feed(b'{"items": [12') == []      # «12» может продолжиться
+    assert s.feed(b'34, 5') == [1234]
+    assert s.feed(b"]}") == [5]
+    assert s.close() == []
+
+def test_items_key_and_first_array_only():
+    body = json.dumps({"items": [_rule(1)], "rules": [_rule(2)]}).encode()
+    assert [r["id"] for r in _parse(body, 4)] == ["r1"]
+
+@pytest.mark.parametrize("body, msg", [
+    (b'[{"id": 1}]', "expected JSON object"),
+    (b'{"rules": [{"id": 1}', "unexpected end"),
+    (b'{"rules": [{"id": 1,}]}', "bad JSON"),
+    (b'{"rules" [1]}', "':' expected"),
+    (b'{"rules": []} {"x": 1}', "trailing data"),
+    (gzip.compress(BODY)[:-10], "truncated gzip"),
+])
+def test_malformed_body_raises(body, msg):
+    with pytest.raises(IngestError, match=msg):
+        _parse(body, 5)
+
+def test_oversized_value_rejected():
+    s = RulesStream(max_item=1024)
+    with pytest.raises(IngestError, match="larger than"):
+        s.feed(b'{"rules": ["' + b"a" * 4096)
+
+def test_body_size_limit():
+    s = RulesStream(max_bytes=100)
+    with pytest.raises(IngestError, match="body larger"):
+        _ = s.feed(BODY)
+
+def test_invalid_items_and_duplicates_are_counted_not_fatal():
+    items = [_rule(1), {"id": "bad"}, "not an object", _rule(2, grade="x"), _rule(1), _rule(3)]
+    rep, calls = _run(json.dumps({"rules": items}).encode(), step=3)
+    assert (rep["received"], rep["accepted"], rep["invalid"], rep["duplicates"]) == (6, 2, 3, 1)
+    assert calls == [["r1", "r3"]] and rep["ok"] and rep["upserted"] == 2
+
+def test_batch_size_flush():
+    rep, calls = _run(json.dumps({"rules": [_rule(i) for i in range(7)]}).encode(), batch_size=3, concurrency=1)
+    assert [len(c) for c in calls] == [3, 3, 1]
+    assert [b["batch"] for b in rep["batches"]] == [1, 2, 3] and rep["upserted"] == 7
+
+def test_batch_chars_flush():
+    rules = [_rule(i, brief="x" * 40) for i in range(5)]
+    rep, calls = _run(json.dumps({"rules": rules}).encode(), batch_size=100, batch_chars=100)
+    assert [len(c) for c in calls] == [2, 2, 1]
+
+def test_failed_batch_reported_others_upserted():
+    async def upsert(batch, timings):
+        if batch[0]["id"] == "r2":
+            raise RuntimeError("embeddings 429")
+    body = json.dumps({"rules": [_rule(i) for i in range(6)]}).encode()
+    rep = asyncio.run(ingest(_chunks(body, 16), upsert, batch_size=2))
+    assert not rep["ok"] and rep["upserted"] == 4 and rep["failed"] == 2
+    assert "429" in rep["batches"][1]["error"]
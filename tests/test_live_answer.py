@@ -0,0 +1,50 @@
+# tests/test_live_answer.py — потоковый ответ: итоговая правка несёт inline-клавиатуру, обычная — со спиннером
+import asyncio
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import bot
+
+class _Msg:
+    def __init__(self):
+        self.edits = []; self.deleted = False
+    async def edit_text(self, text, **kw):
+        self.edits.append((text, kw))
+    async def delete(self):
+        self.deleted = True
+
+def _stream(final_markup):
+    msg = _Msg(); kept = []
+    async def take_over(on_done):
+        return msg, lambda: kept.append(1)
+    async def main():
+        live = bot.LiveAnswer(take_over, interval=0.01)
+        live.push("Ответ: 4")
+        await asyncio.sleep(0.02)
+        return await live.finalize("<b>Ответ:</b> 4", final_markup)
+    return asyncio.run(main()), msg, kept
+
+def test_finalize_edits_with_inline_markup():
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("Ещё", callback_data="more")]])
+    ok, msg, kept = _stream(markup)
+    assert ok and kept and not msg.deleted
+    text, kw = msg.edits[-1]
+    assert text == "<b>Ответ:</b> 4" and kw["reply_markup"] is markup
+
+def test_finalize_with_reply_keyboard_keeps_streamed_message():
+    ok, msg, _ = _stream(bot.kb(1))
+    assert ok and not msg.deleted
+    assert msg.edits[-1][1]["reply_markup"] is None   # editMessageText обычную клавиатуру не примет
+
+def test_spinner_message_carries_reply_keyboard():
+    sent = []
+    class _Update:
+        class message:
+            @staticmethod
+            async def reply_text(text, **kw):
+                sent.append(kw); return _Msg()
+    async def main():
+        finish, _, _ = await bot.start_spinner(_Update, None, "Решаю…", reply_markup=bot.kb(1))
+        await finish()
+    asyncio.run(main())
+    assert isinstance(sent[0]["reply_markup"], bot.ReplyKeyboardMarkup)
@@ -0,0 +1,85 @@
+# tests/test_llm_sched.py — диспетчер LLM: порядок классов, round-robin внутри класса, старение, отказ LlmBusy
+import asyncio
+
+import pytest
+
+from services.llm_sched import LlmScheduler, LlmBusy, PRIO_ADMIN, PRIO_PRO, PRIO_FREE, PRIO_FOLLOWUP
+
+def _run_order(sched: LlmScheduler, reqs, before_release=None):
+    """Слот занят, reqs = [(prio, uid, метка)] встают в очередь; после освобождения — порядок получения слота."""
+    async def main():
+        await sched.acquire("m", PRIO_ADMIN, 0)
+        order = []
+
+        async def worker(prio, uid, tag):
+            await sched.acquire("m", prio, uid)
+            order.append(tag)
+            sched.release("m")
+
+        tasks = []
+        for prio, uid, tag in reqs:
+            tasks.append(asyncio.create_task(worker(prio, uid, tag)))
+            await asyncio.sleep(0)   # встать в очередь в заданном порядке
+        if before_release:
+            before_release(sched)
+        sched.release("m")
+        await asyncio.gather(*tasks)
+        return order
+    return asyncio.run(main())
+
+def test_strict_priority_without_aging():
+    sched = LlmScheduler(total=1, per_model=1, aging=0)
+    order = _run_order(sched, [(PRIO_FOLLOWUP, 1, "followup"), (PRIO_FREE, 2, "free"),
+                               (PRIO_PRO, 3, "pro"), (PRIO_ADMIN, 4, "admin")])
+    assert order == ["admin", "pro", "free", "followup"]
+
+def test_round_robin_between_users_in_class():
+    sched = LlmScheduler(total=1, per_model=1, aging=0)
+    order = _run_order(sched, [(PRIO_FREE, 1, "a1"), (PRIO_FREE, 1, "a2"), (PRIO_FREE, 1, "a3"), (PRIO_FREE, 2, "b1")])
+    assert order == ["a1", "b1", "a2", "a3"]
+
+def test_aging_lifts_long_waiting_free_above_pro():
+    def age_free(sched):
+        for w in sched._lanes["m"].classes[PRIO_FREE][2]:
+            w.t -= 100   # ждёт уже 100 с: при aging=15 это больше разницы классов
+    sched = LlmScheduler(total=1, per_model=1, aging=15)
+    order = _run_order(sched, [(PRIO_PRO, 1, "pro"), (PRIO_FREE, 2, "free")], before_release=age_free)
+    assert order == ["free", "pro"]
+
+def test_full_queue_rejects_with_llm_busy():
+    async def main():
+        sched = LlmScheduler(total=1, per_model=1, queue_max=1)
+        await sched.acquire("m", PRIO_FREE, 1)
+        waiter = asyncio.create_task(sched.acquire("m", PRIO_FREE, 2))
+        await asyncio.sleep(0)
+        with pytest.raises(LlmBusy):
+            await sched.acquire("m", PRIO_FREE, 3)
+        assert sched.rejected == 1 and sched.waiting == 1
+        sched.release("m")
+        await waiter
+        sched.release("m")
+        assert sched.running == 0 and sched.waiting == 0
+    asyncio.run(main())
+
+def test_wait_timeout_raises_llm_busy_and_leaves_queue():
+    async def main():
+        sched = LlmScheduler(total=1, per_model=1, wait_timeout=0.05)
+        await sched.acquire("m", PRIO_FREE, 1)
+        with pytest.raises(LlmBusy):
+            await sched.acquire("m", PRIO_FREE, 2)
+        assert sched.timeouts == 1 and sched.waiting == 0
+        sched.release("m")
+        assert await sched.acquire("m", PRIO_FREE, 3) < 0.05   # слот свободен — сразу
+    asyncio.run(main())
+
+def test_per_model_cap_does_not_block_other_models():
+    async def main():
+        sched = LlmScheduler(total=4, per_model=1, caps="")
+        await sched.acquire("gpt-4o", PRIO_PRO, 1)
+        slow = asyncio.create_task(sched.acquire("gpt-4o", PRIO_PRO, 2))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(sched.acquire("gpt-4o-mini", PRIO_FREE, 3), 1)
+        assert not slow.done()
+        sched.release("gpt-4o")
+        await slow
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+# tests/test_metrics_log.py — журнал метрик: дозапись/replay (побеждает последняя), порог сжатия, оборванная
+# последняя строка после падения, атомарное сжатие, импорт старого снимка metrics.json в bot.stats_load
+import json, os
+
+import pytest
+
+import bot
+from services import metrics_log
+from services.metrics_log import MetricsLog
+
+@pytest.fixture
+def mlog(tmp_path):
+    return MetricsLog(str(tmp_path / "metrics.jsonl"))
+
+def test_append_and_replay_last_record_wins(mlog):
+    assert mlog.append([{"uid": 1, "gpt_calls": 1}, {"uid": 2, "gpt_calls": 5}]) == 2
+    assert mlog.append([{"uid": 1, "gpt_calls": 3, "name": "Аня"}]) == 1
+    assert mlog.append([]) == 0
+    recs = MetricsLog(mlog.path).replay()
+    assert recs == {1: {"uid": 1, "gpt_calls": 3, "name": "Аня"}, 2: {"uid": 2, "gpt_calls": 5}}
+    assert mlog.lines == 3 and mlog.bytes == os.path.getsize(mlog.path)
+
+def test_replay_missing_file_is_empty(mlog):
+    assert mlog.replay() == {} and mlog.lines == 0
+
+def test_torn_last_line_skipped_and_next_append_survives(mlog):
+    mlog.append([{"uid": 1, "gpt_calls": 1}, {"uid": 2, "gpt_calls": 2}])
+    with open(mlog.path, "ab") as f:
+        f.write(b'{"uid": 2, "gpt_cal')      # падение посреди записи
+    after_crash = MetricsLog(mlog.path)
+    assert after_crash.replay() == {1: {"uid": 1, "gpt_calls": 1}, 2: {"uid": 2, "gpt_calls": 2}}
+    assert after_crash.lines == 2
+    after_crash.append([{"uid": 3, "gpt_calls": 7}])
+    assert MetricsLog(mlog.path).replay()[3] == {"uid": 3, "gpt_calls": 7}
+
+def test_broken_line_in_the_middle_skipped(mlog):
+    mlog.append([{"uid": 1, "v": 1}])
+    with open(mlog.path, "ab") as f:
+        f.write(b"not json\n")
+    mlog.append([{"uid": 1, "v": 2}])
+    m = MetricsLog(mlog.path)
+    assert m.replay() == {1: {"uid": 1, "v": 2}} and m.lines == 3
+
+def test_compaction_threshold(mlog, monkeypatch):
+    monkeypatch.setattr(metrics_log, "METRICS_LOG_SLACK", 4)
+    mlog.lines = 4 * 256
+    assert not mlog.needs_compaction(10)           # малым базам — не меньше 256 строк на запас
+    mlog.lines += 1
+    assert mlog.needs_compaction(10)
+    assert not mlog.needs_compaction(1000)         # 4 × 1000 пользователей
+    mlog.lines = 0; mlog.bytes = metrics_log.METRICS_LOG_MAX_MB * 1024 * 1024 + 1
+    assert mlog.needs_compaction(1000)             # по размеру файла
+
+def test_compact_rewrites_one_line_per_user(mlog, tmp_path):
+    for v in range(5):
+        mlog.append([{"uid": 1, "v": v}, {"uid": 2, "v": v}])
+    recs = mlog.replay()
+    mlog.compact(recs.values())
+    assert mlog.lines == 2 and mlog.compactions == 1
+    assert MetricsLog(mlog.path).replay() == recs
+    assert sorted(os.listdir(tmp_path)) == ["metrics.jsonl"]   # временный файл не остаётся
+
+def test_failed_compact_keeps_old_log(mlog, tmp_path):
+    mlog.append([{"uid": 1, "v": 1}])
+    def records():
+        yield {"uid": 1, "v": 2}
+        raise RuntimeError("disk full")
+    with pytest.raises(RuntimeError):
+        mlog.compact(records())
+    assert MetricsLog(mlog.path).replay() == {1: {"uid": 1, "v": 1}}
+    assert sorted(os.listdir(tmp_path)) == ["metrics.jsonl"]
+
+# ---------- bot.stats_load: переход с metrics.json ----------
+@pytest.fixture
+def bot_totals():
+    yield
+    bot._rebuild_totals()   # после отката monkeypatch: итоги снова по настоящим USERS
+
+def test_stats_load_imports_legacy_snapshot(bot_totals, tmp_path, monkeypatch):
+    legacy = tmp_path / "metrics.json"
+    legacy.write_text(json.dumps({"users": {
+        "501": {"name": "Петя", "kinds": {"solve_text": 2}, "gpt_calls": 2, "cost_usd": 0.5},
+        "502": {"name": "Маша", "kinds": {"essay": 1}, "gpt_calls": 1, "ocr_ok": 3},
+    }}, ensure_ascii=False), encoding="utf-8")
+    log_ = MetricsLog(str(tmp_path / "metrics.jsonl"))
+    monkeypatch.setattr(bot, "METRICS_PATH", str(legacy))
+    monkeypatch.setattr(bot, "METRICS_LOG", log_)
+    monkeypatch.setattr(bot, "USERS", {})
+    bot.stats_load()
+
+    assert set(bot.USERS) == {501, 502}
+    assert bot.USERS[501].name == "Петя" and bot.USERS[501].kinds["solve_text"] == 2
+    assert bot.TOTALS["gpt_calls"] == 3 and bot.TOTALS["ocr_ok"] == 3 and bot.TOTAL_KINDS["essay"] == 1
+    # снимок сразу переложен в журнал: следующий старт читает уже его
+    recs = MetricsLog(log_.path).replay()
+    assert set(recs) == {501, 502} and recs[502]["name"] == "Маша"
+
+    # журнал не пуст — metrics.json больше не читается
+    legacy.write_text(json.dumps({"users": {"999": {"name": "старьё"}}}), encoding="utf-8")
+    monkeypatch.setattr(bot, "USERS", {})
+    bot.stats_load()
+    assert set(bot.USERS) == {501, 502}
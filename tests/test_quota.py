@@ -0,0 +1,134 @@
+# tests/test_quota.py — квоты: списание на границе лимита, возврат после LlmBusy/ошибки модели,
+# мемо апдейта (одно списание, в том числе из asyncio.to_thread), смена суток
+import asyncio, itertools
+
+import pytest
+
+import bot
+from services.llm_sched import LlmBusy
+from services.storage import tx as db_tx
+
+_uids = itertools.count(910_000_001)
+
+@pytest.fixture
+def uid():
+    return next(_uids)
+
+def _update(fn, *args):
+    """Как в _begin_update: свежее мемо на время одного апдейта."""
+    tok = bot._UPDATE_MEMO.set({})
+    try:
+        return fn(*args)
+    finally:
+        bot._UPDATE_MEMO.reset(tok)
+
+def _free_used(uid) -> int:
+    with db_tx() as db:
+        row = db.execute("SELECT free_count FROM user_plan WHERE user_id=?", (uid,)).fetchone()
+    return row[0] if row else 0
+
+def _expire_pro(uid):
+    with db_tx() as db:
+        bot._plan_row(db, uid)
+        db.execute("UPDATE user_plan SET pro_until=0, sub_until=0 WHERE user_id=?", (uid,))
+
+def test_free_charges_up_to_daily_limit(uid):
+    for _ in range(bot.FREE_LIMIT_PER_DAY):
+        assert _update(bot.consume_request, uid, False) == (True, "free", "")
+    ok, mode, reason = _update(bot.consume_request, uid, False)
+    assert not ok and "лимит" in reason
+    assert _free_used(uid) == bot.FREE_LIMIT_PER_DAY
+
+def test_pro_needs_credit_after_trial(uid):
+    _expire_pro(uid)
+    assert not _update(bot.consume_request, uid, True)[0]
+    bot.add_credits(uid, 1)
+    assert _update(bot.consume_request, uid, True) == (True, "pro", "")
+    assert not _update(bot.consume_request, uid, True)[0]
+
+def test_one_charge_per_update(uid):
+    def twice():
+        bot.consume_request(uid, False)
+        return bot.consume_request(uid, False)
+    assert _update(twice) == (True, "free", "")
+    assert _free_used(uid) == 1
+
+def test_memo_shared_with_to_thread_charges_once(uid):
+    async def handler():
+        bot._UPDATE_MEMO.set({})
+        return await asyncio.gather(*(asyncio.to_thread(bot.consume_request, uid, False) for _ in range(8)))
+    res = asyncio.run(handler())
+    assert all(r == (True, "free", "") for r in res)
+    assert _free_used(uid) == 1
+
+def test_refund_is_idempotent(uid):
+    def charge_and_refund():
+        bot.consume_request(uid, False)
+        return bot.refund_request(uid), bot.refund_request(uid)
+    assert _update(charge_and_refund) == (True, False)
+    assert _free_used(uid) == 0
+
+def test_credit_refund_returns_credit(uid):
+    _expire_pro(uid)
+    bot.add_credits(uid, 1)
+    def charge_and_refund():
+        assert bot.consume_request(uid, True)[0]
+        return bot.refund_request(uid)
+    assert _update(charge_and_refund)
+    assert bot.plan_get(uid)["credits"] == 1
+
+def test_day_rollover_resets_free_and_refund_keeps_new_day(uid, monkeypatch):
+    today = bot.DAY()
+    for _ in range(bot.FREE_LIMIT_PER_DAY):
+        _update(bot.consume_request, uid, False)
+    assert not _update(bot.consume_request, uid, False)[0]
+
+    monkeypatch.setattr(bot, "DAY", lambda: today + 1)
+    assert bot.plan_get(uid)["free_left_today"] == bot.FREE_LIMIT_PER_DAY
+    assert _update(bot.consume_request, uid, False)[0]
+    assert _free_used(uid) == 1
+
+    # списали вчера, возвращаем уже сегодня — сегодняшний счётчик не трогаем
+    def charge_yesterday_refund_today():
+        monkeypatch.setattr(bot, "DAY", lambda: today + 1)
+        bot.consume_request(uid, False)
+        monkeypatch.setattr(bot, "DAY", lambda: today + 2)
+        return bot.refund_request(uid)
+    _update(charge_yesterday_refund_today)
+    assert bot.plan_get(uid)["free_left_today"] == bot.FREE_LIMIT_PER_DAY
+
+# ---------- возврат при отказе очереди / ошибке модели ----------
+async def _no_rag(uid, text, qv_task=None):
+    return None, []
+
+class _FailingCompletions:
+    async def create(self, **kw):
+        raise RuntimeError("upstream 500")
+
+class _FailingClient:
+    class chat:
+        completions = _FailingCompletions()
+
+def _solve(uid, text):
+    async def handler():
+        bot._UPDATE_MEMO.set({})
+        ok, mode, _ = bot.consume_request(uid, False)
+        assert ok
+        return await bot.call_model(uid, text, mode)
+    return asyncio.run(handler())
+
+def test_refund_after_llm_busy(uid, monkeypatch):
+    async def busy(*a, **kw):
+        raise LlmBusy("LLM queue full")
+    monkeypatch.setattr(bot, "retrieve_context", _no_rag)
+    monkeypatch.setattr(bot.llm_sched, "acquire", busy)
+    with pytest.raises(LlmBusy):   # отказ очереди — исключением: вызывающий не сохраняет его как ответ
+        _solve(uid, f"задача про поезда {uid}: найди скорость")
+    assert _free_used(uid) == 0
+
+def test_refund_after_model_error(uid, monkeypatch):
+    monkeypatch.setattr(bot, "retrieve_context", _no_rag)
+    monkeypatch.setattr(bot, "client", _FailingClient())
+    out = _solve(uid, f"задача про бассейн {uid}: за сколько часов")
+    assert out.startswith("❌")
+    assert _free_used(uid) == 0
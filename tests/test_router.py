@@ -0,0 +1,80 @@
+# tests/test_router.py — предохранитель моделей: срыв, проба half-open, закрытие, возврат пробы при раннем выходе
+from services.router import ModelRouter, CLOSED, OPEN, HALF_OPEN, ROUTER_OPEN_SEC, ROUTER_DECISIONS
+
+PRO_TASK = "Реши уравнение 3x + 5 = 20"   # Pro → o4-mini, запасная gpt-4o-mini
+
+class Clock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+def _router():
+    clock = Clock()
+    return ModelRouter(clock=clock, min_calls=4, consec_fail=3, budgets={}), clock
+
+def _trip(r, model="o4-mini"):
+    for _ in range(3):
+        r.record(model, 1.0, False)
+    return r._health[model]
+
+def test_consecutive_failures_open_breaker_and_route_to_fallback():
+    r, _ = _router()
+    assert r.select(PRO_TASK, "pro").model == "o4-mini"
+    assert _trip(r).state == OPEN
+    rt = r.select(PRO_TASK, "pro")
+    assert (rt.model, rt.reason, rt.probe) == ("gpt-4o-mini", "breaker:o4-mini", False)
+
+def test_half_open_gives_single_probe_and_success_closes():
+    r, clock = _router()
+    h = _trip(r)
+    clock.t += ROUTER_OPEN_SEC
+    rt = r.select(PRO_TASK, "pro")
+    assert (rt.model, rt.reason, rt.probe) == ("o4-mini", "probe", True)
+    assert h.state == HALF_OPEN
+    assert r.select(PRO_TASK, "pro").model == "gpt-4o-mini"   # пока проба в пути — вторую не даём
+    r.record("o4-mini", 1.0, True, reason=rt.reason)
+    assert h.state == CLOSED
+    assert r.select(PRO_TASK, "pro").model == "o4-mini"
+
+def test_failed_probe_reopens_with_doubled_pause():
+    r, clock = _router()
+    h = _trip(r)
+    clock.t += ROUTER_OPEN_SEC
+    assert r.select(PRO_TASK, "pro").probe
+    r.record("o4-mini", 1.0, False)
+    assert h.state == OPEN and h.open_for == 2 * ROUTER_OPEN_SEC
+    clock.t += ROUTER_OPEN_SEC
+    assert r.select(PRO_TASK, "pro").model == "gpt-4o-mini"
+
+def test_release_returns_probe_on_early_exit():
+    r, clock = _router()
+    h = _trip(r)
+    clock.t += ROUTER_OPEN_SEC
+    rt = r.select(PRO_TASK, "pro")
+    assert rt.probe and h.probe_at
+    r.release(rt)                                  # LlmBusy / отмена до вызова модели
+    assert h.probe_at == 0.0 and h.state == HALF_OPEN
+    again = r.select(PRO_TASK, "pro")
+    assert again.model == "o4-mini" and again.probe
+
+def test_release_of_non_probe_keeps_outstanding_probe():
+    r, clock = _router()
+    h = _trip(r)
+    clock.t += ROUTER_OPEN_SEC
+    assert r.select(PRO_TASK, "pro").probe
+    other = r.select(PRO_TASK, "pro")
+    assert not other.probe
+    r.release(other)
+    assert h.probe_at == clock.t
+
+def test_decision_counted_only_when_model_called():
+    r, _ = _router()
+    key = ("gpt-4o-mini", "static")
+    before = ROUTER_DECISIONS._series.get(key, 0)
+    rt = r.select("привет", "free")
+    r.release(rt)
+    assert ROUTER_DECISIONS._series.get(key, 0) == before
+    r.record(rt.model, 0.5, True, reason=rt.reason)
+    assert ROUTER_DECISIONS._series.get(key, 0) == before + 1
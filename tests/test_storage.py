@@ -0,0 +1,97 @@
+# tests/test_storage.py — миграции app.db: база в форме до миграций (events/users/sub_usage из services/usage.py,
+# followup_state/user_plan/admin_users из bot.py) доводится через все шаги user_version; упавший шаг откатывается
+import sqlite3
+
+import pytest
+
+from services import storage
+
+def _baseline_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE users(user_id INTEGER PRIMARY KEY, credits INTEGER DEFAULT 0, sub_until INTEGER DEFAULT 0);
+        CREATE TABLE events(ts INTEGER, day INTEGER, ym TEXT, user_id INTEGER,
+                            type TEXT, mode TEXT, model TEXT, amount INTEGER);
+        CREATE INDEX idx_events_day ON events(day);
+        CREATE INDEX idx_events_ym ON events(ym);
+        CREATE TABLE sub_usage(user_id INTEGER, ym TEXT, used INTEGER, PRIMARY KEY(user_id, ym));
+        CREATE TABLE followup_state(user_id INTEGER PRIMARY KEY, last_task TEXT, last_answer TEXT,
+                                    ts INTEGER, used_free INTEGER);
+        CREATE TABLE user_plan(user_id INTEGER PRIMARY KEY, pro_until INTEGER NOT NULL DEFAULT 0,
+                               day INTEGER NOT NULL DEFAULT 0, free_count INTEGER NOT NULL DEFAULT 0,
+                               credits INTEGER NOT NULL DEFAULT 0, sub_until INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE admin_users(user_id INTEGER PRIMARY KEY, added_ts INTEGER);
+        INSERT INTO events VALUES(1700000000, 19675, '202311', 42, 'query', 'free', '4o-mini', NULL);
+        INSERT INTO user_plan(user_id, free_count, credits) VALUES(42, 2, 5);
+    """)
+    conn.commit(); conn.close()
+
+def _migrate(path, monkeypatch):
+    monkeypatch.setattr(storage, "_migrated", False)
+    storage.migrate(str(path))
+
+def _inspect(path):
+    conn = sqlite3.connect(path)
+    try:
+        ver = conn.execute("PRAGMA user_version").fetchone()[0]
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        cols = [r[1] for r in conn.execute("PRAGMA table_info(events)")]
+        return conn, ver, tables, cols
+    except Exception:
+        conn.close(); raise
+
+def test_baseline_db_upgrades_through_every_step(tmp_path, monkeypatch):
+    path = tmp_path / "app.db"
+    _baseline_db(path)
+    _migrate(path, monkeypatch)
+    conn, ver, tables, cols = _inspect(path)
+    try:
+        assert ver == len(storage.MIGRATIONS) == storage.MIGRATIONS[-1][0]
+        assert {"app_meta", "user_session", "events", "user_plan", "followup_state", "admin_users"} <= tables
+        assert cols == ["ts", "day", "ym", "user_id", "type", "mode", "model", "amount",
+                        "model_name", "kind", "tok_prompt", "tok_cached", "tok_completion", "cost_usd"]
+        # старые строки на месте, новые колонки у них пустые
+        assert conn.execute("SELECT user_id, mode, kind, cost_usd FROM events").fetchall() == [(42, "free", None, None)]
+        assert conn.execute("SELECT free_count, credits FROM user_plan WHERE user_id=42").fetchone() == (2, 5)
+        assert conn.execute("SELECT value FROM app_meta WHERE key='admins_version'").fetchone() == (0,)
+        idx = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+        assert {"idx_events_day", "idx_events_ym", "idx_events_user_day"} <= idx
+    finally:
+        conn.close()
+
+    _migrate(path, monkeypatch)   # повторный запуск — ни одного шага
+    assert _inspect(path)[1] == len(storage.MIGRATIONS)
+
+def test_fresh_db_gets_full_schema(tmp_path, monkeypatch):
+    path = tmp_path / "new" / "app.db"
+    _migrate(path, monkeypatch)
+    conn, ver, tables, cols = _inspect(path)
+    conn.close()
+    assert ver == len(storage.MIGRATIONS) and "cost_usd" in cols and "user_session" in tables
+
+def test_failed_step_rolls_back_whole_migration(tmp_path, monkeypatch):
+    path = tmp_path / "app.db"
+    _baseline_db(path)
+    conn = sqlite3.connect(path)
+    conn.execute("ALTER TABLE events ADD COLUMN kind TEXT")   # ручная правка: v4 споткнётся о дубль колонки
+    conn.commit(); conn.close()
+
+    with pytest.raises(sqlite3.OperationalError, match="duplicate column"):
+        _migrate(path, monkeypatch)
+    conn, ver, tables, cols = _inspect(path)
+    idx = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    conn.close()
+    assert ver == 3                                   # v1–v3 применены, v4 — нет
+    assert "user_session" in tables
+    assert "model_name" not in cols                   # ALTER до падения откачен
+    assert "idx_events_user_day" not in idx
+    assert not storage._migrated
+
+    # после починки базы миграция проходит с того же места
+    conn = sqlite3.connect(path)
+    conn.execute("ALTER TABLE events DROP COLUMN kind")
+    conn.commit(); conn.close()
+    _migrate(path, monkeypatch)
+    conn, ver, _, cols = _inspect(path)
+    conn.close()
+    assert ver == len(storage.MIGRATIONS) and cols.count("kind") == 1 and "model_name" in cols